@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Request, Form, Depends, HTTPException, status, BackgroundTasks, File, UploadFile, Query
+from fastapi import FastAPI, Request, Form, Depends, HTTPException, status, File, UploadFile, Query
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
@@ -13,7 +13,12 @@ import httpx
 import json
 import shutil
 from aiogram import Bot
-from bot.config import load_settings
+from bot.config import get_settings
+from bot.db import Database
+from bot.db_pool import SQLitePool
+from bot.history_store import history_store, thumb_of, utc_day
+from bot.thumbnails import FULL_SIZE, THUMB_SIZES, thumbnail_cache
+from bot.pagination import as_user_id, decode_cursor, encode_cursor, is_pid
 from bot.strings import get_string
 from datetime import datetime, timedelta
 import re
@@ -1926,34 +1931,78 @@ async def _get_prompt_placeholders(db: aiosqlite.Connection) -> list[dict]:
             unique.append(p)
     return unique
 
+# Общий экземпляр bot.db.Database: держит пул соединений, поэтому не создаём его на каждый запрос
+_bot_db: Database | None = None
+
+
+def get_bot_db() -> Database:
+    global _bot_db
+    if _bot_db is None:
+        _bot_db = Database(DB_PATH)
+    return _bot_db
+
+
+# Соединения веб-админки: один писатель и ADMIN_DB_READERS читателей, строки — aiosqlite.Row.
+# Отдельно от пула get_bot_db(): запрос держит своё соединение до конца и не должен
+# ждать соединения, которое нужно методам Database в этом же запросе.
+ADMIN_DB_READERS = 8
+_db_pool: SQLitePool | None = None
+
+
+def get_db_pool() -> SQLitePool:
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = SQLitePool(DB_PATH, readers=ADMIN_DB_READERS, row_factory=aiosqlite.Row)
+    return _db_pool
+
+
+_tg_bot: Bot | None = None
+_tg_bot_lock = asyncio.Lock()
+
+
+async def get_tg_bot() -> Bot:
+    """Один Bot (и одна HTTP-сессия) на процесс админки — для прокси файлов и уведомлений.
+
+    Прокси — как у бота (bot.tg_proxy.resolve_bot_proxy), с фолбэком на PROXY_* из .env.
+    """
+    global _tg_bot
+    if _tg_bot is not None:
+        return _tg_bot
+    async with _tg_bot_lock:
+        if _tg_bot is None:
+            from aiogram.client.session.aiohttp import AiohttpSession
+            from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+            from bot.outbound import outbound_limiter
+            from bot.tg_proxy import parse_proxy, resolve_bot_proxy
+
+            api_url = getattr(settings, "telegram_api_url", None)
+            api = TelegramAPIServer.from_base(api_url) if api_url else PRODUCTION
+            try:
+                proxy = await resolve_bot_proxy(get_bot_db())
+            except Exception as e:
+                print(f"Telegram proxy lookup failed: {e}")
+                proxy = None
+            if proxy is None:
+                proxy = parse_proxy(settings.proxy.as_url() or "")
+            session = AiohttpSession(api=api, proxy=proxy, timeout=60) if proxy else AiohttpSession(api=api, timeout=60)
+            bot = Bot(token=settings.bot_token, session=session)
+            bot.session.middleware(outbound_limiter)
+            _tg_bot = bot
+    return _tg_bot
+
+
+HISTORY_RETENTION_DAYS = 7
+
+
 async def cleanup_old_history():
-    """Фоновая задача для очистки истории старше 7 дней"""
+    """Фоновая задача для очистки истории старше HISTORY_RETENTION_DAYS дней"""
     while True:
         try:
-            async with aiosqlite.connect(DB_PATH) as db:
-                # Находим записи старше 7 дней
-                async with db.execute("SELECT pid, input_paths, result_path FROM generation_history WHERE created_at < datetime('now', '-7 days')") as cur:
-                    old_records = await cur.fetchall()
-                
-                if old_records:
-                    print(f"Cleanup: Found {len(old_records)} old generations to delete")
-                    for pid, inps_json, res_path in old_records:
-                        # Удаляем файлы
-                        if res_path and os.path.exists(res_path):
-                            try: os.remove(res_path)
-                            except: pass
-                        if inps_json:
-                            try:
-                                inps = json.loads(inps_json)
-                                for p in inps:
-                                    if p and os.path.exists(p):
-                                        try: os.remove(p)
-                                        except: pass
-                            except: pass
-                        
-                        # Удаляем из БД
-                        await db.execute("DELETE FROM generation_history WHERE pid=?", (pid,))
-                    await db.commit()
+            # Строки — пачками по индексу created_at, файлы — каталогами дней
+            deleted = await get_bot_db().cleanup_old_generations(HISTORY_RETENTION_DAYS)
+            dropped, loose = await asyncio.to_thread(history_store.drop_expired, HISTORY_RETENTION_DAYS)
+            if deleted or dropped or loose:
+                print(f"Cleanup: {deleted} old generations, {dropped} day dirs, {loose} loose files deleted")
         except Exception as e:
             print(f"Cleanup history error: {e}")
         
@@ -1969,7 +2018,7 @@ async def lifespan(app: FastAPI):
         
         # Запуск миграций при старте
         try:
-            async with aiosqlite.connect(DB_PATH, timeout=30) as db:
+            async with get_db_pool().write() as db:
                 await run_migrations(db)
                 
                 async with db.execute("PRAGMA table_info(generation_history)") as cur:
@@ -1994,6 +2043,12 @@ async def lifespan(app: FastAPI):
             print(f"ERROR in lifespan migrations: {e}")
             import traceback
             traceback.print_exc()
+
+        # Индексы поиска (FTS5) и их триггеры — после миграций, которые создают site_users
+        try:
+            await get_bot_db().ensure_search_index()
+        except Exception as e:
+            print(f"ERROR creating search index: {e}")
         
         # Запуск очистки в фоне
         try:
@@ -2007,6 +2062,16 @@ async def lifespan(app: FastAPI):
         
     yield
 
+    if _tg_bot is not None:
+        await _tg_bot.session.close()
+    thumbnail_cache.close()
+    if _db_pool is not None:
+        await _db_pool.close()
+    if _bot_db is not None:
+        await _bot_db.close()
+    from bot.gemini import close_clients
+    await close_clients()
+
 # Домен и путь для g-box.space
 BASE_URL = os.getenv("BASE_URL", "https://g-box.space").rstrip("/")
 BASE_PATH = os.getenv("BASE_PATH", "").rstrip("/")  # Если приложение под подпутём, напр. /app
@@ -2042,6 +2107,7 @@ app.mount("/uploads", StaticFiles(directory=os.path.join(BASE_DIR, "data", "uplo
 # --- Шаблоны ---
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "admin_web", "templates"))
 templates.env.filters["from_json"] = json.loads
+templates.env.filters["thumb"] = thumb_of
 templates.env.globals["is_site_admin"] = lambda email: email == ADMIN_USER if email else False
 templates.env.globals["base_url"] = BASE_URL
 templates.env.globals["user"] = None  # по умолчанию для страниц без авторизации
@@ -2051,7 +2117,7 @@ templates.env.globals["SITE_STRINGS"] = SITE_STRINGS
 security = HTTPBasic()
 
 try:
-    settings = load_settings()
+    settings = get_settings()
 except Exception as e:
     print(f"Error loading settings: {e}")
     class MockSettings:
@@ -2082,12 +2148,15 @@ def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
     return credentials.username
 
 async def get_db():
-    db = await aiosqlite.connect(DB_PATH, timeout=30)
-    db.row_factory = aiosqlite.Row
-    try:
+    """Соединение для чтения (query_only) из общего пула — страницы, списки, API только на чтение."""
+    async with get_db_pool().read() as db:
+        yield db
+
+
+async def get_write_db():
+    """Писатель пула: маршруты с записью получают его по очереди, без гонки за блокировку SQLite."""
+    async with get_db_pool().write() as db:
         yield db
-    finally:
-        await db.close()
 
 
 def _get_site_user_from_session(request: Request) -> dict | None:
@@ -2148,11 +2217,7 @@ async def api_site_strings(lang: str = "ru"):
 async def api_site_status():
     """Диагностика: проверка API ключей и БД"""
     try:
-        import sys
-        if BASE_DIR not in sys.path:
-            sys.path.insert(0, BASE_DIR)
-        from bot.db import Database
-        bot_db = Database(DB_PATH)
+        bot_db = get_bot_db()
         keys = await bot_db.list_api_keys()
         active = sum(1 for k in keys if k[2])
         return {"api_keys_total": len(keys), "api_keys_active": active, "db_path": DB_PATH}
@@ -2197,7 +2262,7 @@ async def register_submit(
     email: str = Form(...),
     password: str = Form(...),
     password2: str = Form(...),
-    db: aiosqlite.Connection = Depends(get_db),
+    db: aiosqlite.Connection = Depends(get_write_db),
 ):
     if password != password2:
         return templates.TemplateResponse("register.html", {"request": request, "error": "Пароли не совпадают", "user": None})
@@ -2249,12 +2314,13 @@ async def profile_page(request: Request, user=Depends(require_site_user), db: ai
 
 
 @app.post("/profile/lang")
-async def profile_lang(request: Request, lang: str = Form(...), next_url: str = Form("/profile"), user=Depends(require_site_user), db: aiosqlite.Connection = Depends(get_db)):
+async def profile_lang(request: Request, lang: str = Form(...), next_url: str = Form("/profile"), user=Depends(require_site_user), db: aiosqlite.Connection = Depends(get_write_db)):
     if lang not in ("ru", "en", "vi"):
         lang = "ru"
     await db.execute("UPDATE site_users SET language=? WHERE id=?", (lang, user["id"]))
     await db.execute("UPDATE users SET language=? WHERE id=?", (lang, -user["id"]))
     await db.commit()
+    get_bot_db().invalidate_user_profile(-user["id"])
     if request.session.get("site_user"):
         request.session["site_user"]["language"] = lang
     return RedirectResponse(url=next_url or "/profile", status_code=302)
@@ -2357,20 +2423,19 @@ async def api_site_models(category: str, db: aiosqlite.Connection = Depends(get_
 
 
 @app.post("/api/site/generate")
-async def api_site_generate(
-    request: Request,
-    user=Depends(require_site_user),
-    db: aiosqlite.Connection = Depends(get_db),
-):
+async def api_site_generate(request: Request):
+    # Генерация идёт до минуты — соединение пула берём только на проверку пользователя
+    async with get_db_pool().read() as db:
+        user = await require_site_user(request, db)
     try:
-        return await _api_site_generate_impl(request, user, db)
+        return await _api_site_generate_impl(request, user)
     except Exception as e:
         import traceback
         traceback.print_exc()
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
-async def _api_site_generate_impl(request: Request, user: dict, db):
+async def _api_site_generate_impl(request: Request, user: dict):
     form = await request.form()
     category = form.get("category", "")
     model_id = form.get("model_id") or None
@@ -2393,10 +2458,9 @@ async def _api_site_generate_impl(request: Request, user: dict, db):
     import sys
     if BASE_DIR not in sys.path:
         sys.path.insert(0, BASE_DIR)
-    from bot.db import Database
-    from bot.gemini import generate_image
+    from bot.scheduler import QueueFull, generation_scheduler
 
-    bot_db = Database(DB_PATH)
+    bot_db = get_bot_db()
     user_id = -user["id"]
     price = 20
 
@@ -2411,8 +2475,9 @@ async def _api_site_generate_impl(request: Request, user: dict, db):
     images_bytes = []
     needs_model_photo = category in ("storefront", "female", "male", "child", "boy", "girl", "presets", "own") and model_id
     if needs_model_photo:
-        async with db.execute("SELECT photo_file_id FROM models WHERE id=?", (model_id,)) as cur:
-            row = await cur.fetchone()
+        async with get_db_pool().read() as db:
+            async with db.execute("SELECT photo_file_id FROM models WHERE id=?", (model_id,)) as cur:
+                row = await cur.fetchone()
         if row and row[0]:
             bg_path = str(row[0]).replace("\\", "/")
             full = os.path.join(BASE_DIR, bg_path) if not os.path.isabs(bg_path) else bg_path
@@ -2438,21 +2503,34 @@ async def _api_site_generate_impl(request: Request, user: dict, db):
     if not prompt:
         return JSONResponse({"error": "Не удалось сформировать промпт"}, status_code=500)
 
-    api_keys = await bot_db.list_api_keys()
-    active_keys = [(k[0], k[1]) for k in api_keys if k[2]]
-    if not active_keys:
+    if not await bot_db.key_pool.has_active_keys():
         return JSONResponse({"error": "Нет активных API ключей"}, status_code=503)
 
-    import random
+    try:
+        # Общая очередь генераций: ответ придёт, когда освободится линия
+        async with generation_scheduler.slot(user_id):
+            return await _site_generate_with_keys(
+                bot_db, user_id, price, category, model_id, aspect, prompt, images_bytes,
+            )
+    except QueueFull as e:
+        if e.reason == "user":
+            return JSONResponse({"error": "Генерация уже выполняется"}, status_code=429)
+        return JSONResponse({"error": "Очередь генераций переполнена, попробуйте позже"}, status_code=429)
+
+
+async def _site_generate_with_keys(bot_db, user_id, price, category, model_id, aspect, prompt, images_bytes):
+    from bot.gemini import generate_image
     import uuid
-    random.shuffle(active_keys)
     last_err = None
-    for kid, token in active_keys[:5]:
-        ok, _ = await bot_db.check_api_key_limits(kid)
-        if not ok:
-            continue
+    tried_ids: set[int] = set()
+    while len(tried_ids) < 5:
+        lease = await bot_db.key_pool.acquire(exclude=tried_ids)
+        if lease is None:
+            break
+        kid, token = lease.key_id, lease.token
+        tried_ids.add(kid)
         try:
-            result_path = await generate_image(
+            result = await generate_image(
                 api_key=token,
                 prompt=prompt,
                 images_bytes=images_bytes,
@@ -2460,10 +2538,17 @@ async def _api_site_generate_impl(request: Request, user: dict, db):
                 key_id=kid,
                 db_instance=bot_db,
             )
-            if result_path:
+            if not result:
+                lease.failure()
+            else:
+                lease.success()
                 pid = f"WEB{str(uuid.uuid4().hex[:10]).upper()}"
-                rp = result_path.replace("\\", "/")
-                rp_db = rp.split("/")[-1] if "/" in rp else rp  # для href /data/xxx
+                # Результат сайта — в тот же каталог дня, что и история бота (оттуда и отдаётся по /data/...)
+                rp_db = history_store.result_path(pid, utc_day())
+                if result.data is not None:
+                    await asyncio.to_thread(history_store.write, rp_db, result.data)
+                else:
+                    await asyncio.to_thread(history_store.move, result.path, rp_db)
                 await bot_db.subtract_user_balance(user_id, price, reason="generation")
                 await bot_db.add_generation_history(
                     pid=pid,
@@ -2480,12 +2565,15 @@ async def _api_site_generate_impl(request: Request, user: dict, db):
                 new_balance = await bot_db.get_user_balance(user_id)
                 return JSONResponse({
                     "result_path": rp_db,
-                    "result_url": "/data/" + rp_db,
+                    "result_url": "/" + rp_db,
                     "new_balance": new_balance,
                 })
         except Exception as e:
+            lease.failure(e)
             last_err = str(e)
             continue
+        finally:
+            lease.release()
 
     return JSONResponse({"error": last_err or "Ошибка генерации"}, status_code=500)
 
@@ -2505,17 +2593,9 @@ async def _build_web_prompt(category: str, model_id: int | None, aspect: str, db
     
     # Для категорий с моделями - берем промпт модели, затем добавляем общий промпт категории если есть
     if category in ("female", "male", "child", "boy", "girl", "presets", "own") and model_id:
-        base = ""
         # Промпт модели из таблицы prompts
-        async with aiosqlite.connect(DB_PATH) as conn:
-            async with conn.execute(
-                "SELECT p.text FROM prompts p JOIN models m ON m.prompt_id=p.id WHERE m.id=?",
-                (model_id,),
-            ) as cur:
-                row = await cur.fetchone()
-        if row:
-            base = row[0]
-        else:
+        base = await db.get_model_prompt_text(model_id)
+        if base is None:
             base = "Professional commercial photography. High quality, 8k resolution."
         
         # Добавляем общий промпт категории если есть
@@ -2548,7 +2628,7 @@ async def _build_web_prompt(category: str, model_id: int | None, aspect: str, db
 
 
 @app.get("/models/toggle/{model_id}")
-async def toggle_model_status(model_id: int, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def toggle_model_status(model_id: int, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     """Включает/выключает модель (пресет)"""
     async with db.execute("SELECT is_active FROM models WHERE id=?", (model_id,)) as cur:
         row = await cur.fetchone()
@@ -2562,7 +2642,7 @@ async def toggle_model_status(model_id: int, db: aiosqlite.Connection = Depends(
     return RedirectResponse(url="/prompts", status_code=303)
 
 @app.get("/models/delete/{model_id}")
-async def delete_model(model_id: int, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def delete_model(model_id: int, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     async with db.execute("SELECT prompt_id, photo_file_id FROM models WHERE id=?", (model_id,)) as cur:
         row = await cur.fetchone()
         if row:
@@ -2580,7 +2660,7 @@ async def delete_model(model_id: int, db: aiosqlite.Connection = Depends(get_db)
     return RedirectResponse(url="/prompts", status_code=303)
 
 @app.post("/models/delete_bulk")
-async def delete_bulk_models(model_ids: str = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def delete_bulk_models(model_ids: str = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     ids = [int(x) for x in model_ids.split(",") if x.isdigit()]
     for model_id in ids:
         async with db.execute("SELECT prompt_id, photo_file_id FROM models WHERE id=?", (model_id,)) as cur:
@@ -2629,20 +2709,6 @@ async def check_proxy(db: aiosqlite.Connection = None):
     except Exception as e:
         return f"❌ Ошибка: {str(e)[:50]}"
 
-async def run_broadcast(message_text: str):
-    if settings.bot_token == "MOCK": return
-    bot = Bot(token=settings.bot_token)
-    db = await aiosqlite.connect(DB_PATH)
-    async with db.execute("SELECT id FROM users") as cur:
-        users = await cur.fetchall()
-    for user in users:
-        try:
-            await bot.send_message(user[0], message_text)
-            await asyncio.sleep(0.05)
-        except Exception: continue
-    await bot.session.close()
-    await db.close()
-
 async def send_subscription_notification(user_id: int, plan_name: str, expires_at_str: str, daily_limit: int, lang: str):
     """Отправляет уведомление пользователю об активации подписки"""
     if settings.bot_token == "MOCK": return
@@ -2673,10 +2739,8 @@ async def send_subscription_notification(user_id: int, plan_name: str, expires_a
                          expires_date=expires_date,
                          expires_time=expires_time,
                          daily_limit=daily_limit)
-        
-        bot = Bot(token=settings.bot_token)
-        await bot.send_message(user_id, text)
-        await bot.session.close()
+
+        await (await get_tg_bot()).send_message(user_id, text)
     except Exception as e:
         print(f"Error sending subscription notification to {user_id}: {e}")
 
@@ -2740,32 +2804,59 @@ async def index(request: Request, db: aiosqlite.Connection = Depends(get_db), us
         "recent_errors": recent_errors, "proxy_errors_count": proxy_errors_count
     })
 
+def _keyset_page(rows: list, limit: int) -> tuple[list, str | None]:
+    """Страница из limit+1 прочитанных строк и курсор следующей (см. bot/pagination.py)."""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+
+
+async def _fetch_ranked(db: aiosqlite.Connection, query: str, ids: list[int]) -> list:
+    """Строки по списку id из поиска — в порядке релевантности (query содержит «IN ({ids})»)."""
+    if not ids:
+        return []
+    async with db.execute(query.format(ids=",".join("?" * len(ids))), ids) as cur:
+        rows = await cur.fetchall()
+    order = {row_id: i for i, row_id in enumerate(ids)}
+    return sorted(rows, key=lambda r: order.get(r["id"], len(order)))
+
+
+USERS_PAGE_SIZE = 50
+
+
 @app.get("/users", response_class=HTMLResponse)
-async def list_users(request: Request, q: str = "", db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
-    if q:
-        query = """
-            SELECT u.id, u.username, u.blocked, u.balance, u.generation_price, su.email as site_email
-            FROM users u 
-            LEFT JOIN site_users su ON su.id = -u.id
-            WHERE CAST(u.id AS TEXT) LIKE ? OR u.username LIKE ? OR su.email LIKE ?
-            ORDER BY u.created_at DESC LIMIT 100
-        """
-        async with db.execute(query, (f"%{q}%", f"%{q}%", f"%{q}%")) as cur:
+async def list_users(request: Request, q: str = "", after: str = "", db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+    select = """
+        SELECT u.id, u.username, u.blocked, u.balance, u.generation_price, u.created_at, su.email as site_email
+        FROM users u
+        LEFT JOIN site_users su ON su.id = -u.id
+    """
+    next_cursor = None
+    q = q.strip()
+    user_id = as_user_id(q) if q else None
+    if user_id is not None:
+        # Точное совпадение по id — поиск по первичному ключу
+        async with db.execute(select + " WHERE u.id = ?", (user_id,)) as cur:
             rows = await cur.fetchall()
+    elif q:
+        # Полнотекстовый поиск по username, имени и email; порядок — по релевантности
+        ids = await get_bot_db().search_users(q, limit=100)
+        rows = await _fetch_ranked(db, select + " WHERE u.id IN ({ids})", ids)
     else:
-        query = """
-            SELECT u.id, u.username, u.blocked, u.balance, u.generation_price, su.email as site_email
-            FROM users u 
-            LEFT JOIN site_users su ON su.id = -u.id
-            ORDER BY u.created_at DESC LIMIT 50
-        """
-        async with db.execute(query) as cur:
-            rows = await cur.fetchall()
+        cursor = decode_cursor(after)
+        where, args = ("WHERE (u.created_at, u.id) < (?, ?)", cursor) if cursor else ("", ())
+        async with db.execute(
+            select + f" {where} ORDER BY u.created_at DESC, u.id DESC LIMIT ?", (*args, USERS_PAGE_SIZE + 1)
+        ) as cur:
+            rows, next_cursor = _keyset_page(await cur.fetchall(), USERS_PAGE_SIZE)
     users = [dict(zip(r.keys(), r)) for r in rows]
     return templates.TemplateResponse("users.html", {
         "request": request, 
         "users": users, 
-        "q": q
+        "q": q,
+        "after": after,
+        "next_cursor": next_cursor,
     })
 
 @app.post("/users/edit_balance")
@@ -2773,7 +2864,7 @@ async def edit_balance(
     user_id: int = Form(...),
     amount: int = Form(...),
     price: int = Form(...),
-    db: aiosqlite.Connection = Depends(get_db),
+    db: aiosqlite.Connection = Depends(get_write_db),
     user: str = Depends(get_current_username)
 ):
     # Получаем текущий баланс для лога
@@ -2792,21 +2883,23 @@ async def edit_balance(
     )
     
     await db.commit()
+    get_bot_db().invalidate_user_profile(user_id)
     return RedirectResponse(url=f"/users?q={user_id}", status_code=303)
 
 @app.post("/admin/block_user")
 async def admin_block_user_route(
     user_id: int = Form(...),
     block: int = Form(...),
-    db: aiosqlite.Connection = Depends(get_db),
+    db: aiosqlite.Connection = Depends(get_write_db),
     user: str = Depends(get_current_username)
 ):
     await db.execute("UPDATE users SET blocked = ? WHERE id = ?", (block, user_id))
     await db.commit()
+    get_bot_db().invalidate_user_profile(user_id)
     return RedirectResponse(url=f"/users?q={user_id}", status_code=303)
 
 @app.post("/cancel_subscription")
-async def cancel_subscription(user_id: int = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def cancel_subscription(user_id: int = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
     await db.commit()
     return RedirectResponse(url=f"/users?q={user_id}", status_code=303)
@@ -2815,7 +2908,7 @@ async def cancel_subscription(user_id: int = Form(...), db: aiosqlite.Connection
 async def add_requests(
     user_id: int = Form(...),
     extra: int = Form(...),
-    db: aiosqlite.Connection = Depends(get_db),
+    db: aiosqlite.Connection = Depends(get_write_db),
     user: str = Depends(get_current_username)
 ):
     if extra <= 0:
@@ -2829,24 +2922,41 @@ async def add_requests(
 
 @app.get("/mailing", response_class=HTMLResponse)
 async def mailing_page(request: Request, user: str = Depends(get_current_username)):
-    return templates.TemplateResponse("mailing.html", {"request": request})
+    jobs = await get_bot_db().list_broadcast_jobs(limit=20)
+    return templates.TemplateResponse("mailing.html", {"request": request, "jobs": jobs})
+
+BALANCE_HISTORY_PAGE_SIZE = 200
+
 
 @app.get("/balance_history", response_class=HTMLResponse)
 async def balance_history_page(
     request: Request, 
+    q: str = "",
+    after: str = "",
     db: aiosqlite.Connection = Depends(get_db), 
     user: str = Depends(get_current_username)
 ):
-    # Получаем историю за последние 30 дней
-    history_query = """
+    # Последние изменения (или одного пользователя) страницами по (created_at, id)
+    conds, args = [], []
+    user_id = as_user_id(q) if q else None
+    if user_id is not None:
+        conds.append("bh.user_id = ?")
+        args.append(user_id)
+    cursor = decode_cursor(after)
+    if cursor:
+        conds.append("(bh.created_at, bh.id) < (?, ?)")
+        args.extend(cursor)
+    where = f"WHERE {' AND '.join(conds)}" if conds else ""
+    history_query = f"""
         SELECT bh.*, u.username 
         FROM balance_history bh
         JOIN users u ON bh.user_id = u.id
-        ORDER BY bh.created_at DESC
-        LIMIT 1000
+        {where}
+        ORDER BY bh.created_at DESC, bh.id DESC
+        LIMIT ?
     """
-    async with db.execute(history_query) as cur:
-        history = await cur.fetchall()
+    async with db.execute(history_query, (*args, BALANCE_HISTORY_PAGE_SIZE + 1)) as cur:
+        history, next_cursor = _keyset_page(await cur.fetchall(), BALANCE_HISTORY_PAGE_SIZE)
 
     # Данные для графиков (пополнения по дням за месяц)
     stats_query = """
@@ -2902,6 +3012,9 @@ async def balance_history_page(
     return templates.TemplateResponse("balance_history.html", {
         "request": request, 
         "history": history,
+        "q": q,
+        "after": after,
+        "next_cursor": next_cursor,
         "chart_labels": chart_labels,
         "chart_values": chart_values,
         "report": report,
@@ -2910,15 +3023,30 @@ async def balance_history_page(
     })
 
 @app.post("/mailing/send")
-async def send_mailing(background_tasks: BackgroundTasks, text: str = Form(...), user: str = Depends(get_current_username)):
-    background_tasks.add_task(run_broadcast, text)
+async def send_mailing(text: str = Form(...), user: str = Depends(get_current_username)):
+    # Рассылку ведёт бот (bot/broadcast.py): задание переживает перезапуск, прогресс виден на странице
+    await get_bot_db().create_broadcast_job("text", {"text": text})
     return RedirectResponse(url="/mailing?status=sent", status_code=303)
 
+
+@app.post("/mailing/{job_id}/cancel")
+async def cancel_mailing(job_id: int, user: str = Depends(get_current_username)):
+    await get_bot_db().cancel_broadcast_job(job_id)
+    return RedirectResponse(url="/mailing", status_code=303)
+
 @app.get("/prompts", response_class=HTMLResponse)
-async def list_prompts(request: Request, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def list_prompts(request: Request, q: str = "", db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
     try:
-        async with db.execute("SELECT m.*, p.text as prompt_text, p.title as prompt_title FROM models m JOIN prompts p ON m.prompt_id = p.id") as cur:
-            models = await cur.fetchall()
+        query = "SELECT m.*, p.text as prompt_text, p.title as prompt_title FROM models m JOIN prompts p ON m.prompt_id = p.id"
+        if q.strip():
+            # Только модели, чей промпт нашёлся по названию или тексту
+            prompt_ids = await get_bot_db().search_prompts(q, limit=200)
+            query += f" WHERE p.id IN ({','.join('?' * len(prompt_ids)) or 'NULL'})"
+            async with db.execute(query, prompt_ids) as cur:
+                models = await cur.fetchall()
+        else:
+            async with db.execute(query) as cur:
+                models = await cur.fetchall()
     except Exception: models = []
     
     categorized_models = {}
@@ -2956,7 +3084,8 @@ async def list_prompts(request: Request, db: aiosqlite.Connection = Depends(get_
         "categorized_models": categorized_models, 
         "categories": CATEGORIES,
         "prompt_placeholders": prompt_placeholders,
-        "cat_prompts": cat_prompts
+        "cat_prompts": cat_prompts,
+        "q": q,
     })
 
 @app.get("/proxy", response_class=HTMLResponse)
@@ -2966,7 +3095,7 @@ async def list_proxies_page(request: Request, db: aiosqlite.Connection = Depends
     return templates.TemplateResponse("proxy.html", {"request": request, "proxies": proxies})
 
 @app.post("/admin/proxy/add")
-async def add_proxy_route(urls: str = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def add_proxy_route(urls: str = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     proxy_list = [u.strip() for u in urls.split("\n") if u.strip()]
     for url in proxy_list:
         # Умная конвертация IP:PORT:USER:PASS -> http://USER:PASS@IP:PORT
@@ -2985,24 +3114,26 @@ async def add_proxy_route(urls: str = Form(...), db: aiosqlite.Connection = Depe
     return RedirectResponse(url="/proxy", status_code=303)
 
 @app.post("/admin/proxy/delete")
-async def delete_proxy_route(id: int = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def delete_proxy_route(id: int = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("DELETE FROM proxies WHERE id = ?", (id,))
     await db.commit()
     return RedirectResponse(url="/proxy", status_code=303)
 
 @app.post("/admin/proxy/toggle")
-async def toggle_proxy_route(id: int = Form(...), active: int = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def toggle_proxy_route(id: int = Form(...), active: int = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("UPDATE proxies SET is_active = ? WHERE id = ?", (active, id))
     await db.commit()
     return RedirectResponse(url="/proxy", status_code=303)
 
 @app.post("/admin/proxy/check")
-async def check_proxy_route(id: int = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
-    async with db.execute("SELECT url FROM proxies WHERE id = ?", (id,)) as cur:
-        row = await cur.fetchone()
-        if not row:
-            return RedirectResponse(url="/proxy", status_code=303)
-        proxy_url = row[0]
+async def check_proxy_route(id: int = Form(...), user: str = Depends(get_current_username)):
+    # Соединения пула берём коротко: проверка прокси идёт до 2×15 с и не должна их держать
+    async with get_db_pool().read() as db:
+        async with db.execute("SELECT url FROM proxies WHERE id = ?", (id,)) as cur:
+            row = await cur.fetchone()
+    if not row:
+        return RedirectResponse(url="/proxy", status_code=303)
+    proxy_url = row[0]
 
     import httpx
     import time
@@ -3035,11 +3166,12 @@ async def check_proxy_route(id: int = Form(...), db: aiosqlite.Connection = Depe
             error_msg = f"{str(e)} ({proto})"
             continue
 
-    await db.execute(
-        "UPDATE proxies SET url = ?, status = ?, error_message = ?, last_check = CURRENT_TIMESTAMP WHERE id = ?",
-        (proxy_url, status, error_msg, id)
-    )
-    await db.commit()
+    async with get_db_pool().write() as db:
+        await db.execute(
+            "UPDATE proxies SET url = ?, status = ?, error_message = ?, last_check = CURRENT_TIMESTAMP WHERE id = ?",
+            (proxy_url, status, error_msg, id)
+        )
+        await db.commit()
     return RedirectResponse(url="/proxy", status_code=303)
 
 @app.post("/prompts/category_prompts")
@@ -3053,7 +3185,7 @@ async def update_category_prompts(
     infographic_other_prompt: str = Form(""),
     own_prompt: str = Form(""),
     own_variant_prompt: str = Form(""),
-    db: aiosqlite.Connection = Depends(get_db),
+    db: aiosqlite.Connection = Depends(get_write_db),
     user: str = Depends(get_current_username)
 ):
     payload = {
@@ -3084,7 +3216,7 @@ async def edit_model_prompt(
     name: str = Form(...), 
     prompt_text: str = Form(...), 
     photo: UploadFile = File(None),
-    db: aiosqlite.Connection = Depends(get_db), 
+    db: aiosqlite.Connection = Depends(get_write_db), 
     user: str = Depends(get_current_username)
 ):
     await db.execute("UPDATE models SET name=? WHERE id=?", (name, model_id))
@@ -3110,7 +3242,7 @@ async def add_full_model(
     prompt_text: str = Form(...),
     cloth: str = Form("all"),
     photo: UploadFile = File(None),
-    db: aiosqlite.Connection = Depends(get_db),
+    db: aiosqlite.Connection = Depends(get_write_db),
     user: str = Depends(get_current_username)
 ):
     await db.execute("INSERT INTO prompts (title, text) VALUES (?, ?)", (f"Prompt for {name}", prompt_text))
@@ -3134,7 +3266,7 @@ async def add_full_model(
     return RedirectResponse(url="/prompts", status_code=303)
 
 @app.get("/models/delete_photo/{model_id}")
-async def delete_model_photo(model_id: int, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def delete_model_photo(model_id: int, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     async with db.execute("SELECT photo_file_id FROM models WHERE id=?", (model_id,)) as cur:
         row = await cur.fetchone()
         if row and row[0]:
@@ -3173,7 +3305,7 @@ async def update_app_settings(
     channel_id: str = Form(None),
     channel_url: str = Form(None),
     support_contact: str = Form(None),
-    db: aiosqlite.Connection = Depends(get_db), 
+    db: aiosqlite.Connection = Depends(get_write_db), 
     user: str = Depends(get_current_username)
 ):
     # Очистка channel_id от лишних символов (пробелы, @ и т.д.)
@@ -3207,7 +3339,7 @@ async def test_channel_settings(
     if not channel_id:
         return JSONResponse({"status": "error", "message": "ID канала не установлен"})
 
-    bot = Bot(token=settings.bot_token)
+    bot = await get_tg_bot()
     try:
         chat = await bot.get_chat(channel_id)
         # Проверяем права бота
@@ -3220,8 +3352,6 @@ async def test_channel_settings(
         })
     except Exception as e:
         return JSONResponse({"status": "error", "message": f"Ошибка: {str(e)}"})
-    finally:
-        await bot.session.close()
 
 @app.get("/api_keys", response_class=HTMLResponse)
 async def list_keys(request: Request, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
@@ -3233,7 +3363,7 @@ async def list_keys(request: Request, db: aiosqlite.Connection = Depends(get_db)
     return templates.TemplateResponse("api_keys.html", {"request": request, "gemini_keys": gemini_keys})
 
 @app.post("/api_keys/add")
-async def add_key(token: str = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def add_key(token: str = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     # Очистка токена от всего лишнего
     token = "".join(token.split())
     
@@ -3253,68 +3383,88 @@ async def add_key(token: str = Form(...), db: aiosqlite.Connection = Depends(get
     
     await db.execute("INSERT INTO api_keys (token) VALUES (?)", (token,))
     await db.commit()
+    get_bot_db().key_pool.invalidate()
     return RedirectResponse(url="/api_keys", status_code=303)
 
 @app.get("/api_keys/delete/{key_id}")
-async def delete_key(key_id: int, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def delete_key(key_id: int, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("DELETE FROM api_keys WHERE id=?", (key_id,))
     await db.commit()
+    get_bot_db().key_pool.invalidate()
     return RedirectResponse(url="/api_keys", status_code=303)
 
-@app.get("/tg_img/{file_id}")
-async def get_telegram_image(file_id: str, user: str = Depends(get_current_username)):
-    """Прокси-роут для отображения фото из Telegram по file_id"""
+# Файлы Telegram по file_id неизменны — браузер может кэшировать их бессрочно
+TG_FILE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+async def _serve_tg_file(request: Request, file_id: str, size: str) -> Response:
+    """Превью (size из THUMB_SIZES) или оригинал файла Telegram с ETag и Cache-Control."""
     if not file_id or file_id == "None" or file_id == "FILE_ID_MOCK":
         return Response(status_code=404)
     if settings.bot_token == "MOCK":
         return Response(status_code=500, content="Bot token not configured")
-    
-    bot = Bot(token=settings.bot_token)
-    try:
-        # Получаем путь к файлу через Telegram API
-        file = await bot.get_file(file_id)
-        file_url = f"https://api.telegram.org/file/bot{settings.bot_token}/{file.file_path}"
-        
-        # Используем httpx для скачивания
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            # Настраиваем прокси для запроса к Telegram, если они есть
-            proxy_url = settings.proxy.as_url() if hasattr(settings, "proxy") else None
-            
-            # Важно: для httpx прокси передаются в конструктор или через mount
-            # Но здесь мы можем просто попробовать без них, если прокси только для Gemini
-            resp = await client.get(file_url, timeout=30)
-            
-            if resp.status_code == 200:
-                return Response(content=resp.content, media_type="image/jpeg")
-            
-            # Если без прокси не вышло и прокси есть, пробуем с ними
-            if proxy_url:
-                async with httpx.AsyncClient(proxy=proxy_url, follow_redirects=True) as p_client:
-                    resp = await p_client.get(file_url, timeout=30)
-                    if resp.status_code == 200:
-                        return Response(content=resp.content, media_type="image/jpeg")
-            
-            print(f"Telegram image {file_id} error: {resp.status_code}")
-            return Response(status_code=resp.status_code)
-            
-    except Exception as e:
-        print(f"Critical error proxying Telegram image {file_id}: {e}")
-        return Response(status_code=500, content=str(e))
-    finally:
-        await bot.session.close()
+    if size not in THUMB_SIZES:
+        size = FULL_SIZE
+    headers = {"ETag": thumbnail_cache.etag(file_id, size), "Cache-Control": TG_FILE_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    result = await thumbnail_cache.get(await get_tg_bot(), file_id, size)
+    if result is None:
+        return Response(status_code=404)
+    content, media_type = result
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+@app.get("/tg_img/{file_id}")
+async def get_telegram_image(request: Request, file_id: str, size: str = FULL_SIZE, user: str = Depends(get_current_username)):
+    """Прокси-роут для отображения фото из Telegram по file_id (size=s|m|l — превью)"""
+    return await _serve_tg_file(request, file_id, size)
+
+HISTORY_PAGE_SIZE = 50
+
 
 @app.get("/history", response_class=HTMLResponse)
-async def list_history(request: Request, q: str = "", db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def list_history(request: Request, q: str = "", after: str = "", db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+    next_cursor = None
+    q = q.strip()
     try:
-        if q:
-            query = "SELECT * FROM generation_history WHERE pid LIKE ? OR user_id LIKE ? ORDER BY created_at DESC LIMIT 50"
-            async with db.execute(query, (f"%{q}%", f"%{q}%")) as cur:
+        user_id = as_user_id(q) if q else None
+        if q and is_pid(q):
+            # PID целиком или его начало — GLOB по уникальному индексу pid
+            async with db.execute(
+                "SELECT * FROM generation_history WHERE pid GLOB ? ORDER BY pid LIMIT 50", (q.upper() + "*",)
+            ) as cur:
                 history = await cur.fetchall()
+        elif q and user_id is None:
+            # Остальное — полнотекстовый поиск по тексту промпта
+            ids = await get_bot_db().search_generation_history(q, limit=50)
+            history = await _fetch_ranked(db, "SELECT * FROM generation_history WHERE id IN ({ids})", ids)
         else:
-            async with db.execute("SELECT * FROM generation_history ORDER BY created_at DESC LIMIT 50") as cur:
-                history = await cur.fetchall()
+            # Лента целиком или одного пользователя: keyset по (created_at, id)
+            conds, args = [], []
+            if user_id is not None:
+                conds.append("user_id = ?")
+                args.append(user_id)
+            cursor = decode_cursor(after)
+            if cursor:
+                conds.append("(created_at, id) < (?, ?)")
+                args.extend(cursor)
+            where = f"WHERE {' AND '.join(conds)}" if conds else ""
+            async with db.execute(
+                f"SELECT * FROM generation_history {where} ORDER BY created_at DESC, id DESC LIMIT ?",
+                (*args, HISTORY_PAGE_SIZE + 1),
+            ) as cur:
+                history, next_cursor = _keyset_page(await cur.fetchall(), HISTORY_PAGE_SIZE)
     except Exception: history = []
-    return templates.TemplateResponse("history.html", {"request": request, "history": history, "q": q})
+    # Место на диске по дням — только на первой странице ленты (сканирование каталогов кэшируется)
+    disk_usage = [] if (q or after) else await asyncio.to_thread(history_store.usage_by_day)
+    return templates.TemplateResponse(
+        "history.html",
+        {
+            "request": request, "history": history, "q": q, "after": after, "next_cursor": next_cursor,
+            "disk_usage": disk_usage, "retention_days": HISTORY_RETENTION_DAYS,
+        },
+    )
 
 @app.get("/payments", response_class=HTMLResponse)
 async def list_payments(request: Request, q: str = "", db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
@@ -3378,7 +3528,7 @@ async def edit_plan(
     desc_ru: str = Form(None),
     desc_en: str = Form(None),
     desc_vi: str = Form(None),
-    db: aiosqlite.Connection = Depends(get_db),
+    db: aiosqlite.Connection = Depends(get_write_db),
     user: str = Depends(get_current_username)
 ):
     try:
@@ -3397,7 +3547,7 @@ async def edit_plan(
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.post("/categories/toggle")
-async def toggle_category(key: str = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def toggle_category(key: str = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     async with db.execute("SELECT value FROM app_settings WHERE key=?", (key,)) as cur:
         row = await cur.fetchone()
         current = row[0] if row else "1"
@@ -3414,7 +3564,7 @@ async def edit_subscription(
     days: int = Form(...), 
     limit: int = Form(...), 
     api_key: str = Form(None),
-    db: aiosqlite.Connection = Depends(get_db), 
+    db: aiosqlite.Connection = Depends(get_write_db), 
     user: str = Depends(get_current_username)
 ):
     try:
@@ -3504,7 +3654,7 @@ async def proxy_page(request: Request, db: aiosqlite.Connection = Depends(get_db
     return templates.TemplateResponse("proxy.html", {"request": request, "current_proxy": current_proxy, "status": status_text})
 
 @app.post("/proxy/edit")
-async def edit_proxy(proxy_url: str = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def edit_proxy(proxy_url: str = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("INSERT INTO app_settings (key, value) VALUES ('bot_proxy', ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (proxy_url,))
     await db.commit()
     return RedirectResponse(url="/proxy", status_code=303)
@@ -3550,7 +3700,7 @@ async def mtproxy_public_link(db: aiosqlite.Connection = Depends(get_db)):
 
 
 @app.get("/api/mtproxy/status")
-async def mtproxy_status(db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def mtproxy_status(db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     """Проверка статуса MTProxy и получение ссылки"""
     import subprocess
     import base64
@@ -3624,7 +3774,7 @@ async def mtproxy_status(db: aiosqlite.Connection = Depends(get_db), user: str =
 
 
 @app.post("/api/mtproxy/generate")
-async def mtproxy_generate(db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def mtproxy_generate(db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     """Генерация нового секрета для MTProxy"""
     import secrets
     import subprocess
@@ -3709,7 +3859,7 @@ async def mtproxy_generate(db: aiosqlite.Connection = Depends(get_db), user: str
 
 
 @app.post("/api/mtproxy/toggle")
-async def mtproxy_toggle(db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def mtproxy_toggle(db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     """Запуск/остановка MTProxy контейнера"""
     import subprocess
     import os
@@ -3790,7 +3940,7 @@ async def mtproxy_toggle(db: aiosqlite.Connection = Depends(get_db), user: str =
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @app.post("/maintenance/toggle")
-async def toggle_maintenance(db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def toggle_maintenance(db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     current = False
     try:
         async with db.execute("SELECT value FROM app_settings WHERE key='maintenance'") as cur:
@@ -3830,7 +3980,7 @@ async def constructor_page(request: Request, db: aiosqlite.Connection = Depends(
     return templates.TemplateResponse("constructor.html", {"request": request, "categories": categories})
 
 @app.post("/constructor/category/add")
-async def admin_add_category(key: str = Form(...), name: str = Form(...), order: int = Form(0), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_add_category(key: str = Form(...), name: str = Form(...), order: int = Form(0), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute(
         "INSERT OR IGNORE INTO categories (key, name_ru, is_active, order_index) VALUES (?, ?, 1, ?)",
         (key, name, order)
@@ -3839,7 +3989,7 @@ async def admin_add_category(key: str = Form(...), name: str = Form(...), order:
     return RedirectResponse("/constructor", status_code=303)
 
 @app.post("/constructor/category/delete/{cat_id}")
-async def admin_delete_category(cat_id: int, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_delete_category(cat_id: int, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     # Удаляем все связанные данные
     await db.execute("DELETE FROM step_options WHERE step_id IN (SELECT id FROM steps WHERE category_id=?)", (cat_id,))
     await db.execute("DELETE FROM steps WHERE category_id=?", (cat_id,))
@@ -3974,7 +4124,7 @@ async def category_languages_page(request: Request, cat_id: int, db: aiosqlite.C
 
 
 @app.post("/constructor/category/{cat_id}/save_translations")
-async def save_category_translations(request: Request, cat_id: int, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def save_category_translations(request: Request, cat_id: int, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     form = await request.form()
     for key, val in form.items():
         value = (val or "").strip()
@@ -3998,7 +4148,7 @@ async def save_category_translations(request: Request, cat_id: int, db: aiosqlit
     return RedirectResponse(f"/constructor/category/{cat_id}/languages", status_code=303)
 
 @app.post("/constructor/category/update/{cat_id}")
-async def admin_update_category(cat_id: int, name: str = Form(...), key: str = Form(...), is_active: int = Form(1), order: int = Form(0), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_update_category(cat_id: int, name: str = Form(...), key: str = Form(...), is_active: int = Form(1), order: int = Form(0), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute(
         "UPDATE categories SET name_ru=?, key=?, is_active=?, order_index=? WHERE id=?",
         (name, key, is_active, order, cat_id)
@@ -4007,7 +4157,7 @@ async def admin_update_category(cat_id: int, name: str = Form(...), key: str = F
     return RedirectResponse(f"/constructor/category/{cat_id}", status_code=303)
 
 @app.post("/constructor/step/add/{cat_id}")
-async def admin_add_step(cat_id: int, step_key: str = Form(...), question: str = Form(...), input_type: str = Form(...), is_optional: int = Form(0), order: int = Form(0), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_add_step(cat_id: int, step_key: str = Form(...), question: str = Form(...), input_type: str = Form(...), is_optional: int = Form(0), order: int = Form(0), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     if order == 0:
         async with db.execute("SELECT MAX(order_index) FROM steps WHERE category_id=?", (cat_id,)) as cur:
             row = await cur.fetchone()
@@ -4021,14 +4171,14 @@ async def admin_add_step(cat_id: int, step_key: str = Form(...), question: str =
     return RedirectResponse(f"/constructor/category/{cat_id}", status_code=303)
 
 @app.post("/constructor/step/delete/{cat_id}/{step_id}")
-async def admin_delete_step(cat_id: int, step_id: int, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_delete_step(cat_id: int, step_id: int, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("DELETE FROM step_options WHERE step_id=?", (step_id,))
     await db.execute("DELETE FROM steps WHERE id=?", (step_id,))
     await db.commit()
     return RedirectResponse(f"/constructor/category/{cat_id}", status_code=303)
 
 @app.post("/constructor/option/add/{cat_id}/{step_id}")
-async def admin_add_option(cat_id: int, step_id: int, text: str = Form(...), value: str = Form(...), order: int = Form(0), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_add_option(cat_id: int, step_id: int, text: str = Form(...), value: str = Form(...), order: int = Form(0), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute(
         "INSERT INTO step_options (step_id, option_text, option_value, order_index) VALUES (?, ?, ?, ?)",
         (step_id, text, value, order)
@@ -4037,13 +4187,13 @@ async def admin_add_option(cat_id: int, step_id: int, text: str = Form(...), val
     return RedirectResponse(f"/constructor/category/{cat_id}", status_code=303)
 
 @app.post("/constructor/option/delete/{cat_id}/{opt_id}")
-async def admin_delete_option(cat_id: int, opt_id: int, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_delete_option(cat_id: int, opt_id: int, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("DELETE FROM step_options WHERE id=?", (opt_id,))
     await db.commit()
     return RedirectResponse(f"/constructor/category/{cat_id}", status_code=303)
 
 @app.post("/constructor/steps/reorder/{cat_id}")
-async def admin_reorder_steps(cat_id: int, request: Request, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_reorder_steps(cat_id: int, request: Request, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     data = await request.json()
     step_ids = data.get("step_ids", [])
     
@@ -4055,7 +4205,7 @@ async def admin_reorder_steps(cat_id: int, request: Request, db: aiosqlite.Conne
     return JSONResponse({"status": "ok"})
 
 @app.post("/constructor/category/{cat_id}/save_all")
-async def admin_save_all_steps(cat_id: int, request: Request, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_save_all_steps(cat_id: int, request: Request, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     try:
         data = await request.json()
         print(f"Starting save_all for category {cat_id}. Data: {len(data.get('steps', []))} steps.")
@@ -4159,7 +4309,7 @@ async def admin_save_all_steps(cat_id: int, request: Request, db: aiosqlite.Conn
         return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
 
 @app.post("/constructor/library/step/add")
-async def admin_add_library_step(step_key: str = Form(...), question: str = Form(...), input_type: str = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_add_library_step(step_key: str = Form(...), question: str = Form(...), input_type: str = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute(
         "INSERT INTO library_steps (step_key, question_text, input_type) VALUES (?, ?, ?)",
         (step_key, question, input_type)
@@ -4168,7 +4318,7 @@ async def admin_add_library_step(step_key: str = Form(...), question: str = Form
     return RedirectResponse(request.headers.get("referer", "/constructor"), status_code=303)
 
 @app.post("/constructor/library/step/update/{step_id}")
-async def admin_update_library_step(step_id: int, request: Request, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_update_library_step(step_id: int, request: Request, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     data = await request.json()
     step_data = data.get("step", {})
     options = data.get("options", [])
@@ -4220,14 +4370,14 @@ async def admin_update_library_step(step_id: int, request: Request, db: aiosqlit
     return JSONResponse({"status": "ok"})
 
 @app.post("/constructor/library/step/delete/{step_id}")
-async def admin_delete_library_step(step_id: int, request: Request, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_delete_library_step(step_id: int, request: Request, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("DELETE FROM library_step_options WHERE step_id=?", (step_id,))
     await db.execute("DELETE FROM library_steps WHERE id=?", (step_id,))
     await db.commit()
     return RedirectResponse(request.headers.get("referer", "/constructor"), status_code=303)
 
 @app.post("/constructor/library/button/add")
-async def admin_add_library_button(request: Request, text: str = Form(...), text_en: str = Form(""), text_vi: str = Form(""), value: str = Form(...), category: str = Form("Системные"), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_add_library_button(request: Request, text: str = Form(...), text_en: str = Form(""), text_vi: str = Form(""), value: str = Form(...), category: str = Form("Системные"), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     # Находим или создаем категорию кнопок
     async with db.execute("SELECT id FROM button_categories WHERE name=?", (category,)) as cur:
         row = await cur.fetchone()
@@ -4246,13 +4396,13 @@ async def admin_add_library_button(request: Request, text: str = Form(...), text
     return RedirectResponse(request.headers.get("referer", "/constructor"), status_code=303)
 
 @app.post("/constructor/library/button/delete/{btn_id}")
-async def admin_delete_library_button(request: Request, btn_id: int, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_delete_library_button(request: Request, btn_id: int, db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("DELETE FROM library_options WHERE id=?", (btn_id,))
     await db.commit()
     return RedirectResponse(request.headers.get("referer", "/constructor"), status_code=303)
 
 @app.post("/constructor/library/category/add")
-async def admin_add_library_category(request: Request, name: str = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def admin_add_library_category(request: Request, name: str = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("INSERT OR IGNORE INTO button_categories (name) VALUES (?)", (name,))
     await db.commit()
     return RedirectResponse(request.headers.get("referer", "/constructor"), status_code=303)
@@ -4260,7 +4410,7 @@ async def admin_add_library_category(request: Request, name: str = Form(...), db
 # --- Техподдержка ---
 
 @app.get("/support", response_class=HTMLResponse)
-async def get_support(request: Request, user_id: int = None, db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def get_support(request: Request, user_id: int = None, q: str = "", db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
     # Список пользователей, писавших в поддержку
     async with db.execute("""
         SELECT u.id, u.username, u.first_name, 
@@ -4275,56 +4425,45 @@ async def get_support(request: Request, user_id: int = None, db: aiosqlite.Conne
     messages = []
     current_user = None
     if user_id:
-        # Помечаем как прочитанные
-        await db.execute("UPDATE support_messages SET is_read = 1 WHERE user_id = ? AND is_admin = 0", (user_id,))
-        await db.commit()
-        
+        # Помечаем как прочитанные — коротко через писателя и только если есть что помечать
+        if any(row["id"] == user_id and row["unread_count"] for row in support_users):
+            async with get_db_pool().write() as wdb:
+                await wdb.execute("UPDATE support_messages SET is_read = 1 WHERE user_id = ? AND is_admin = 0", (user_id,))
+                await wdb.commit()
+
         async with db.execute("SELECT message_text, is_admin, created_at, file_id, file_type FROM support_messages WHERE user_id = ? ORDER BY created_at ASC", (user_id,)) as cur:
             messages = await cur.fetchall()
         
         async with db.execute("SELECT id, username, first_name FROM users WHERE id = ?", (user_id,)) as cur:
             current_user = await cur.fetchone()
 
+    # Поиск по тексту всех обращений
+    found = await get_bot_db().search_support_messages(q, limit=50) if q.strip() else []
+
     return templates.TemplateResponse("support.html", {
         "request": request, 
         "support_users": support_users, 
         "messages": messages, 
-        "current_user": current_user
+        "current_user": current_user,
+        "q": q,
+        "found": found,
     })
 
 @app.get("/support/file/{file_id}")
-async def proxy_telegram_file(file_id: str, user: str = Depends(get_current_username)):
+async def proxy_telegram_file(request: Request, file_id: str, size: str = FULL_SIZE, user: str = Depends(get_current_username)):
     """Проксирует файл из Telegram для отображения в админке"""
-    try:
-        settings = load_settings()
-        async with httpx.AsyncClient() as client:
-            # 1. Получаем путь к файлу
-            get_file_url = f"https://api.telegram.org/bot{settings.bot_token}/getFile?file_id={file_id}"
-            resp = await client.get(get_file_url)
-            file_data = resp.json()
-            if not file_data.get("ok"):
-                return Response(status_code=404)
-            
-            file_path = file_data["result"]["file_path"]
-            # 2. Скачиваем сам файл
-            download_url = f"https://api.telegram.org/file/bot{settings.bot_token}/{file_path}"
-            file_resp = await client.get(download_url)
-            
-            return Response(content=file_resp.content, media_type=file_resp.headers.get("content-type"))
-    except Exception as e:
-        print(f"Error proxying file {file_id}: {e}")
-        return Response(status_code=500)
+    return await _serve_tg_file(request, file_id, size)
 
 @app.post("/support/send")
 async def send_support_reply(
     user_id: int = Form(...),
     message_text: str = Form(None),
     file: UploadFile = File(None),
-    db: aiosqlite.Connection = Depends(get_db),
     user: str = Depends(get_current_username)
 ):
+    # Писатель берём только на INSERT: загрузка в Telegram не должна держать остальные записи админки
     try:
-        settings = load_settings()
+        settings = get_settings()
         file_id = None
         file_type = 'text'
         
@@ -4367,7 +4506,8 @@ async def send_support_reply(
                 resp = await client.post(url, json=payload)
                 result = resp.json()
 
-            # Сохраняем в БД
+        # Сохраняем в БД
+        async with get_db_pool().write() as db:
             await db.execute(
                 "INSERT INTO support_messages (user_id, message_text, file_id, file_type, is_admin, is_read) VALUES (?, ?, ?, ?, 1, 1)",
                 (user_id, message_text, file_id, file_type)
@@ -4380,7 +4520,7 @@ async def send_support_reply(
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.post("/support/mark_read")
-async def mark_read(user_id: int = Form(...), db: aiosqlite.Connection = Depends(get_db), user: str = Depends(get_current_username)):
+async def mark_read(user_id: int = Form(...), db: aiosqlite.Connection = Depends(get_write_db), user: str = Depends(get_current_username)):
     await db.execute("UPDATE support_messages SET is_read = 1 WHERE user_id = ? AND is_admin = 0", (user_id,))
     await db.commit()
     return {"status": "ok"}
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import logging
+import os
+
+from aiogram import Bot
+
+from bot.concurrency import register
+from bot.db import Database
+from bot.file_cache import TelegramFileCache, telegram_file_cache
+from bot.history_store import HistoryStore, history_store, utc_day
+
+logger = logging.getLogger(__name__)
+
+class ArchiveJob:
+    """Генерация, которую нужно положить в историю (data/history + generation_history).
+
+    inputs — байты входных фото в том же порядке, что input_photos (None, если
+    фото не скачалось). Результат — либо байты (result_bytes), либо временный
+    файл генератора (result_path), который переносится в историю.
+    """
+
+    __slots__ = (
+        "db", "bot", "user_id", "category", "params", "input_photos", "inputs",
+        "result_photo_id", "result_bytes", "result_path", "prompt", "pid", "day", "attempts",
+    )
+
+    def __init__(
+        self,
+        db: Database,
+        bot: Bot,
+        user_id: int,
+        category: str,
+        params: str,
+        input_photos: list[str],
+        inputs: list[bytes | None],
+        result_photo_id: str,
+        result_bytes: bytes | None = None,
+        result_path: str | None = None,
+        prompt: str | None = None,
+    ) -> None:
+        self.db = db
+        self.bot = bot
+        self.user_id = user_id
+        self.category = category
+        self.params = params
+        self.input_photos = input_photos
+        self.inputs = inputs
+        self.result_photo_id = result_photo_id
+        self.result_bytes = result_bytes
+        self.result_path = result_path
+        self.prompt = prompt
+        self.pid: str | None = None
+        self.day: str | None = None
+        self.attempts = 0
+
+
+class HistoryArchiver:
+    """Фоновая запись результатов генераций в историю.
+
+    Хендлер отправляет пользователю документ и ставит ArchiveJob в очередь —
+    файлы пишутся в каталог дня HistoryStore из уже имеющихся в памяти байтов
+    (в потоке, без запросов к Telegram), затем добавляется строка generation_history. Очередь ограничена
+    (max_queue): если воркеры не успевают, submit() ждёт свободного места.
+    Неудачная запись повторяется max_attempts раз с растущей паузой; PID
+    и день задания сохраняются между попытками, поэтому файлы просто перезаписываются.
+    Telegram (через кэш файлов) используется, только если байтов нет.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        max_queue: int = 200,
+        max_attempts: int = 5,
+        retry_delay: float = 1.0,
+        file_cache: TelegramFileCache = telegram_file_cache,
+        store: HistoryStore = history_store,
+    ) -> None:
+        self.workers = max(1, int(workers))
+        self.max_queue = max(1, int(max_queue))
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_delay = retry_delay
+        self.file_cache = file_cache
+        self.store = store
+        self._queue: asyncio.Queue[ArchiveJob] | None = None
+        self._tasks: list[asyncio.Task] = []
+        self.archived = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _ensure_workers(self) -> asyncio.Queue[ArchiveJob]:
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_queue)
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+        return self._queue
+
+    async def submit(self, job: ArchiveJob) -> None:
+        """Ставит задание в очередь; при полной очереди ждёт места."""
+        await self._ensure_workers().put(job)
+
+    async def close(self, timeout: float = 30.0) -> None:
+        """Дописывает очередь (не дольше timeout) и останавливает воркеров."""
+        if self._queue is not None and self._tasks:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"[archive] {self._queue.qsize()} jobs not archived on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    async def _worker(self) -> None:
+        queue = self._queue
+        while True:
+            job = await queue.get()
+            try:
+                await self._process(job)
+            finally:
+                queue.task_done()
+
+    async def _process(self, job: ArchiveJob) -> None:
+        while True:
+            job.attempts += 1
+            try:
+                await self._archive(job)
+                self.archived += 1
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if job.attempts >= self.max_attempts:
+                    self.failed += 1
+                    logger.error(f"[archive] {job.pid or job.result_photo_id} failed after {job.attempts} attempts: {e}")
+                    self._discard_temp(job)
+                    return
+                self.retried += 1
+                delay = self.retry_delay * 2 ** (job.attempts - 1)
+                logger.warning(f"[archive] {job.pid or job.result_photo_id} attempt {job.attempts} failed: {e}; retry in {delay:.0f}s")
+                await asyncio.sleep(delay)
+
+    async def _archive(self, job: ArchiveJob) -> None:
+        if job.pid is None:
+            job.pid = await job.db.generate_pid()
+            job.day = utc_day()
+        pid, store = job.pid, self.store
+        db_result_path = store.result_path(pid, job.day)
+        await self._store_result(job, db_result_path)
+
+        input_paths = []
+        for i, file_id in enumerate(job.input_photos):
+            if not file_id:
+                continue
+            data = job.inputs[i] if i < len(job.inputs) else None
+            if data is None:
+                data = await self.file_cache.get_bytes(job.bot, file_id)
+                if data is None:
+                    logger.warning(f"[archive] input {file_id} of {pid} unavailable")
+                    continue
+            db_input_path = store.input_path(pid, i, job.day)
+            await asyncio.to_thread(store.write, db_input_path, data)
+            input_paths.append(db_input_path)
+
+        await job.db.add_generation_history(
+            pid=pid,
+            user_id=job.user_id,
+            category=job.category,
+            params=job.params,
+            input_photos=json.dumps(job.input_photos),
+            result_photo_id=job.result_photo_id,
+            input_paths=json.dumps(input_paths),
+            result_path=db_result_path,
+            prompt=job.prompt,
+        )
+        # Байты больше не нужны, пока задание ещё может где-то держаться
+        job.inputs = []
+        job.result_bytes = None
+
+    async def _store_result(self, job: ArchiveJob, dest: str) -> None:
+        store = self.store
+        if job.result_bytes is not None:
+            await asyncio.to_thread(store.write, dest, job.result_bytes)
+            self._discard_temp(job)
+            return
+        if job.result_path:
+            if os.path.exists(job.result_path):
+                await asyncio.to_thread(store.move, job.result_path, dest)
+                job.result_path = None
+                return
+            logger.warning(f"[archive] result file {job.result_path} is gone, fetching {job.result_photo_id}")
+            job.result_path = None
+        elif store.exists(dest):
+            # Перенесён на прошлой попытке
+            return
+        data = await self.file_cache.get_bytes(job.bot, job.result_photo_id)
+        if data is None:
+            raise RuntimeError(f"result {job.result_photo_id} unavailable")
+        await asyncio.to_thread(store.write, dest, data)
+
+    @staticmethod
+    def _discard_temp(job: ArchiveJob) -> None:
+        if job.result_path:
+            try:
+                os.remove(job.result_path)
+            except OSError:
+                pass
+            job.result_path = None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "archived": self.archived,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+history_archiver = register(
+    "archive",
+    HistoryArchiver(
+        workers=_env_int("ARCHIVE_WORKERS", 2),
+        max_queue=_env_int("ARCHIVE_QUEUE_SIZE", 200),
+    ),
+)
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+
+from bot.concurrency import register
+from bot.db import Database
+from bot.outbound import bulk_sends
+from bot.strings import get_string
+
+logger = logging.getLogger(__name__)
+
+KIND_TEXT = "text"
+KIND_MEDIA = "media"
+KIND_COPY = "copy"
+
+
+class BroadcastEngine:
+    """Рассылки как задания в БД (broadcast_jobs), которые переживают перезапуск.
+
+    Получатели читаются страницами по users.id (keyset), отправляют concurrency
+    задач в полосе рассылок — темп задаёт OutboundLimiter. Результаты пишутся
+    в broadcast_deliveries пачками (checkpoint_every) вместе со счётчиками и
+    heartbeat; после падения задание с устаревшим heartbeat подхватывается и
+    продолжается с непройденных пользователей. Заблокировавшие бота помечаются
+    (users.bot_blocked) и в следующие рассылки не попадают.
+
+    Задания создаёт кто угодно (админ-команда, веб-админка) — движок находит их
+    опросом раз в poll_interval или сразу после wake().
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        bot: Bot,
+        concurrency: int = 10,
+        page_size: int = 500,
+        checkpoint_every: int = 50,
+        poll_interval: float = 5.0,
+        stale_after: float = 120.0,
+    ) -> None:
+        self.db = db
+        self.bot = bot
+        self.concurrency = max(1, int(concurrency))
+        self.page_size = max(1, int(page_size))
+        self.checkpoint_every = max(1, int(checkpoint_every))
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._current: int | None = None
+        self.jobs_done = 0
+        self.sent = 0
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._poll())
+
+    def wake(self) -> None:
+        """Проверить задания сейчас, не дожидаясь опроса."""
+        self._wake.set()
+
+    async def close(self) -> None:
+        """Останавливает рассылку; незавершённое задание возвращается в очередь."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _poll(self) -> None:
+        while True:
+            try:
+                now = time.time()
+                for job_id in await self.db.list_claimable_broadcast_jobs(now - self.stale_after):
+                    if await self.db.claim_broadcast_job(job_id, self.owner, now, now - self.stale_after):
+                        await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[broadcast] poll failed: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _run(self, job_id: int) -> None:
+        job = await self.db.get_broadcast_job(job_id)
+        if job is None:
+            return
+        send = self._sender(job["kind"], job["payload"])
+        self._current = job_id
+        logger.info(f"[broadcast] job {job_id} started from user {job['last_user_id']}")
+        results: list[tuple[int, str, str | None]] = []
+        status: str | None = "running"
+
+        async def flush(last_user_id: int | None = None) -> None:
+            nonlocal status
+            batch = results[:]
+            results.clear()
+            status = await self.db.checkpoint_broadcast(job_id, self.owner, time.time(), batch, last_user_id)
+
+        try:
+            cursor = int(job["last_user_id"] or 0)
+            while status == "running":
+                page = await self.db.list_broadcast_recipients(job_id, cursor, self.page_size)
+                if not page:
+                    break
+                pending = iter(page)
+
+                async def worker() -> None:
+                    for uid in pending:
+                        if status != "running":
+                            return
+                        try:
+                            await send(uid)
+                            results.append((uid, "delivered", None))
+                        except TelegramForbiddenError:
+                            results.append((uid, "blocked", None))
+                        except Exception as e:
+                            results.append((uid, "failed", str(e)[:200]))
+                        self.sent += 1
+                        if len(results) >= self.checkpoint_every:
+                            await flush()
+
+                with bulk_sends():
+                    await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+                cursor = page[-1]
+                await flush(cursor)
+        except asyncio.CancelledError:
+            # Остановка процесса: сохраняем сделанное и отдаём задание
+            await asyncio.shield(self._release(job_id, results))
+            raise
+        finally:
+            self._current = None
+
+        if status == "running":
+            await self.db.finish_broadcast_job(job_id, self.owner, "done")
+            self.jobs_done += 1
+        job = await self.db.get_broadcast_job(job_id)
+        logger.info(
+            f"[broadcast] job {job_id} {job['status']}: delivered={job['delivered']} "
+            f"blocked={job['blocked']} failed={job['failed']}"
+        )
+        await self._notify(job)
+
+    async def _release(self, job_id: int, results: list[tuple[int, str, str | None]]) -> None:
+        try:
+            await self.db.checkpoint_broadcast(job_id, self.owner, time.time(), results[:])
+            await self.db.release_broadcast_job(job_id, self.owner)
+        except Exception as e:
+            logger.error(f"[broadcast] release of job {job_id} failed: {e}")
+
+    def _sender(self, kind: str, payload: dict):
+        bot = self.bot
+        text = payload.get("text") or ""
+        if kind == KIND_COPY:
+            from_chat_id, message_id = payload["from_chat_id"], payload["message_id"]
+            return lambda uid: bot.copy_message(chat_id=uid, from_chat_id=from_chat_id, message_id=message_id)
+        if kind == KIND_MEDIA and payload.get("video"):
+            return lambda uid: bot.send_video(chat_id=uid, video=payload["video"], caption=text)
+        if kind == KIND_MEDIA and payload.get("photo"):
+            return lambda uid: bot.send_photo(chat_id=uid, photo=payload["photo"], caption=text)
+        return lambda uid: bot.send_message(chat_id=uid, text=text)
+
+    async def _notify(self, job: dict) -> None:
+        admin_id = job.get("created_by")
+        if not admin_id:
+            return
+        try:
+            lang = await self.db.get_user_language(admin_id)
+            key = "admin_broadcast_done" if job["status"] == "done" else "admin_broadcast_cancelled"
+            counts = {k: job[k] for k in ("delivered", "blocked", "failed")}
+            await self.bot.send_message(
+                admin_id,
+                get_string(key, lang, id=job["id"]) + "\n" + get_string("admin_broadcast_counts", lang, **counts),
+            )
+        except Exception as e:
+            logger.debug(f"[broadcast] notify {admin_id} failed: {e}")
+
+    def stats(self) -> dict[str, int]:
+        return {"current_job": self._current or 0, "jobs_done": self.jobs_done, "sent": self.sent}
+
+
+def create_engine(db: Database, bot: Bot) -> BroadcastEngine:
+    return register("broadcast", BroadcastEngine(db, bot))
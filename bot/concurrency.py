@@ -0,0 +1,113 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class BoundedDedup:
+    """Множество «уже обработано» с ограничением по размеру и времени жизни ключа.
+
+    Порядок добавления хранится в кольцевом буфере (deque), проверка — по dict,
+    поэтому и вытеснение самых старых, и проверка стоят O(1).
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 600.0) -> None:
+        self.max_size = max(1, int(max_size))
+        self.ttl = float(ttl)
+        # key -> момент добавления
+        self._seen: dict[Hashable, float] = {}
+        self._order: deque[tuple[float, Hashable]] = deque()
+        self.hits = 0
+        self.evicted = 0
+
+    def _expire(self, now: float) -> None:
+        order, seen = self._order, self._seen
+        while order and (len(seen) > self.max_size or now - order[0][0] >= self.ttl):
+            ts, key = order.popleft()
+            # Ключ могли добавить заново после истечения — в буфере он тогда встречается дважды
+            if seen.get(key) == ts:
+                del seen[key]
+                self.evicted += 1
+
+    def __contains__(self, key: Hashable) -> bool:
+        self._expire(time.monotonic())
+        if key in self._seen:
+            self.hits += 1
+            return True
+        return False
+
+    def add(self, key: Hashable) -> bool:
+        """Добавляет ключ. False, если он уже был (дубликат)."""
+        now = time.monotonic()
+        self._expire(now)
+        if key in self._seen:
+            self.hits += 1
+            return False
+        self._seen[key] = now
+        self._order.append((now, key))
+        self._expire(now)
+        return True
+
+    def __len__(self) -> int:
+        self._expire(time.monotonic())
+        return len(self._seen)
+
+    def stats(self) -> dict[str, int]:
+        self._expire(time.monotonic())
+        return {"size": len(self._seen), "max_size": self.max_size, "hits": self.hits, "evicted": self.evicted}
+
+
+class LockRegistry:
+    """asyncio.Lock по ключу (например, user_id), который живёт, пока его держат или ждут.
+
+    Счётчик ссылок вместо defaultdict(asyncio.Lock): когда последний пользователь
+    замка выходит, запись удаляется, и словарь не растёт с числом пользователей.
+    """
+
+    def __init__(self) -> None:
+        # key -> [lock, число держащих и ожидающих]
+        self._locks: dict[Hashable, list] = {}
+        self.acquired = 0
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                self.acquired += 1
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self._locks.get(key) is entry:
+                del self._locks[key]
+
+    def locked(self, key: Hashable) -> bool:
+        entry = self._locks.get(key)
+        return entry is not None and entry[0].locked()
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def stats(self) -> dict[str, int]:
+        held = sum(1 for lock, _ in self._locks.values() if lock.locked())
+        refs = sum(refs for _, refs in self._locks.values())
+        return {"keys": len(self._locks), "held": held, "waiting": refs - held, "acquired": self.acquired}
+
+
+# Именованные структуры процесса для метрик (статистика админки, /stats воркера)
+_registry: dict[str, object] = {}
+
+
+def register(name: str, obj: T) -> T:
+    _registry[name] = obj
+    return obj
+
+
+def snapshot() -> dict[str, dict[str, int]]:
+    return {name: obj.stats() for name, obj in _registry.items()}
@@ -1,10 +1,13 @@
+import logging
 import os
 from dataclasses import dataclass
 from typing import List
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
 
-@dataclass
+
+@dataclass(frozen=True)
 class ProxyConfig:
     scheme: str | None
     host: str | None
@@ -20,18 +23,28 @@ class ProxyConfig:
         return f"{self.scheme}://{self.host}:{self.port}"
 
 
-@dataclass
+@dataclass(frozen=True)
 class Settings:
     bot_token: str
     old_bot_token: str | None
     gemini_api_key: str
     database_url: str
     proxy: ProxyConfig
-    admin_ids: list[int]
+    admin_ids: frozenset[int]
+    # Webhook-режим (bot/webhook.py): включается, если задан webhook_url
+    webhook_url: str | None = None
+    webhook_path: str = "/webhook"
+    webhook_secret: str | None = None
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    bot_workers: int = 1
+    worker_port_base: int = 8100
+    # Свой Bot API сервер (telegram-bot-api) вместо api.telegram.org
+    telegram_api_url: str | None = None
 
 
-def load_settings() -> Settings:
-    load_dotenv()
+def load_settings(override: bool = False) -> Settings:
+    load_dotenv(override=override)
 
     bot_token = os.getenv("BOT_TOKEN", "").strip()
     old_bot_token = os.getenv("OLD_BOT_TOKEN", "").strip() or None
@@ -81,6 +94,16 @@ def load_settings() -> Settings:
             except ValueError:
                 continue
 
+    def _int_env(name: str, default: int) -> int:
+        try:
+            return int(os.getenv(name, "").strip() or default)
+        except ValueError:
+            return default
+
+    webhook_path = os.getenv("WEBHOOK_PATH", "").strip() or "/webhook"
+    if not webhook_path.startswith("/"):
+        webhook_path = "/" + webhook_path
+
     if not bot_token:
         raise RuntimeError("BOT_TOKEN is required in .env")
     if not gemini_api_key:
@@ -92,7 +115,39 @@ def load_settings() -> Settings:
         gemini_api_key=gemini_api_key,
         database_url=database_url,
         proxy=proxy,
-        admin_ids=admin_ids,
+        admin_ids=frozenset(admin_ids),
+        webhook_url=os.getenv("WEBHOOK_URL", "").strip().rstrip("/") or None,
+        webhook_path=webhook_path,
+        webhook_secret=os.getenv("WEBHOOK_SECRET", "").strip() or None,
+        webhook_host=os.getenv("WEBHOOK_HOST", "").strip() or "0.0.0.0",
+        webhook_port=_int_env("WEBHOOK_PORT", 8080),
+        bot_workers=max(1, _int_env("BOT_WORKERS", 1)),
+        worker_port_base=_int_env("WEBHOOK_WORKER_PORT_BASE", 8100),
+        telegram_api_url=os.getenv("TELEGRAM_API_URL", "").strip().rstrip("/") or None,
     )
 
 
+# Настройки читаются один раз за процесс; load_settings() парсит .env заново при каждом вызове
+_settings: Settings | None = None
+
+
+def get_settings() -> Settings:
+    global _settings
+    if _settings is None:
+        _settings = load_settings()
+    return _settings
+
+
+def reload_settings() -> Settings:
+    """Перечитывает .env (например, по SIGHUP). При ошибке остаются прежние настройки."""
+    global _settings
+    try:
+        _settings = load_settings(override=True)
+        logger.info("Settings reloaded")
+    except Exception as e:
+        logger.error(f"Settings reload failed, keeping previous: {e}")
+        if _settings is None:
+            raise
+    return _settings
+
+
@@ -1,6 +1,14 @@
-import aiosqlite
+from collections import OrderedDict
 from typing import Optional
+import asyncio
+import json
 import logging
+import re
+import sqlite3
+import time
+
+from bot.db_pool import SQLitePool
+from bot.key_pool import KeyPool
 
 logger = logging.getLogger(__name__)
 
@@ -155,6 +163,169 @@ CREATE TABLE IF NOT EXISTS api_usage_log (
 );
 """
 
+CREATE_API_USAGE_LOG_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_api_usage_log_key_ts ON api_usage_log(key_id, timestamp);
+"""
+
+# Агрегаты api_usage_log по ключам (UTC): bucket='m' — минута 'YYYY-MM-DD HH:MM', 'd' — день 'YYYY-MM-DD'
+CREATE_API_USAGE_ROLLUP_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS api_usage_rollup (
+    key_id INTEGER NOT NULL,
+    bucket TEXT NOT NULL,
+    bucket_start TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, bucket_start, key_id)
+) WITHOUT ROWID;
+"""
+
+# Сколько хранить сырые строки api_usage_log и минутные агрегаты (дневные храним всегда)
+API_USAGE_LOG_RETENTION_DAYS = 7
+API_USAGE_MINUTE_RETENTION_HOURS = 48
+
+# Состояния FSM (см. bot/fsm_storage.py); data — JSON
+CREATE_FSM_STORAGE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS fsm_storage (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL DEFAULT '{}',
+    updated_at REAL NOT NULL
+);
+"""
+
+CREATE_FSM_STORAGE_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated_at ON fsm_storage(updated_at);
+"""
+
+# Списки админки «новые сверху» с keyset-пагинацией (см. bot/pagination.py)
+CREATE_LISTING_INDEXES_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_generation_history_created_at ON generation_history(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_generation_history_user_created ON generation_history(user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_balance_history_created_at ON balance_history(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_balance_history_user_created ON balance_history(user_id, created_at)",
+)
+
+# Полнотекстовый поиск админки (FTS5), см. Database.ensure_search_index.
+# unicode61 без диакритики — для ru/en/vi; prefix — быстрые запросы «нач*» от 2-3 символов.
+_FTS_OPTIONS = "tokenize='unicode61 remove_diacritics 2', prefix='2 3'"
+
+# Пользователи: своя таблица (rowid = users.id), email берётся из site_users (id = -users.id)
+CREATE_USERS_FTS_SQL = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(username, first_name, last_name, email, {_FTS_OPTIONS});
+"""
+
+# Остальные — external content: в индексе только токены, текст читается из самой таблицы
+CREATE_SUPPORT_FTS_SQL = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS support_fts USING fts5(
+    message_text, content='support_messages', content_rowid='id', {_FTS_OPTIONS}
+);
+"""
+
+CREATE_PROMPTS_FTS_SQL = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS prompts_fts USING fts5(title, text, content='prompts', content_rowid='id', {_FTS_OPTIONS});
+"""
+
+CREATE_HISTORY_FTS_SQL = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS generation_history_fts USING fts5(
+    prompt, content='generation_history', content_rowid='id', {_FTS_OPTIONS}
+);
+"""
+
+
+def _content_fts_triggers(table: str, fts: str, columns: tuple[str, ...]) -> tuple[str, ...]:
+    cols = ", ".join(columns)
+    new = ", ".join(f"new.{c}" for c in columns)
+    old = ", ".join(f"old.{c}" for c in columns)
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old}); "
+        f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new}); END",
+    )
+
+
+# (таблица, FTS-таблица, колонки, CREATE) — индексы по содержимому таблиц
+_CONTENT_FTS = (
+    ("support_messages", "support_fts", ("message_text",), CREATE_SUPPORT_FTS_SQL),
+    ("prompts", "prompts_fts", ("title", "text"), CREATE_PROMPTS_FTS_SQL),
+    ("generation_history", "generation_history_fts", ("prompt",), CREATE_HISTORY_FTS_SQL),
+)
+
+USERS_FTS_TRIGGERS_SQL = (
+    "CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, first_name, last_name ON users BEGIN "
+    "UPDATE users_fts SET username = new.username, first_name = new.first_name, last_name = new.last_name "
+    "WHERE rowid = new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN "
+    "DELETE FROM users_fts WHERE rowid = old.id; END",
+)
+
+# Вставка зависит от того, есть ли site_users (её создаёт веб-админка) — пересоздаётся в ensure_search_index
+USERS_FTS_INSERT_TRIGGER_SQL = (
+    "CREATE TRIGGER users_fts_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, username, first_name, last_name, email) "
+    "VALUES (new.id, new.username, new.first_name, new.last_name, {email}); END"
+)
+
+SITE_USERS_FTS_TRIGGERS_SQL = (
+    "CREATE TRIGGER IF NOT EXISTS site_users_fts_ai AFTER INSERT ON site_users BEGIN "
+    "UPDATE users_fts SET email = new.email WHERE rowid = -new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS site_users_fts_au AFTER UPDATE OF email ON site_users BEGIN "
+    "UPDATE users_fts SET email = new.email WHERE rowid = -new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS site_users_fts_ad AFTER DELETE ON site_users BEGIN "
+    "UPDATE users_fts SET email = NULL WHERE rowid = -old.id; END",
+)
+
+# Больше совпадений — не ранжируем (см. Database._search)
+FTS_RANK_LIMIT = 2000
+
+_FTS_TOKEN_RE = re.compile(r"[^\W_]+")
+
+
+def _fts_query(text: str) -> str | None:
+    """Пользовательский ввод -> запрос FTS5: все слова, каждое как префикс ("ив"* "петр"*)."""
+    tokens = _FTS_TOKEN_RE.findall(text or "")[:8]
+    if not tokens:
+        return None
+    return " ".join(f'"{t}"*' for t in tokens)
+
+
+# Рассылки (см. bot/broadcast.py): задание, курсор по users.id и счётчики
+CREATE_BROADCAST_JOBS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,               -- text | media | copy
+    payload TEXT NOT NULL,            -- JSON
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending | running | done | cancelled
+    created_by INTEGER,
+    owner TEXT,                       -- процесс, который ведёт рассылку
+    heartbeat REAL,
+    last_user_id INTEGER NOT NULL DEFAULT 0,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+"""
+
+_BROADCAST_JOB_COLUMNS = (
+    "id", "kind", "payload", "status", "created_by", "owner", "heartbeat", "last_user_id",
+    "delivered", "blocked", "failed", "created_at", "finished_at",
+)
+
+CREATE_BROADCAST_DELIVERIES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    job_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL,             -- delivered | blocked | failed
+    error TEXT,
+    PRIMARY KEY (job_id, user_id)
+) WITHOUT ROWID;
+"""
+
 CREATE_API_ERRORS_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS api_key_errors (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -216,6 +387,51 @@ CREATE TABLE IF NOT EXISTS app_settings (
 );
 """
 
+# Счётчик версий app_settings: триггеры увеличивают его при любой записи (в т.ч. из админки),
+# по нему процесс понимает, что кэш настроек устарел. user_frac_* — счётчики пользователей,
+# они пишутся на каждую генерацию и в кэш не попадают.
+CREATE_APP_SETTINGS_VERSION_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS app_settings_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+APP_SETTINGS_VERSION_TRIGGERS_SQL = [
+    """
+    CREATE TRIGGER IF NOT EXISTS app_settings_version_ins
+    AFTER INSERT ON app_settings
+    WHEN substr(NEW.key, 1, 10) <> 'user_frac_'
+    BEGIN
+      UPDATE app_settings_version SET version = version + 1 WHERE id = 1;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS app_settings_version_upd
+    AFTER UPDATE ON app_settings
+    WHEN substr(NEW.key, 1, 10) <> 'user_frac_'
+    BEGIN
+      UPDATE app_settings_version SET version = version + 1 WHERE id = 1;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS app_settings_version_del
+    AFTER DELETE ON app_settings
+    WHEN substr(OLD.key, 1, 10) <> 'user_frac_'
+    BEGIN
+      UPDATE app_settings_version SET version = version + 1 WHERE id = 1;
+    END;
+    """,
+]
+
+# Как часто (сек) сверять версию app_settings с БД; в промежутке чтения идут из памяти
+SETTINGS_CACHE_TTL = 5.0
+UNCACHED_SETTING_PREFIX = "user_frac_"
+
+# Кэш профилей пользователей (LRU + TTL). TTL ограничивает устаревание при правках из админки.
+PROFILE_CACHE_SIZE = 10000
+PROFILE_CACHE_TTL = 30.0
+
 CREATE_TRANSACTIONS_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS transactions (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -335,12 +551,66 @@ CREATE TABLE IF NOT EXISTS support_messages (
 );
 """
 
+class UserProfile:
+    """Поля пользователя, нужные почти каждому апдейту: грузятся одним запросом.
+
+    blocked и balance здесь могут отставать на PROFILE_CACHE_TTL (админка пишет
+    из другого процесса) — перед генерацией и списанием проверяются
+    get_user_blocked / get_user_balance, которые читают БД напрямую.
+    """
+
+    __slots__ = ("id", "lang", "blocked", "accepted_terms", "balance", "referrer_id")
+
+    def __init__(
+        self,
+        id: int,
+        lang: str = "ru",
+        blocked: bool = False,
+        accepted_terms: bool = False,
+        balance: int = 0,
+        referrer_id: int | None = None,
+    ) -> None:
+        self.id = id
+        self.lang = lang
+        self.blocked = blocked
+        self.accepted_terms = accepted_terms
+        self.balance = balance
+        self.referrer_id = referrer_id
+
+    def __repr__(self) -> str:
+        return f"UserProfile(id={self.id}, lang={self.lang!r}, blocked={self.blocked}, balance={self.balance})"
+
+
 class Database:
-    def __init__(self, db_path: str = "bot.db") -> None:
+    def __init__(self, db_path: str = "bot.db", pool_size: int = 4) -> None:
         self._db_path = db_path
+        # Долгоживущие соединения вместо aiosqlite.connect() на каждый вызов
+        self._pool = SQLitePool(db_path, readers=pool_size)
+        # Ключи Gemini и их счётчики в памяти (см. bot/key_pool.py)
+        self.key_pool = KeyPool(self)
+        # Кэш app_settings (см. _cached_settings)
+        self._settings: dict[str, str] | None = None
+        self._settings_version: int | None = None
+        self._settings_checked = 0.0
+        self._settings_lock = asyncio.Lock()
+        # user_id -> (loaded_at, UserProfile)
+        self._profiles: OrderedDict[int, tuple[float, UserProfile]] = OrderedDict()
+        self._profiles_epoch = 0
+        # None — ещё не проверяли, False — SQLite собран без FTS5 (поиск через LIKE)
+        self._fts: bool | None = None
+
+    def _read(self):
+        return self._pool.read()
+
+    def _write(self):
+        return self._pool.write()
+
+    async def close(self) -> None:
+        await self.key_pool.close()
+        await self._pool.close()
 
     async def init(self) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("PRAGMA journal_mode=WAL;")
             await db.execute(CREATE_USERS_TABLE_SQL)
             await db.execute(CREATE_SUBSCRIPTION_PLANS_TABLE_SQL)
@@ -349,12 +619,19 @@ class Database:
             await db.execute(CREATE_MODELS_TABLE_SQL)
             await db.execute(CREATE_API_KEYS_TABLE_SQL)
             await db.execute(CREATE_API_USAGE_LOG_TABLE_SQL)
+            await db.execute(CREATE_API_USAGE_LOG_INDEX_SQL)
+            await db.execute(CREATE_API_USAGE_ROLLUP_TABLE_SQL)
+            await self._backfill_api_usage_rollup(db)
             await db.execute(CREATE_API_ERRORS_TABLE_SQL)
             await db.execute(CREATE_OWN_VARIANT_API_KEYS_TABLE_SQL)
             await db.execute(CREATE_PROXIES_TABLE_SQL)
             await db.execute(CREATE_OWN_VARIANT_RATE_LIMIT_TABLE_SQL)
             await db.execute(CREATE_OWN_VARIANT_RATE_LIMIT_INDEX_SQL)
             await db.execute(CREATE_APP_SETTINGS_TABLE_SQL)
+            await db.execute(CREATE_APP_SETTINGS_VERSION_TABLE_SQL)
+            await db.execute("INSERT OR IGNORE INTO app_settings_version (id, version) VALUES (1, 0)")
+            for trigger_sql in APP_SETTINGS_VERSION_TRIGGERS_SQL:
+                await db.execute(trigger_sql)
             await db.execute(CREATE_TRANSACTIONS_TABLE_SQL)
             await db.execute(CREATE_PAYMENTS_TABLE_SQL)
             await db.execute(CREATE_SUBSCRIPTIONS_TABLE_SQL)
@@ -369,10 +646,14 @@ class Database:
             await db.execute(CREATE_LIBRARY_STEP_OPTIONS_TABLE_SQL)
             await db.execute(CREATE_SUPPORT_MESSAGES_TABLE_SQL)
             await db.execute(CREATE_BALANCE_HISTORY_TABLE_SQL)
+            await db.execute(CREATE_FSM_STORAGE_TABLE_SQL)
+            await db.execute(CREATE_FSM_STORAGE_INDEX_SQL)
+            await db.execute(CREATE_BROADCAST_JOBS_TABLE_SQL)
+            await db.execute(CREATE_BROADCAST_DELIVERIES_TABLE_SQL)
             await db.commit()
         
         # Миграция для описаний планов
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             async with db.execute("PRAGMA table_info(subscription_plans)") as cur:
                 cols = [row[1] for row in await cur.fetchall()]
             if "description_ru" not in cols:
@@ -457,7 +738,7 @@ class Database:
             logger.warning(f"Не удалось добавить токен nano-banano при инициализации: {e}")
 
         # Ensure new columns exist
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             async with db.execute("PRAGMA table_info(users)") as cur:
                 cols = [row[1] for row in await cur.fetchall()]
             if "trial_used" not in cols:
@@ -466,6 +747,9 @@ class Database:
                 await db.execute("ALTER TABLE users ADD COLUMN balance INTEGER NOT NULL DEFAULT 0")
             if "generation_price" not in cols:
                 await db.execute("ALTER TABLE users ADD COLUMN generation_price INTEGER NOT NULL DEFAULT 20")
+            if "bot_blocked" not in cols:
+                # 1 — пользователь заблокировал бота (рассылки его пропускают), сбрасывается при /start
+                await db.execute("ALTER TABLE users ADD COLUMN bot_blocked INTEGER NOT NULL DEFAULT 0")
             
             async with db.execute("PRAGMA table_info(api_keys)") as cur:
                 cols = [row[1] for row in await cur.fetchall()]
@@ -492,11 +776,17 @@ class Database:
             if support_cols and "file_type" not in support_cols:
                 await db.execute("ALTER TABLE support_messages ADD COLUMN file_type TEXT DEFAULT 'text'")
 
+            # Индексы — после миграций: старые базы могли получить created_at только что
+            for sql in CREATE_LISTING_INDEXES_SQL:
+                await db.execute(sql)
+
             await db.commit()
 
+        await self.ensure_search_index()
+
     # Support messages
     async def add_support_message(self, user_id: int, text: Optional[str] = None, file_id: Optional[str] = None, file_type: str = 'text', is_admin: bool = False) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT INTO support_messages (user_id, message_text, file_id, file_type, is_admin) VALUES (?, ?, ?, ?, ?)",
                 (user_id, text, file_id, file_type, 1 if is_admin else 0)
@@ -504,7 +794,7 @@ class Database:
             await db.commit()
 
     async def get_support_chat(self, user_id: int) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT id, message_text, is_admin, is_read, created_at, file_id, file_type FROM support_messages WHERE user_id = ? ORDER BY created_at ASC",
                 (user_id,)
@@ -513,7 +803,7 @@ class Database:
 
     async def get_support_users(self) -> list[tuple]:
         """Возвращает список пользователей, у которых есть сообщения в поддержке, с информацией о непрочитанных"""
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 """
                 SELECT u.id, u.username, u.first_name, 
@@ -527,7 +817,7 @@ class Database:
                 return await cur.fetchall()
 
     async def mark_support_read(self, user_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE support_messages SET is_read = 1 WHERE user_id = ? AND is_admin = 0",
                 (user_id,)
@@ -536,14 +826,14 @@ class Database:
 
     # API keys management
     async def list_api_keys(self) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT id, token, is_active, priority, daily_usage, total_usage, last_usage_reset, created_at, updated_at FROM api_keys ORDER BY is_active DESC, priority DESC, id"
             ) as cur:
                 return await cur.fetchall()
 
     async def list_active_api_keys(self) -> list[str]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT token FROM api_keys WHERE is_active=1 ORDER BY priority DESC, id"
             ) as cur:
@@ -551,12 +841,13 @@ class Database:
                 return [str(r[0]) for r in rows]
 
     async def add_api_key(self, token: str, priority: int = 0) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT INTO api_keys (token, priority) VALUES (?, ?)",
                 (token.strip(), int(priority)),
             )
             await db.commit()
+            self.key_pool.invalidate()
             async with db.execute("SELECT last_insert_rowid()") as cur:
                 row = await cur.fetchone()
                 return int(row[0])
@@ -565,7 +856,7 @@ class Database:
     async def add_transaction(self, user_id: int, amount: int, type: str, reason: str | None = None) -> None:
         safe_type = (type or "adjust").strip()
         safe_reason = (reason or "").strip() or None
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT INTO transactions (user_id, amount, type, reason) VALUES (?,?,?,?)",
                 (int(user_id), int(amount), safe_type, safe_reason),
@@ -573,7 +864,7 @@ class Database:
             await db.commit()
 
     async def list_user_transactions(self, user_id: int, offset: int, limit: int) -> list[tuple[int, int, str, str | None, str]]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT id, amount, type, reason, datetime(created_at, 'localtime') "
                 "FROM transactions WHERE user_id=? ORDER BY id DESC LIMIT ? OFFSET ?",
@@ -597,14 +888,16 @@ class Database:
         if not fields:
             return
         values.append(int(key_id))
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(f"UPDATE api_keys SET {', '.join(fields)} WHERE id=?", tuple(values))
             await db.commit()
+        self.key_pool.invalidate()
 
     async def delete_api_key(self, key_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM api_keys WHERE id=?", (int(key_id),))
             await db.commit()
+        self.key_pool.invalidate()
 
     # Own Variant API keys management
     async def list_own_variant_api_keys(self) -> list[tuple[int, str, int]]:
@@ -616,7 +909,7 @@ class Database:
         return await self.list_active_api_keys()
 
     async def add_own_variant_api_key(self, token: str, priority: int = 0) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT INTO own_variant_api_keys (token, priority) VALUES (?, ?)",
                 (token.strip(), int(priority)),
@@ -641,12 +934,12 @@ class Database:
         if not fields:
             return
         values.append(int(key_id))
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(f"UPDATE own_variant_api_keys SET {', '.join(fields)} WHERE id=?", tuple(values))
             await db.commit()
 
     async def delete_own_variant_api_key(self, key_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM own_variant_api_keys WHERE id=?", (int(key_id),))
             await db.commit()
 
@@ -659,15 +952,15 @@ class Database:
 
     # Maintenance flag
     async def get_maintenance(self) -> bool:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='maintenance'") as cur:
-                row = await cur.fetchone()
-                return (str(row[0]) == '1') if row else False
+        return await self.get_app_setting('maintenance') == '1'
 
     async def set_maintenance(self, enabled: bool) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
-            # Получаем текущий статус
-            current = await self.get_maintenance()
+        changed: dict[str, str] = {}
+        async with self._write() as db:
+            # Получаем текущий статус (из БД, а не из кэша — решение о продлении подписок)
+            async with db.execute("SELECT value FROM app_settings WHERE key='maintenance'") as cur:
+                row = await cur.fetchone()
+                current = (str(row[0]) == '1') if row else False
             if current == enabled:
                 return
 
@@ -680,6 +973,7 @@ class Database:
                     "INSERT INTO app_settings (key, value) VALUES ('maintenance_start', ?)\n                     ON CONFLICT(key) DO UPDATE SET value=excluded.value",
                     (now_str,),
                 )
+                changed['maintenance_start'] = now_str
             else:
                 # Выключаем: считаем сколько длились техработы и продлеваем подписки
                 async with db.execute("SELECT value FROM app_settings WHERE key='maintenance_start'") as cur:
@@ -701,16 +995,18 @@ class Database:
                 ('1' if enabled else '0',),
             )
             await db.commit()
+            changed['maintenance'] = '1' if enabled else '0'
+        await self._settings_written(changed)
 
     # Prompt Templates
     async def get_prompt_template(self, key: str) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT template FROM prompt_templates WHERE key=?", (key,)) as cur:
                 row = await cur.fetchone()
                 return str(row[0]) if row else None
 
     async def set_prompt_template(self, key: str, template: str) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT INTO prompt_templates (key, template) VALUES (?, ?)\n                 ON CONFLICT(key) DO UPDATE SET template=excluded.template",
                 (key, template),
@@ -718,7 +1014,7 @@ class Database:
             await db.commit()
 
     async def list_prompt_templates(self) -> list[tuple[str, str, str | None]]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT key, template, description FROM prompt_templates") as cur:
                 rows = await cur.fetchall()
                 return [(str(r[0]), str(r[1]), r[2]) for r in rows]
@@ -730,7 +1026,7 @@ class Database:
             ("required_channel_url", "https://t.me/bnbslow"),
             ("agreement_text", "Пожалуйста, ознакомьтесь и примите условия пользовательского соглашения перед использованием бота."),
         ]
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             for key, val in settings:
                 await db.execute(
                     "INSERT INTO app_settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO NOTHING",
@@ -745,7 +1041,7 @@ class Database:
             ("template_child", "Манекен {Пол}, одежда {Стиль}, возраст {Возраст}, ракурс {Ракурс}", "Шаблон для детей"),
             ("template_own_variant", "Photo 1: model reference. Photo 2: clothing. \nReproduce Photo 2 on the model from Photo 1. \nDetails: Length {Длина}, Sleeve {Рукав}, View {Ракурс}", "Шаблон для 'Свой вариант'"),
         ]
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             for key, tmpl, desc in templates:
                 await db.execute(
                     "INSERT OR IGNORE INTO prompt_templates (key, template, description) VALUES (?, ?, ?)",
@@ -755,165 +1051,77 @@ class Database:
 
     # Base prompts storage (single prompt per key)
     async def get_whitebg_prompt(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='whitebg_prompt'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('whitebg_prompt')
 
     async def set_whitebg_prompt(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('whitebg_prompt', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('whitebg_prompt', safe)
 
     async def get_random_prompt(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='random_prompt'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('random_prompt')
 
     async def set_random_prompt(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('random_prompt', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('random_prompt', safe)
 
     async def get_random_other_prompt(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='random_other_prompt'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('random_other_prompt')
 
     async def set_random_other_prompt(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('random_other_prompt', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('random_other_prompt', safe)
 
     async def get_storefront_prompt(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='storefront_prompt'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('storefront_prompt')
 
     async def set_storefront_prompt(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('storefront_prompt', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('storefront_prompt', safe)
 
     async def get_infographic_clothing_prompt(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='infographic_clothing_prompt'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('infographic_clothing_prompt')
 
     async def set_infographic_clothing_prompt(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('infographic_clothing_prompt', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('infographic_clothing_prompt', safe)
 
     async def get_infographic_other_prompt(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='infographic_other_prompt'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('infographic_other_prompt')
 
     async def set_infographic_other_prompt(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('infographic_other_prompt', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('infographic_other_prompt', safe)
     # Own prompts (3 steps)
     async def get_own_prompt1(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='own_prompt1'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('own_prompt1')
     async def set_own_prompt1(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('own_prompt1', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('own_prompt1', safe)
     async def get_own_prompt2(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='own_prompt2'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('own_prompt2')
     async def set_own_prompt2(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('own_prompt2', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('own_prompt2', safe)
     async def get_own_prompt3(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='own_prompt3'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('own_prompt3')
     async def set_own_prompt3(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('own_prompt3', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('own_prompt3', safe)
 
     async def get_own_prompt(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='own_prompt'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('own_prompt')
 
     async def set_own_prompt(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('own_prompt', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('own_prompt', safe)
 
     # Own Variant prompt storage
     async def get_own_variant_prompt(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='own_variant_prompt'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('own_variant_prompt')
 
     async def set_own_variant_prompt(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('own_variant_prompt', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('own_variant_prompt', safe)
 
     # Category prices (in tenths of tokens, e.g., 10 = 1 token, 12 = 1.2 tokens, 20 = 2 tokens)
     async def get_category_price(self, category: str) -> int:
@@ -935,26 +1143,17 @@ class Database:
         if category == "own_variant":
             return 20
         
-        key = f"category_price_{category}"
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key=?", (key,)) as cur:
-                row = await cur.fetchone()
-                if row:
-                    try:
-                        return int(row[0])
-                    except Exception:
-                        return default_price
-                return default_price
+        value = await self.get_app_setting(f"category_price_{category}")
+        if value is None:
+            return default_price
+        try:
+            return int(value)
+        except Exception:
+            return default_price
 
     async def set_category_price(self, category: str, price_tenths: int) -> None:
         """Устанавливает цену категории в десятых долях токена"""
-        key = f"category_price_{category}"
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES (?, ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (key, str(price_tenths)),
-            )
-            await db.commit()
+        await self.set_app_setting(f"category_price_{category}", str(price_tenths))
 
     async def list_category_prices(self) -> dict[str, int]:
         """Возвращает словарь всех цен категорий"""
@@ -966,21 +1165,11 @@ class Database:
 
     # Category enable/disable
     async def get_category_enabled(self, name: str) -> bool:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key=?", (name,)) as cur:
-                row = await cur.fetchone()
-                # По умолчанию категории включены, если нет записи '0'
-                if not row:
-                    return True
-                return str(row[0]) != '0'
+        # По умолчанию категории включены, если нет записи '0'
+        return await self.get_app_setting(name) != '0'
 
     async def set_category_enabled(self, name: str, enabled: bool) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (name, '1' if enabled else '0'),
-            )
-            await db.commit()
+        await self.set_app_setting(name, '1' if enabled else '0')
 
     async def list_categories_enabled(self) -> dict[str, bool]:
         names = ["female", "male", "child", "boy", "girl", "storefront", "whitebg", "random", "random_other", "own", "own_variant", "infographic_clothing", "infographic_other"]
@@ -992,7 +1181,7 @@ class Database:
     # Fractional token support (store tenths remainder per user)
     async def get_user_fraction(self, user_id: int) -> int:
         key = f"user_frac_{int(user_id)}"
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT value FROM app_settings WHERE key=?", (key,)) as cur:
                 row = await cur.fetchone()
                 try:
@@ -1004,7 +1193,7 @@ class Database:
         # fraction in [0..9]
         value = max(0, min(9, int(fraction_tenths)))
         key = f"user_frac_{int(user_id)}"
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT INTO app_settings (key, value) VALUES (?, ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
                 (key, str(value)),
@@ -1013,19 +1202,11 @@ class Database:
 
     # How-to text
     async def get_howto_text(self) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='howto_text'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else None
+        return await self.get_app_setting('howto_text')
 
     async def set_howto_text(self, text: str) -> None:
         safe = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('howto_text', ?)\n                 ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (safe,),
-            )
-            await db.commit()
+        await self.set_app_setting('howto_text', safe)
 
     async def upsert_user(
         self,
@@ -1035,7 +1216,7 @@ class Database:
         last_name: Optional[str],
         referrer_id: Optional[int] = None,
     ) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 """
                 INSERT INTO users (id, username, first_name, last_name, referrer_id, trial_used)
@@ -1043,62 +1224,101 @@ class Database:
                 ON CONFLICT(id) DO UPDATE SET
                     username=excluded.username,
                     first_name=excluded.first_name,
-                    last_name=excluded.last_name
+                    last_name=excluded.last_name,
+                    bot_blocked=0
                 """,
                 (user_id, username, first_name, last_name, referrer_id),
             )
             await db.commit()
+        self.invalidate_user_profile(user_id)
+
+    # User profile cache
+    async def get_user_profile(self, user_id: int) -> UserProfile:
+        """Профиль из кэша или одним запросом из БД. Для неизвестного id — значения по умолчанию."""
+        user_id = int(user_id)
+        entry = self._profiles.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < PROFILE_CACHE_TTL:
+            self._profiles.move_to_end(user_id)
+            return entry[1]
+        epoch = self._profiles_epoch
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT language, blocked, accepted_terms, balance, referrer_id FROM users WHERE id=?",
+                (user_id,),
+            ) as cur:
+                row = await cur.fetchone()
+        if row:
+            profile = UserProfile(
+                id=user_id,
+                lang=str(row[0]) if row[0] is not None else "ru",
+                blocked=bool(int(row[1] or 0)),
+                accepted_terms=bool(int(row[2] or 0)),
+                balance=int(row[3] or 0),
+                referrer_id=int(row[4]) if row[4] is not None else None,
+            )
+        else:
+            profile = UserProfile(id=user_id)
+        # Если пока шёл запрос профиль инвалидировали — не кладём устаревшее значение
+        if epoch == self._profiles_epoch:
+            self._profiles[user_id] = (time.monotonic(), profile)
+            self._profiles.move_to_end(user_id)
+            while len(self._profiles) > PROFILE_CACHE_SIZE:
+                self._profiles.popitem(last=False)
+        return profile
+
+    def invalidate_user_profile(self, user_id: int) -> None:
+        self._profiles_epoch += 1
+        self._profiles.pop(int(user_id), None)
 
     async def set_terms_acceptance(self, user_id: int, accepted: bool) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE users SET accepted_terms=? WHERE id=?",
                 (1 if accepted else 0, user_id),
             )
             await db.commit()
+        self.invalidate_user_profile(user_id)
 
     async def get_user_accepted_terms(self, user_id: int) -> bool:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT accepted_terms FROM users WHERE id=?", (user_id,)) as cur:
-                row = await cur.fetchone()
-                return bool(int(row[0])) if row else False
+        return (await self.get_user_profile(user_id)).accepted_terms
 
     async def get_user_blocked(self, user_id: int) -> bool:
-        async with aiosqlite.connect(self._db_path) as db:
+        # Мимо кэша профилей: блокировку меняют и из админки (другой процесс)
+        async with self._read() as db:
             async with db.execute("SELECT blocked FROM users WHERE id=?", (user_id,)) as cur:
                 row = await cur.fetchone()
-                return bool(int(row[0])) if row else False
+                return bool(int(row[0] or 0)) if row else False
 
     async def set_user_blocked(self, user_id: int, blocked: bool) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET blocked=? WHERE id=?", (1 if blocked else 0, user_id))
             await db.commit()
+        self.invalidate_user_profile(user_id)
 
     async def set_user_language(self, user_id: int, lang: str) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET language=? WHERE id=?", (lang, user_id))
             await db.commit()
+        self.invalidate_user_profile(user_id)
 
     async def get_user_language(self, user_id: int) -> str:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT language FROM users WHERE id=?", (user_id,)) as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else "ru"
+        return (await self.get_user_profile(user_id)).lang
 
     async def get_user_balance(self, user_id: int) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        # Мимо кэша профилей: по балансу решается, списывать ли генерацию
+        async with self._read() as db:
             async with db.execute("SELECT balance FROM users WHERE id=?", (user_id,)) as cur:
                 row = await cur.fetchone()
-                return int(row[0]) if row else 0
+                return int(row[0] or 0) if row else 0
 
     async def get_user_generation_price(self, user_id: int) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT generation_price FROM users WHERE id=?", (user_id,)) as cur:
                 row = await cur.fetchone()
                 return int(row[0]) if row and row[0] is not None else 20
 
     async def increment_user_balance(self, user_id: int, amount: int, reason: str = "recharge", admin_id: str = None) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET balance = balance + ? WHERE id=?", (amount, user_id))
             async with db.execute("SELECT balance FROM users WHERE id=?", (user_id,)) as cur:
                 row = await cur.fetchone()
@@ -1108,9 +1328,10 @@ class Database:
                 (user_id, amount, new_balance, reason, admin_id)
             )
             await db.commit()
+        self.invalidate_user_profile(user_id)
 
     async def subtract_user_balance(self, user_id: int, amount: int, reason: str = "generation") -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET balance = MAX(0, balance - ?) WHERE id=?", (amount, user_id))
             async with db.execute("SELECT balance FROM users WHERE id=?", (user_id,)) as cur:
                 row = await cur.fetchone()
@@ -1120,9 +1341,10 @@ class Database:
                 (user_id, -amount, new_balance, reason, None)
             )
             await db.commit()
+        self.invalidate_user_profile(user_id)
 
     async def add_generation_history(self, pid: str, user_id: int, category: str, params: str, input_photos: str, result_photo_id: str, input_paths: str = None, result_path: str = None, prompt: str = None) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT INTO generation_history (pid, user_id, category, params, input_photos, result_photo_id, input_paths, result_path, prompt) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 (pid, user_id, category, params, input_photos, result_photo_id, input_paths, result_path, prompt)
@@ -1130,12 +1352,12 @@ class Database:
             await db.commit()
 
     async def get_generation_by_pid(self, pid: str) -> tuple | None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT * FROM generation_history WHERE pid=?", (pid,)) as cur:
                 return await cur.fetchone()
 
     async def list_user_generations(self, user_id: int, limit: int = 20) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT pid, result_photo_id, created_at FROM generation_history WHERE user_id=? ORDER BY id DESC LIMIT ?",
                 (user_id, limit)
@@ -1143,7 +1365,7 @@ class Database:
                 return await cur.fetchall()
 
     async def get_user_subscription(self, user_id: int) -> tuple | None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             # Используем максимально надежное сравнение дат для SQLite (UTC)
             sql = """
                 SELECT id, plan_type, expires_at, daily_limit, daily_usage, last_usage_reset, individual_api_key 
@@ -1179,7 +1401,7 @@ class Database:
 
     async def update_daily_usage(self, user_id: int) -> bool:
         """Инкрементирует использование за день. Возвращает False, если лимит исчерпан."""
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             async with db.execute(
                 "SELECT id, daily_limit, daily_usage, last_usage_reset FROM subscriptions WHERE user_id=? AND datetime(expires_at) > CURRENT_TIMESTAMP",
                 (user_id,)
@@ -1206,20 +1428,20 @@ class Database:
 
     async def get_referral_stats(self, user_id: int) -> tuple[int, int]:
         """Возвращает (кол-во рефералов, заработок)"""
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT COUNT(*) FROM users WHERE referrer_id=?", (user_id,)) as cur:
                 count = (await cur.fetchone())[0]
             return count, 0
 
     async def user_exists(self, user_id: int) -> bool:
         """Проверяет, существует ли пользователь в базе"""
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT id FROM users WHERE id=?", (user_id,)) as cur:
                 row = await cur.fetchone()
                 return row is not None
     
     async def get_stats(self) -> dict:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             stats = {}
             # Пользователи
             async with db.execute("SELECT COUNT(*) FROM users") as cur:
@@ -1235,24 +1457,326 @@ class Database:
 
             return stats
 
-    async def list_users_page(self, offset: int, limit: int) -> list[tuple[int, str | None, int, int]]:
-        async with aiosqlite.connect(self._db_path) as db:
+    async def list_users_page(
+        self, limit: int, after: tuple[str, int] | None = None, before: tuple[str, int] | None = None
+    ) -> list[tuple[int, str | None, int, str | None]]:
+        """Пользователи, новые сверху: (id, username, blocked, created_at).
+
+        after — курсор последней строки предыдущей страницы (листаем дальше),
+        before — первой строки текущей (листаем назад). См. bot/pagination.py.
+        """
+        if before is not None:
+            where, order, args = "WHERE (created_at, id) > (?, ?)", "ASC", (*before, limit)
+        elif after is not None:
+            where, order, args = "WHERE (created_at, id) < (?, ?)", "DESC", (*after, limit)
+        else:
+            where, order, args = "", "DESC", (limit,)
+        async with self._read() as db:
             async with db.execute(
-                "SELECT id, username, blocked FROM users ORDER BY created_at DESC LIMIT ? OFFSET ?",
-                (limit, offset),
+                f"SELECT id, username, blocked, created_at FROM users {where} "
+                f"ORDER BY created_at {order}, id {order} LIMIT ?",
+                args,
             ) as cur:
-                rows = await cur.fetchall()
-                # Возвращаем 0 в качестве баланса для совместимости с интерфейсом, если нужно
-                return [(int(r[0]), r[1], 0, int(r[2])) for r in rows]
+                rows = [(int(r[0]), r[1], int(r[2]), r[3]) for r in await cur.fetchall()]
+        if before is not None:
+            rows.reverse()
+        return rows
+
+    async def list_users_by_ids(self, user_ids: list[int]) -> list[tuple[int, str | None, int]]:
+        """(id, username, blocked) в порядке user_ids (например, результатов поиска)."""
+        if not user_ids:
+            return []
+        async with self._read() as db:
+            async with db.execute(
+                f"SELECT id, username, blocked FROM users WHERE id IN ({','.join('?' * len(user_ids))})",
+                user_ids,
+            ) as cur:
+                rows = {int(r[0]): (int(r[0]), r[1], int(r[2])) for r in await cur.fetchall()}
+        return [rows[uid] for uid in user_ids if uid in rows]
 
     async def list_all_user_ids(self) -> list[int]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT id FROM users") as cur:
                 rows = await cur.fetchall()
                 return [int(r[0]) for r in rows]
 
+    # Full-text search
+    async def ensure_search_index(self) -> bool:
+        """Создаёт FTS5-индексы поиска и триггеры, которые их поддерживают (идемпотентно).
+
+        Новые индексы заполняются из таблиц. Вызывается из init() и веб-админкой
+        после её миграций (она создаёт site_users). False — SQLite без FTS5.
+        """
+        async with self._write() as db:
+            async with db.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')") as cur:
+                existing = {r[0] for r in await cur.fetchall()}
+            async with db.execute("PRAGMA table_info(generation_history)") as cur:
+                history_cols = {r[1] for r in await cur.fetchall()}
+            has_site_users = "site_users" in existing
+            try:
+                await db.execute(CREATE_USERS_FTS_SQL)
+                for table, fts, columns, create_sql in _CONTENT_FTS:
+                    if table == "generation_history" and "prompt" not in history_cols:
+                        continue
+                    await db.execute(create_sql)
+                    for sql in _content_fts_triggers(table, fts, columns):
+                        await db.execute(sql)
+                    if fts not in existing:
+                        await db.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+            except sqlite3.OperationalError as e:
+                await db.rollback()
+                logger.warning(f"FTS5 недоступен, поиск админки работает через LIKE: {e}")
+                self._fts = False
+                return False
+
+            for sql in USERS_FTS_TRIGGERS_SQL:
+                await db.execute(sql)
+            email = "(SELECT email FROM site_users WHERE id = -new.id)" if has_site_users else "NULL"
+            await db.execute("DROP TRIGGER IF EXISTS users_fts_ai")
+            await db.execute(USERS_FTS_INSERT_TRIGGER_SQL.format(email=email))
+            if "users_fts" not in existing:
+                await db.execute(
+                    "INSERT INTO users_fts(rowid, username, first_name, last_name) "
+                    "SELECT id, username, first_name, last_name FROM users"
+                )
+            if has_site_users:
+                for sql in SITE_USERS_FTS_TRIGGERS_SQL:
+                    await db.execute(sql)
+                if "site_users_fts_ai" not in existing:
+                    await db.execute(
+                        "UPDATE users_fts SET email = (SELECT email FROM site_users WHERE id = -users_fts.rowid) "
+                        "WHERE rowid < 0"
+                    )
+            await db.commit()
+        self._fts = True
+        return True
+
+    async def _search(
+        self, fts: str, fts_sql: str, like_sql: str, query: str, limit: int, like_columns: int
+    ) -> list[tuple]:
+        """Поиск по FTS5 (лучшие совпадения первыми), без FTS5 — тот же запрос через LIKE.
+
+        Ранжирование (bm25) считает все совпадения, поэтому делается, только если их
+        не больше FTS_RANK_LIMIT; иначе (запрос из одной частой буквы) — новые первыми.
+        Время ответа так не растёт с размером таблицы.
+        """
+        match = _fts_query(query)
+        if match is None:
+            return []
+        if self._fts is not False:
+            try:
+                async with self._read() as db:
+                    async with db.execute(
+                        f"SELECT count(*) FROM (SELECT rowid FROM {fts} WHERE {fts} MATCH ? LIMIT ?)",
+                        (match, FTS_RANK_LIMIT + 1),
+                    ) as cur:
+                        matched = (await cur.fetchone())[0]
+                    order = f"{fts}.rank" if matched <= FTS_RANK_LIMIT else f"{fts}.rowid DESC"
+                    async with db.execute(fts_sql.format(order=order), (match, limit)) as cur:
+                        return await cur.fetchall()
+            except sqlite3.OperationalError as e:
+                # Индекс ещё не создан этим процессом (или FTS5 нет) — ниже LIKE
+                logger.debug(f"FTS search failed, falling back to LIKE: {e}")
+        term = f"%{query.strip()}%"
+        async with self._read() as db:
+            async with db.execute(like_sql, (*([term] * like_columns), limit)) as cur:
+                return await cur.fetchall()
+
+    async def search_users(self, query: str, limit: int = 50) -> list[int]:
+        """id пользователей по username, имени, фамилии и email (веб-пользователи — с минусом)."""
+        rows = await self._search(
+            "users_fts",
+            "SELECT rowid FROM users_fts WHERE users_fts MATCH ? ORDER BY {order} LIMIT ?",
+            "SELECT id FROM users WHERE username LIKE ? OR first_name LIKE ? OR last_name LIKE ? "
+            "ORDER BY created_at DESC LIMIT ?",
+            query,
+            limit,
+            like_columns=3,
+        )
+        return [int(r[0]) for r in rows]
+
+    async def search_support_messages(self, query: str, limit: int = 50) -> list[tuple[int, int, str, str]]:
+        """Сообщения поддержки: (id, user_id, фрагмент с [совпадением], created_at)."""
+        return await self._search(
+            "support_fts",
+            """
+            SELECT m.id, m.user_id, snippet(support_fts, 0, '[', ']', '…', 12), m.created_at
+            FROM support_fts JOIN support_messages m ON m.id = support_fts.rowid
+            WHERE support_fts MATCH ? ORDER BY {order} LIMIT ?
+            """,
+            "SELECT id, user_id, message_text, created_at FROM support_messages WHERE message_text LIKE ? "
+            "ORDER BY id DESC LIMIT ?",
+            query,
+            limit,
+            like_columns=1,
+        )
+
+    async def search_prompts(self, query: str, limit: int = 50) -> list[int]:
+        """id промптов по названию и тексту."""
+        rows = await self._search(
+            "prompts_fts",
+            "SELECT rowid FROM prompts_fts WHERE prompts_fts MATCH ? ORDER BY {order} LIMIT ?",
+            "SELECT id FROM prompts WHERE title LIKE ? OR text LIKE ? ORDER BY id LIMIT ?",
+            query,
+            limit,
+            like_columns=2,
+        )
+        return [int(r[0]) for r in rows]
+
+    async def search_generation_history(self, query: str, limit: int = 50) -> list[int]:
+        """id записей generation_history по тексту промпта."""
+        rows = await self._search(
+            "generation_history_fts",
+            "SELECT rowid FROM generation_history_fts WHERE generation_history_fts MATCH ? ORDER BY {order} LIMIT ?",
+            "SELECT id FROM generation_history WHERE prompt LIKE ? ORDER BY id DESC LIMIT ?",
+            query,
+            limit,
+            like_columns=1,
+        )
+        return [int(r[0]) for r in rows]
+
+    # Broadcast jobs
+    async def create_broadcast_job(self, kind: str, payload: dict, created_by: int | None = None) -> int:
+        async with self._write() as db:
+            cur = await db.execute(
+                "INSERT INTO broadcast_jobs (kind, payload, created_by) VALUES (?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False), created_by),
+            )
+            await db.commit()
+            return int(cur.lastrowid)
+
+    async def get_broadcast_job(self, job_id: int) -> dict | None:
+        async with self._read() as db:
+            async with db.execute(
+                f"SELECT {', '.join(_BROADCAST_JOB_COLUMNS)} FROM broadcast_jobs WHERE id = ?", (job_id,)
+            ) as cur:
+                row = await cur.fetchone()
+        if row is None:
+            return None
+        job = dict(zip(_BROADCAST_JOB_COLUMNS, row))
+        job["payload"] = json.loads(job["payload"] or "{}")
+        return job
+
+    async def list_claimable_broadcast_jobs(self, stale_before: float) -> list[int]:
+        """Новые задания и «running», чей владелец давно не отмечался (упал)."""
+        async with self._read() as db:
+            async with db.execute(
+                """
+                SELECT id FROM broadcast_jobs
+                WHERE status = 'pending' OR (status = 'running' AND (heartbeat IS NULL OR heartbeat < ?))
+                ORDER BY id
+                """,
+                (stale_before,),
+            ) as cur:
+                return [int(r[0]) for r in await cur.fetchall()]
+
+    async def claim_broadcast_job(self, job_id: int, owner: str, now: float, stale_before: float) -> bool:
+        async with self._write() as db:
+            cur = await db.execute(
+                """
+                UPDATE broadcast_jobs SET status = 'running', owner = ?, heartbeat = ?
+                WHERE id = ? AND (status = 'pending' OR (status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)))
+                """,
+                (owner, now, job_id, stale_before),
+            )
+            await db.commit()
+            return cur.rowcount == 1
+
+    async def list_broadcast_recipients(self, job_id: int, after_user_id: int, limit: int) -> list[int]:
+        """Следующая страница получателей по users.id (keyset): без заблокировавших бота и уже обработанных."""
+        async with self._read() as db:
+            async with db.execute(
+                """
+                SELECT u.id FROM users u
+                WHERE u.id > ? AND u.bot_blocked = 0
+                  AND NOT EXISTS (SELECT 1 FROM broadcast_deliveries d WHERE d.job_id = ? AND d.user_id = u.id)
+                ORDER BY u.id
+                LIMIT ?
+                """,
+                (after_user_id, job_id, limit),
+            ) as cur:
+                return [int(r[0]) for r in await cur.fetchall()]
+
+    async def checkpoint_broadcast(
+        self,
+        job_id: int,
+        owner: str,
+        now: float,
+        deliveries: list[tuple[int, str, str | None]],
+        last_user_id: int | None = None,
+    ) -> str | None:
+        """Пишет результаты отправок, счётчики и курсор одной транзакцией. Возвращает текущий статус задания."""
+        counts = {"delivered": 0, "blocked": 0, "failed": 0}
+        for _, status, _ in deliveries:
+            counts[status] += 1
+        blocked_ids = [(uid,) for uid, status, _ in deliveries if status == "blocked"]
+        async with self._write() as db:
+            if deliveries:
+                await db.executemany(
+                    "INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id, status, error) VALUES (?, ?, ?, ?)",
+                    [(job_id, uid, status, error) for uid, status, error in deliveries],
+                )
+            if blocked_ids:
+                await db.executemany("UPDATE users SET bot_blocked = 1 WHERE id = ?", blocked_ids)
+            await db.execute(
+                """
+                UPDATE broadcast_jobs SET
+                    delivered = delivered + ?, blocked = blocked + ?, failed = failed + ?,
+                    last_user_id = MAX(last_user_id, COALESCE(?, last_user_id)),
+                    heartbeat = ?
+                WHERE id = ? AND owner = ?
+                """,
+                (counts["delivered"], counts["blocked"], counts["failed"], last_user_id, now, job_id, owner),
+            )
+            await db.commit()
+            async with db.execute("SELECT status FROM broadcast_jobs WHERE id = ?", (job_id,)) as cur:
+                row = await cur.fetchone()
+        if blocked_ids:
+            for (uid,) in blocked_ids:
+                self.invalidate_user_profile(uid)
+        return row[0] if row else None
+
+    async def finish_broadcast_job(self, job_id: int, owner: str, status: str) -> None:
+        async with self._write() as db:
+            await db.execute(
+                """
+                UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP, heartbeat = NULL
+                WHERE id = ? AND owner = ? AND status = 'running'
+                """,
+                (status, job_id, owner),
+            )
+            await db.commit()
+
+    async def release_broadcast_job(self, job_id: int, owner: str) -> None:
+        """Отдаёт незавершённое задание (остановка процесса) — его подхватят при следующем запуске."""
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE broadcast_jobs SET status = 'pending', owner = NULL, heartbeat = NULL "
+                "WHERE id = ? AND owner = ? AND status = 'running'",
+                (job_id, owner),
+            )
+            await db.commit()
+
+    async def cancel_broadcast_job(self, job_id: int) -> bool:
+        async with self._write() as db:
+            cur = await db.execute(
+                "UPDATE broadcast_jobs SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP "
+                "WHERE id = ? AND status IN ('pending', 'running')",
+                (job_id,),
+            )
+            await db.commit()
+            return cur.rowcount == 1
+
+    async def list_broadcast_jobs(self, limit: int = 20) -> list[dict]:
+        async with self._read() as db:
+            async with db.execute(
+                f"SELECT {', '.join(_BROADCAST_JOB_COLUMNS)} FROM broadcast_jobs ORDER BY id DESC LIMIT ?", (limit,)
+            ) as cur:
+                rows = await cur.fetchall()
+        return [dict(zip(_BROADCAST_JOB_COLUMNS, r)) for r in rows]
+
     async def _seed_prompts(self) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             async with db.execute("SELECT COUNT(*) FROM prompts") as cur:
                 row = await cur.fetchone()
                 count = int(row[0]) if row else 0
@@ -1269,7 +1793,7 @@ class Database:
 
     # Models CRUD and queries
     async def add_model(self, category: str, cloth: str, name: str, prompt_id: int) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             # position = max(position)+1
             async with db.execute(
                 "SELECT COALESCE(MAX(position), -1) + 1 FROM models WHERE category=? AND cloth=?",
@@ -1287,27 +1811,27 @@ class Database:
                 return int(row[0])
 
     async def delete_model(self, model_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM models WHERE id=?", (model_id,))
             await db.commit()
 
     async def set_model_prompt(self, model_id: int, prompt_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE models SET prompt_id=? WHERE id=?", (prompt_id, model_id))
             await db.commit()
 
     async def rename_model(self, model_id: int, name: str) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE models SET name=? WHERE id=?", (name, model_id))
             await db.commit()
 
     async def set_model_photo(self, model_id: int, file_id: str) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE models SET photo_file_id=? WHERE id=?", (file_id, model_id))
             await db.commit()
 
     async def list_models_page(self, category: str, cloth: str, offset: int, limit: int) -> list[tuple[int, str, int, int]]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT id, name, prompt_id, position FROM models WHERE category=? AND cloth=? AND is_active=1 ORDER BY position, id LIMIT ? OFFSET ?",
                 (category, cloth, limit, offset),
@@ -1316,13 +1840,13 @@ class Database:
                 return [(int(r[0]), str(r[1]), int(r[2]), int(r[3])) for r in rows]
 
     async def list_all_models_with_photo(self) -> list[tuple[int, str | None]]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT id, photo_file_id FROM models WHERE is_active=1 AND photo_file_id IS NOT NULL") as cur:
                 rows = await cur.fetchall()
                 return [(int(r[0]), (str(r[1]) if r[1] is not None else None)) for r in rows]
 
     async def count_models(self, category: str, cloth: str | None = None) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             if cloth and cloth != "all":
                 # Для конкретного подтипа (например boy/girl) показываем и его, и универсальные 'all'
                 async with db.execute(
@@ -1341,13 +1865,13 @@ class Database:
                     return int(row[0]) if row else 0
 
     async def list_prompts_page(self, offset: int, limit: int) -> list[tuple[int, str]]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT id, title FROM prompts ORDER BY id LIMIT ? OFFSET ?", (limit, offset)) as cur:
                 rows = await cur.fetchall()
                 return [(int(r[0]), str(r[1])) for r in rows]
 
     async def get_prompt_title(self, prompt_id: int) -> str:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT title FROM prompts WHERE id=?", (prompt_id,)) as cur:
                 row = await cur.fetchone()
                 return str(row[0]) if row else "—"
@@ -1356,7 +1880,7 @@ class Database:
         # Страхуемся от пустых значений
         safe_title = (title or "Untitled").strip() or "Untitled"
         safe_text = (text or "").strip()
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("INSERT INTO prompts (title, text) VALUES (?, ?)", (safe_title, safe_text))
             await db.commit()
             async with db.execute("SELECT last_insert_rowid()") as cur:
@@ -1364,13 +1888,21 @@ class Database:
                 return int(row[0])
 
     async def get_prompt_text(self, prompt_id: int) -> str:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT text FROM prompts WHERE id=?", (prompt_id,)) as cur:
                 row = await cur.fetchone()
                 return str(row[0]) if row else ""
 
+    async def get_model_prompt_text(self, model_id: int) -> str | None:
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT p.text FROM prompts p JOIN models m ON m.prompt_id=p.id WHERE m.id=?", (model_id,)
+            ) as cur:
+                row = await cur.fetchone()
+                return str(row[0]) if row else None
+
     async def get_model_by_index(self, category: str, cloth: str | None, index: int) -> tuple[int, str, int, str | None] | None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             if cloth and cloth != "all":
                 sql = "SELECT id, name, prompt_id, photo_file_id FROM models WHERE category=? AND (cloth=? OR cloth='all') AND is_active=1 ORDER BY position, id LIMIT 1 OFFSET ?"
                 params = (category, cloth, index)
@@ -1386,7 +1918,7 @@ class Database:
 
     # Subscription Plans CRUD
     async def _seed_subscription_plans(self) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             async with db.execute("SELECT COUNT(*) FROM subscription_plans") as cur:
                 if (await cur.fetchone())[0] == 0:
                     plans = [
@@ -1433,12 +1965,12 @@ class Database:
                     await db.commit()
 
     async def list_subscription_plans(self) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT * FROM subscription_plans WHERE is_active=1") as cur:
                 return await cur.fetchall()
 
     async def get_subscription_plan(self, plan_id: int) -> tuple | None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT * FROM subscription_plans WHERE id=?", (plan_id,)) as cur:
                 return await cur.fetchone()
 
@@ -1447,7 +1979,7 @@ class Database:
         from datetime import datetime, timedelta
         expires_at = datetime.utcnow() + timedelta(days=duration_days)
         expires_str = expires_at.strftime("%Y-%m-%d %H:%M:%S")
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             # Если оформляется платная подписка, триал сгорает (хотя он и так перекроется)
             await db.execute(
                 "INSERT INTO subscriptions (user_id, plan_id, plan_type, expires_at, daily_limit) VALUES (?, ?, ?, ?, ?)",
@@ -1467,7 +1999,7 @@ class Database:
             await db.commit()
 
     async def get_user_trial_status(self, user_id: int) -> bool:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT trial_used FROM users WHERE id=?", (user_id,)) as cur:
                 row = await cur.fetchone()
                 return bool(row[0]) if row else True
@@ -1478,73 +2010,121 @@ class Database:
         import string
         while True:
             pid = "PID" + "".join(random.choices(string.digits, k=8))
-            async with aiosqlite.connect(self._db_path) as db:
+            async with self._read() as db:
                 async with db.execute("SELECT 1 FROM generation_history WHERE pid=?", (pid,)) as cur:
                     if not await cur.fetchone():
                         return pid
 
     # History cleanup
-    async def cleanup_old_generations(self, days: int = 7) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
-            # В реальности мы тут должны еще удалять файлы из TG, если нужно,
-            # но пока просто удалим записи или пометим их
-            # Для простоты просто возвращаем кол-во старых записей
-            async with db.execute(
-                "SELECT COUNT(*) FROM generation_history WHERE created_at < datetime('now', '-' || ? || ' days')",
-                (days,)
-            ) as cur:
-                return (await cur.fetchone())[0]
+    async def cleanup_old_generations(self, days: int = 7, batch_size: int = 500) -> int:
+        """Удаляет историю генераций старше days; возвращает число удалённых строк.
+
+        Пачками по индексу created_at, каждая пачка — короткая отдельная транзакция,
+        чтобы не держать запись (и триггеры FTS) на всё удаление. Файлы удаляет
+        HistoryStore целыми каталогами дней.
+        """
+        modifier = f"-{int(days)} days"
+        deleted = 0
+        while True:
+            async with self._write() as db:
+                cur = await db.execute(
+                    "DELETE FROM generation_history WHERE id IN ("
+                    "SELECT id FROM generation_history WHERE created_at < datetime('now', ?) ORDER BY created_at LIMIT ?)",
+                    (modifier, batch_size),
+                )
+                await db.commit()
+            deleted += cur.rowcount
+            if cur.rowcount < batch_size:
+                return deleted
 
     # API Key usage tracking
     async def check_api_key_limits(self, key_id: int) -> tuple[bool, str]:
-        from datetime import datetime
-        MAX_TOTAL_USAGE = 235  # Жесткий общий лимит на ключ
-        MAX_DAILY_USAGE = 235  # Лимит в день (согласно запросу)
-        MAX_MINUTE_USAGE = 20  # Лимит в минуту (согласно запросу)
-        
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT daily_usage, total_usage, last_usage_reset FROM api_keys WHERE id=?", (key_id,)) as cur:
-                row = await cur.fetchone()
-                if not row: return False, "Key not found"
-                daily_usage, total_usage, last_reset = row
-                
-                # Проверка общего лимита (235 фото)
-                if total_usage is not None and total_usage >= MAX_TOTAL_USAGE:
-                    # Автоматически деактивируем ключ при достижении лимита
-                    await db.execute("UPDATE api_keys SET is_active=0 WHERE id=?", (key_id,))
-                    await db.commit()
-                    return False, f"Total limit {MAX_TOTAL_USAGE} reached"
-                
-                # Reset daily if needed
-                if not last_reset or (isinstance(last_reset, str) and last_reset[:10] != datetime.now().isoformat()[:10]):
-                    await db.execute("UPDATE api_keys SET daily_usage=0, last_usage_reset=CURRENT_TIMESTAMP WHERE id=?", (key_id,))
-                    await db.commit()
-                    daily_usage = 0
-                
-                # Проверка дневного лимита (235 фото в день)
-                if daily_usage >= MAX_DAILY_USAGE:
-                    return False, f"Daily limit {MAX_DAILY_USAGE} reached"
-                
-                # Проверка минутного лимита (20 в минуту)
-                async with db.execute(
-                    "SELECT COUNT(*) FROM api_usage_log WHERE key_id=? AND timestamp > datetime('now', '-1 minute')",
-                    (key_id,)
-                ) as cur_log:
-                    minute_usage = (await cur_log.fetchone())[0]
-                    if minute_usage >= MAX_MINUTE_USAGE:
-                        return False, f"Minute limit {MAX_MINUTE_USAGE} reached"
-            
-            return True, ""
+        # Лимиты считаются в памяти пула, без COUNT(*) по api_usage_log на каждую попытку
+        return await self.key_pool.check_limits(key_id)
 
     async def record_api_usage(self, key_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
-            await db.execute("INSERT INTO api_usage_log (key_id) VALUES (?)", (key_id,))
-            await db.execute("UPDATE api_keys SET daily_usage = daily_usage + 1, total_usage = total_usage + 1 WHERE id=?", (key_id,))
+        # Счётчики и api_usage_log пишутся пачкой при сбросе пула
+        await self.key_pool.record_usage(key_id)
+
+    async def _backfill_api_usage_rollup(self, db) -> None:
+        # Однократно строим агрегаты по уже накопленному логу
+        async with db.execute("SELECT 1 FROM api_usage_rollup LIMIT 1") as cur:
+            if await cur.fetchone():
+                return
+        await db.execute(
+            "INSERT INTO api_usage_rollup (key_id, bucket, bucket_start, count) "
+            "SELECT key_id, 'd', substr(timestamp, 1, 10), COUNT(*) FROM api_usage_log GROUP BY key_id, substr(timestamp, 1, 10)"
+        )
+        await db.execute(
+            "INSERT INTO api_usage_rollup (key_id, bucket, bucket_start, count) "
+            "SELECT key_id, 'm', substr(timestamp, 1, 16), COUNT(*) FROM api_usage_log "
+            "WHERE timestamp >= datetime('now', '-' || ? || ' hours') GROUP BY key_id, substr(timestamp, 1, 16)",
+            (API_USAGE_MINUTE_RETENTION_HOURS,),
+        )
+
+    async def get_api_usage_recent(self, key_ids: list[int], since: str) -> dict[int, list[str]]:
+        """Время (UTC, 'YYYY-MM-DD HH:MM:SS') использований ключей начиная с since — все процессы.
+
+        Сырые строки, а не минутные агрегаты: окно лимита скользящее, 60 с, а не две
+        календарные минуты. По индексу (key_id, timestamp) это короткий диапазон на ключ.
+        """
+        if not key_ids:
+            return {}
+        marks = ",".join("?" * len(key_ids))
+        result: dict[int, list[str]] = {}
+        async with self._read() as db:
+            async with db.execute(
+                f"SELECT key_id, timestamp FROM api_usage_log WHERE key_id IN ({marks}) AND timestamp >= ?",
+                (*key_ids, since),
+            ) as cur:
+                for key_id, ts in await cur.fetchall():
+                    result.setdefault(int(key_id), []).append(str(ts))
+        return result
+
+    async def prune_api_usage(self, retention_days: int = API_USAGE_LOG_RETENTION_DAYS, batch: int = 5000) -> int:
+        """Удаляет сырые строки api_usage_log старше retention_days и старые минутные агрегаты.
+
+        Удаляем диапазонами id небольшими транзакциями, чтобы не держать писателя долго.
+        """
+        async with self._read() as db:
+            async with db.execute("SELECT MIN(id) FROM api_usage_log") as cur:
+                row = await cur.fetchone()
+                lo = row[0] if row else None
+            # id растёт вместе со временем: первая свежая строка — граница удаления
+            async with db.execute(
+                "SELECT id FROM api_usage_log WHERE timestamp >= datetime('now', '-' || ? || ' days') ORDER BY id LIMIT 1",
+                (int(retention_days),),
+            ) as cur:
+                row = await cur.fetchone()
+                cutoff = row[0] if row else None
+        if cutoff is None:
+            async with self._read() as db:
+                async with db.execute("SELECT MAX(id) FROM api_usage_log") as cur:
+                    row = await cur.fetchone()
+                    cutoff = (row[0] + 1) if row and row[0] is not None else None
+        deleted = 0
+        if lo is not None and cutoff is not None:
+            while lo < cutoff:
+                hi = min(lo + batch, cutoff)
+                async with self._write() as db:
+                    cur = await db.execute("DELETE FROM api_usage_log WHERE id >= ? AND id < ?", (lo, hi))
+                    deleted += cur.rowcount or 0
+                    await db.commit()
+                lo = hi
+                await asyncio.sleep(0)
+        async with self._write() as db:
+            await db.execute(
+                "DELETE FROM api_usage_rollup WHERE bucket='m' AND bucket_start < strftime('%Y-%m-%d %H:%M', 'now', '-' || ? || ' hours')",
+                (API_USAGE_MINUTE_RETENTION_HOURS,),
+            )
             await db.commit()
+        if deleted:
+            logger.info(f"api_usage_log: pruned {deleted} rows older than {retention_days} days")
+        return deleted
 
     async def record_api_error(self, key_id: int | None, api_key_preview: str, error_type: str, error_message: str, status_code: int | None = None, is_proxy_error: bool = False) -> None:
         """Записывает ошибку API ключа в базу данных"""
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT INTO api_key_errors (key_id, api_key_preview, error_type, error_message, status_code, is_proxy_error) VALUES (?, ?, ?, ?, ?, ?)",
                 (key_id, api_key_preview[:20], error_type, error_message[:500], status_code, 1 if is_proxy_error else 0)
@@ -1553,7 +2133,7 @@ class Database:
 
     async def get_recent_api_errors(self, limit: int = 10) -> list[tuple]:
         """Получает последние ошибки API ключей"""
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT key_id, api_key_preview, error_type, error_message, status_code, is_proxy_error, created_at FROM api_key_errors ORDER BY created_at DESC LIMIT ?",
                 (limit,)
@@ -1562,7 +2142,7 @@ class Database:
 
     async def get_proxy_errors_count(self, hours: int = 24) -> int:
         """Получает количество ошибок прокси за последние N часов"""
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT COUNT(*) FROM api_key_errors WHERE is_proxy_error=1 AND created_at > datetime('now', '-' || ? || ' hours')",
                 (hours,)
@@ -1571,35 +2151,79 @@ class Database:
                 return int(row[0]) if row else 0
 
     # Agreement and Instructions
-    async def get_app_setting(self, key: str, default: str | None = None) -> str | None:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key=?", (key,)) as cur:
+    async def _fetch_settings_version(self, db) -> int | None:
+        try:
+            async with db.execute("SELECT version FROM app_settings_version WHERE id=1") as cur:
                 row = await cur.fetchone()
-                return str(row[0]) if row else default
+                return int(row[0]) if row else None
+        except sqlite3.OperationalError:
+            # Таблицы ещё нет (БД не инициализирована ботом) — перечитываем по TTL
+            return None
+
+    async def _cached_settings(self) -> dict[str, str]:
+        """Вся таблица app_settings в памяти; раз в SETTINGS_CACHE_TTL сверяем версию с БД."""
+        if self._settings is not None and time.monotonic() - self._settings_checked < SETTINGS_CACHE_TTL:
+            return self._settings
+        async with self._settings_lock:
+            if self._settings is not None and time.monotonic() - self._settings_checked < SETTINGS_CACHE_TTL:
+                return self._settings
+            async with self._read() as db:
+                version = await self._fetch_settings_version(db)
+                if self._settings is None or version is None or version != self._settings_version:
+                    async with db.execute(
+                        "SELECT key, value FROM app_settings WHERE substr(key, 1, 10) <> ?",
+                        (UNCACHED_SETTING_PREFIX,),
+                    ) as cur:
+                        rows = await cur.fetchall()
+                    self._settings = {str(r[0]): str(r[1]) for r in rows}
+                    self._settings_version = version
+            self._settings_checked = time.monotonic()
+            return self._settings
+
+    async def _settings_written(self, values: dict[str, str]) -> None:
+        # Write-through: своя запись видна сразу, не дожидаясь сверки версии
+        if not values:
+            return
+        async with self._settings_lock:
+            if self._settings is not None:
+                self._settings.update(values)
 
-    async def get_all_app_settings(self) -> dict[str, str]:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT key, value FROM app_settings") as cur:
-                rows = await cur.fetchall()
-                return {row[0]: row[1] for row in rows}
+    def invalidate_settings_cache(self) -> None:
+        self._settings = None
+        self._settings_version = None
 
-    async def get_agreement_text(self) -> str:
-        async with aiosqlite.connect(self._db_path) as db:
-            async with db.execute("SELECT value FROM app_settings WHERE key='agreement_text'") as cur:
-                row = await cur.fetchone()
-                return str(row[0]) if row else "Пользовательское соглашение не задано."
+    async def get_app_setting(self, key: str, default: str | None = None) -> str | None:
+        if key.startswith(UNCACHED_SETTING_PREFIX):
+            async with self._read() as db:
+                async with db.execute("SELECT value FROM app_settings WHERE key=?", (key,)) as cur:
+                    row = await cur.fetchone()
+                    return str(row[0]) if row else default
+        settings = await self._cached_settings()
+        return settings[key] if key in settings else default
 
-    async def set_agreement_text(self, text: str) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+    async def set_app_setting(self, key: str, value: str) -> None:
+        async with self._write() as db:
             await db.execute(
-                "INSERT INTO app_settings (key, value) VALUES ('agreement_text', ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                (text,)
+                "INSERT INTO app_settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                (key, value),
             )
             await db.commit()
+        if not key.startswith(UNCACHED_SETTING_PREFIX):
+            await self._settings_written({key: value})
+
+    async def get_all_app_settings(self) -> dict[str, str]:
+        """Все настройки, кроме служебных user_frac_* (их читает get_user_fraction)."""
+        return dict(await self._cached_settings())
+
+    async def get_agreement_text(self) -> str:
+        return await self.get_app_setting('agreement_text', "Пользовательское соглашение не задано.")
+
+    async def set_agreement_text(self, text: str) -> None:
+        await self.set_app_setting('agreement_text', text)
 
     # Category and Steps Management
     async def list_categories(self, only_active: bool = False) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             sql = "SELECT id, key, name_ru, is_active, order_index FROM categories"
             if only_active:
                 sql += " WHERE is_active=1"
@@ -1608,12 +2232,12 @@ class Database:
                 return await cur.fetchall()
 
     async def get_category_by_key(self, key: str) -> tuple | None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT id, key, name_ru, is_active, order_index FROM categories WHERE key=?", (key,)) as cur:
                 return await cur.fetchone()
 
     async def list_steps(self, category_id: int) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT id, step_key, question_text, input_type, is_optional, order_index FROM steps WHERE category_id=? ORDER BY order_index, id",
                 (category_id,)
@@ -1621,7 +2245,7 @@ class Database:
                 return await cur.fetchall()
 
     async def list_step_options(self, step_id: int) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT id, option_text, option_value, order_index, custom_prompt FROM step_options WHERE step_id=? ORDER BY order_index, id",
                 (step_id,)
@@ -1629,7 +2253,7 @@ class Database:
                 return await cur.fetchall()
 
     async def get_step_text(self, step_id: int, lang: str) -> str:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT question_text, question_text_en, question_text_vi FROM steps WHERE id=?",
                 (step_id,),
@@ -1645,7 +2269,7 @@ class Database:
                 return str(ru or "")
 
     async def list_step_options_localized(self, step_id: int, lang: str) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                 "SELECT id, option_text, option_text_en, option_text_vi, option_value, order_index, custom_prompt "
                 "FROM step_options WHERE step_id=? ORDER BY order_index, id",
@@ -1660,7 +2284,7 @@ class Database:
                 return result
 
     async def add_category(self, key: str, name_ru: str, is_active: int = 1, order_index: int = 0) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT OR IGNORE INTO categories (key, name_ru, is_active, order_index) VALUES (?, ?, ?, ?)",
                 (key, name_ru, is_active, order_index)
@@ -1671,7 +2295,7 @@ class Database:
                 return row[0]
 
     async def add_step(self, category_id: int, step_key: str, question_text: str, input_type: str, is_optional: int = 0, order_index: int = 0) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             # Проверяем не существует ли уже такой шаг
             async with db.execute("SELECT id, input_type FROM steps WHERE category_id=? AND step_key=?", (category_id, step_key)) as cur:
                 row = await cur.fetchone()
@@ -1689,7 +2313,7 @@ class Database:
                 return (await cur.fetchone())[0]
 
     async def add_step_option(self, step_id: int, text: str, value: str, order_index: int = 0, custom_prompt: str = None) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             # Проверяем не существует ли уже такая опция
             async with db.execute("SELECT id FROM step_options WHERE step_id=? AND option_value=?", (step_id, value)) as cur:
                 row = await cur.fetchone()
@@ -1704,7 +2328,7 @@ class Database:
             await db.commit()
 
     async def delete_category(self, cat_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             # Удаляем все опции шагов этой категории
             await db.execute("DELETE FROM step_options WHERE step_id IN (SELECT id FROM steps WHERE category_id=?)", (cat_id,))
             # Удаляем шаги
@@ -1714,7 +2338,7 @@ class Database:
             await db.commit()
 
     async def update_category(self, cat_id: int, name_ru: str, is_active: int, order_index: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE categories SET name_ru=?, is_active=?, order_index=? WHERE id=?",
                 (name_ru, is_active, order_index, cat_id)
@@ -1723,12 +2347,12 @@ class Database:
 
     # --- Library Management ---
     async def list_library_steps(self) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT id, step_key, question_text, input_type FROM library_steps ORDER BY id") as cur:
                 return await cur.fetchall()
 
     async def add_library_step(self, step_key: str, question_text: str, input_type: str = 'buttons') -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT INTO library_steps (step_key, question_text, input_type) VALUES (?, ?, ?)",
                 (step_key, question_text, input_type)
@@ -1738,30 +2362,30 @@ class Database:
                 return (await cur.fetchone())[0]
 
     async def delete_library_step(self, step_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM library_steps WHERE id=?", (step_id,))
             await db.commit()
 
     async def list_button_categories(self) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT id, name FROM button_categories ORDER BY id") as cur:
                 return await cur.fetchall()
 
     async def add_button_category(self, name: str) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("INSERT OR IGNORE INTO button_categories (name) VALUES (?)", (name,))
             await db.commit()
             async with db.execute("SELECT id FROM button_categories WHERE name=?", (name,)) as cur:
                 return (await cur.fetchone())[0]
 
     async def delete_button_category(self, cat_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM library_options WHERE category_id=?", (cat_id,))
             await db.execute("DELETE FROM button_categories WHERE id=?", (cat_id,))
             await db.commit()
 
     async def list_library_options(self, category_id: int = None) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             if category_id:
                 sql = "SELECT id, category_id, option_text, option_value, custom_prompt FROM library_options WHERE category_id=? ORDER BY id"
                 params = (category_id,)
@@ -1772,7 +2396,7 @@ class Database:
                 return await cur.fetchall()
 
     async def add_library_option(self, category_id: int, text: str, value: str, custom_prompt: str = None) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "INSERT INTO library_options (category_id, option_text, option_value, custom_prompt) VALUES (?, ?, ?, ?)",
                 (category_id, text, value, custom_prompt)
@@ -1782,18 +2406,18 @@ class Database:
                 return (await cur.fetchone())[0]
 
     async def delete_library_option(self, opt_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM library_options WHERE id=?", (opt_id,))
             await db.commit()
 
     async def delete_step(self, step_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM step_options WHERE step_id=?", (step_id,))
             await db.execute("DELETE FROM steps WHERE id=?", (step_id,))
             await db.commit()
 
     async def update_step(self, step_id: int, question_text: str, input_type: str, is_optional: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE steps SET question_text=?, input_type=?, is_optional=? WHERE id=?",
                 (question_text, input_type, is_optional, step_id)
@@ -1802,7 +2426,7 @@ class Database:
 
     async def _seed_library(self) -> None:
         """Предзаполнение библиотек вопросов и кнопок"""
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             # 1. Библиотека вопросов
             async with db.execute("SELECT COUNT(*) FROM library_steps") as cur:
                 if (await cur.fetchone())[0] == 0:
@@ -1934,7 +2558,7 @@ class Database:
 
     async def _seed_categories(self) -> None:
         """Предзаполнение категорий и шагов только если база пуста"""
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT COUNT(*) FROM categories") as cur:
                 count = (await cur.fetchone())[0]
             if count > 0:
@@ -2289,7 +2913,7 @@ class Database:
 
     # --- PROXIES METHODS ---
     async def add_proxy(self, url: str) -> int:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("INSERT INTO proxies (url) VALUES (?)", (url,))
             await db.commit()
             async with db.execute("SELECT last_insert_rowid()") as cur:
@@ -2297,23 +2921,23 @@ class Database:
                 return int(row[0])
 
     async def delete_proxy(self, proxy_id: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM proxies WHERE id=?", (proxy_id,))
             await db.commit()
 
     async def list_proxies(self) -> list[tuple]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT * FROM proxies ORDER BY created_at DESC") as cur:
                 return await cur.fetchall()
 
     async def get_active_proxies_urls(self) -> list[str]:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._read() as db:
             async with db.execute("SELECT url FROM proxies WHERE is_active = 1") as cur:
                 rows = await cur.fetchall()
                 return [r[0] for r in rows]
 
     async def update_proxy_status(self, proxy_id: int, status: str, error_message: str = None) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute(
                 "UPDATE proxies SET status = ?, error_message = ?, last_check = CURRENT_TIMESTAMP WHERE id = ?",
                 (status, error_message, proxy_id)
@@ -2321,7 +2945,7 @@ class Database:
             await db.commit()
 
     async def toggle_proxy_active(self, proxy_id: int, is_active: int) -> None:
-        async with aiosqlite.connect(self._db_path) as db:
+        async with self._write() as db:
             await db.execute("UPDATE proxies SET is_active = ? WHERE id = ?", (is_active, proxy_id))
             await db.commit()
 
@@ -0,0 +1,153 @@
+import asyncio
+import contextvars
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class SQLitePool:
+    """Пул долгоживущих соединений SQLite: один писатель и N читателей.
+
+    Соединения открываются лениво при первом обращении и живут до close().
+    Писатель сериализуется asyncio.Lock, читатели раздаются через очередь
+    и работают в режиме query_only.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        readers: int = 4,
+        busy_timeout_ms: int = 30000,
+        cached_statements: int = 256,
+        row_factory=None,
+    ) -> None:
+        self._db_path = db_path
+        self._readers_count = max(1, int(readers))
+        self._busy_timeout_ms = int(busy_timeout_ms)
+        self._cached_statements = int(cached_statements)
+        # Например, aiosqlite.Row для веб-админки; Database работает с кортежами
+        self._row_factory = row_factory
+        self._writer: aiosqlite.Connection | None = None
+        self._readers: asyncio.Queue | None = None
+        self._all: list[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        # (task, connection, is_writer) — соединение этого пула, которое текущая задача
+        # уже держит. Нужно для вложенных вызовов (например, set_maintenance ->
+        # get_maintenance), чтобы не брать второе соединение и не ловить дедлок на
+        # блокировке писателя. Своя переменная у каждого пула: соединение другого
+        # пула (другие row_factory и транзакция) переиспользовать нельзя.
+        self._held: contextvars.ContextVar[tuple | None] = contextvars.ContextVar(
+            f"sqlite_pool_held_{id(self):x}", default=None
+        )
+
+    @property
+    def db_path(self) -> str:
+        return self._db_path
+
+    async def _connect(self, *, query_only: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(
+            self._db_path,
+            timeout=self._busy_timeout_ms / 1000,
+            cached_statements=self._cached_statements,
+        )
+        await conn.execute(f"PRAGMA busy_timeout={self._busy_timeout_ms}")
+        if not query_only:
+            # journal_mode хранится в файле БД — достаточно выставить с писателя
+            await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        if query_only:
+            await conn.execute("PRAGMA query_only=1")
+        if self._row_factory is not None:
+            conn.row_factory = self._row_factory
+        return conn
+
+    async def _ensure_open(self) -> None:
+        if self._writer is not None:
+            return
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            writer = await self._connect(query_only=False)
+            readers: asyncio.Queue = asyncio.Queue()
+            opened = [writer]
+            try:
+                for _ in range(self._readers_count):
+                    conn = await self._connect(query_only=True)
+                    opened.append(conn)
+                    readers.put_nowait(conn)
+            except Exception:
+                for conn in opened:
+                    try:
+                        await conn.close()
+                    except Exception:
+                        pass
+                raise
+            self._all = opened
+            self._readers = readers
+            self._writer = writer
+            logger.info(f"SQLite pool opened: {self._db_path} (1 writer, {self._readers_count} readers)")
+
+    @staticmethod
+    async def _discard_transaction(conn: aiosqlite.Connection) -> None:
+        # Поведение как у закрытого без commit() соединения: незафиксированное откатывается
+        try:
+            if conn.in_transaction:
+                await conn.rollback()
+        except Exception as e:
+            logger.warning(f"SQLite pool rollback failed: {e}")
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[aiosqlite.Connection]:
+        task = asyncio.current_task()
+        held = self._held.get()
+        if held is not None and held[0] is task:
+            yield held[1]
+            return
+        await self._ensure_open()
+        readers = self._readers
+        conn = await readers.get()
+        token = self._held.set((task, conn, False))
+        try:
+            yield conn
+        finally:
+            self._held.reset(token)
+            await self._discard_transaction(conn)
+            readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[aiosqlite.Connection]:
+        task = asyncio.current_task()
+        held = self._held.get()
+        if held is not None and held[0] is task and held[2]:
+            yield held[1]
+            return
+        await self._ensure_open()
+        async with self._write_lock:
+            conn = self._writer
+            token = self._held.set((task, conn, True))
+            try:
+                yield conn
+            finally:
+                self._held.reset(token)
+                await self._discard_transaction(conn)
+
+    async def close(self) -> None:
+        async with self._open_lock:
+            conns, self._all = self._all, []
+            writer, self._writer = self._writer, None
+            self._readers = None
+            if writer is not None:
+                try:
+                    await writer.execute("PRAGMA optimize")
+                except Exception:
+                    pass
+            for conn in conns:
+                try:
+                    await conn.close()
+                except Exception as e:
+                    logger.warning(f"SQLite pool close failed: {e}")
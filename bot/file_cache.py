@@ -0,0 +1,226 @@
+import asyncio
+import io
+import logging
+import os
+from collections import OrderedDict
+
+from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Результат in-flight future, если загружавшую задачу отменили: ждущие грузят сами
+_ABANDONED = object()
+
+
+class TelegramFileCache:
+    """Кэш байтов файлов Telegram: память (LRU) + диск (LRU по размеру).
+
+    Содержимое хранится по file_unique_id, поэтому один и тот же файл, пришедший
+    под разными file_id, скачивается один раз. Соответствие file_id -> file_unique_id
+    держим в памяти; после перезапуска оно восстанавливается одним get_file без скачивания.
+    Пути вида "data/..." читаются с диска проекта, как и раньше.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        memory_max_bytes: int = 64 * 1024 * 1024,
+        disk_max_bytes: int = 512 * 1024 * 1024,
+        max_item_bytes: int = 20 * 1024 * 1024,
+        max_aliases: int = 100000,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.max_aliases = max_aliases
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        # file_unique_id -> размер на диске, в порядке последнего использования
+        self._disk: OrderedDict[str, int] | None = None
+        self._disk_bytes = 0
+        self._aliases: OrderedDict[str, str] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    # --- память ---
+    def _memory_get(self, uid: str) -> bytes | None:
+        data = self._memory.get(uid)
+        if data is not None:
+            self._memory.move_to_end(uid)
+        return data
+
+    def _memory_put(self, uid: str, data: bytes) -> None:
+        if len(data) > self.max_item_bytes:
+            return
+        old = self._memory.pop(uid, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[uid] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    # --- диск ---
+    def _path(self, uid: str) -> str:
+        return os.path.join(self.cache_dir, uid)
+
+    def _scan_disk(self) -> OrderedDict[str, int]:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+        entries.sort()
+        return OrderedDict((name, size) for _, name, size in entries)
+
+    async def _ensure_disk(self) -> OrderedDict[str, int]:
+        if self._disk is None:
+            disk = await asyncio.to_thread(self._scan_disk)
+            if self._disk is None:
+                self._disk = disk
+                self._disk_bytes = sum(disk.values())
+        return self._disk
+
+    @staticmethod
+    def _read_file(path: str, touch: bool = False) -> bytes | None:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            if touch:
+                # mtime — порядок LRU при следующем сканировании каталога
+                os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        tmp = f"{path}.{os.getpid()}.{id(data)}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _remove_files(paths: list[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def _disk_get(self, uid: str) -> bytes | None:
+        disk = await self._ensure_disk()
+        if uid not in disk:
+            return None
+        data = await asyncio.to_thread(self._read_file, self._path(uid), True)
+        if data is None:
+            self._disk_bytes -= disk.pop(uid, 0)
+            return None
+        disk.move_to_end(uid)
+        return data
+
+    async def _disk_put(self, uid: str, data: bytes) -> None:
+        if len(data) > self.max_item_bytes:
+            return
+        disk = await self._ensure_disk()
+        try:
+            await asyncio.to_thread(self._write_file, self._path(uid), data)
+        except OSError as e:
+            logger.warning(f"[file_cache] Disk write failed for {uid}: {e}")
+            return
+        self._disk_bytes -= disk.pop(uid, 0)
+        disk[uid] = len(data)
+        self._disk_bytes += len(data)
+        evicted = []
+        while self._disk_bytes > self.disk_max_bytes and len(disk) > 1:
+            old_uid, size = disk.popitem(last=False)
+            self._disk_bytes -= size
+            evicted.append(self._path(old_uid))
+        if evicted:
+            await asyncio.to_thread(self._remove_files, evicted)
+
+    # --- публичное API ---
+    async def get_bytes(self, bot: Bot, file_id: str) -> bytes | None:
+        """Байты файла по file_id (или по локальному пути data/...); None, если скачать не удалось."""
+        if not file_id:
+            return None
+        file_id = str(file_id)
+        if file_id.startswith("data/"):
+            local_path = os.path.join(BASE_DIR, file_id)
+            if os.path.exists(local_path):
+                return await asyncio.to_thread(self._read_file, local_path)
+
+        uid = self._aliases.get(file_id)
+        if uid is not None:
+            self._aliases.move_to_end(file_id)
+            data = self._memory_get(uid)
+            if data is not None:
+                return data
+
+        pending = self._inflight.get(file_id)
+        if pending is not None:
+            data = await asyncio.shield(pending)
+            if data is not _ABANDONED:
+                return data
+            # Задачу, которая скачивала файл, отменили — скачиваем сами
+            return await self.get_bytes(bot, file_id)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[file_id] = fut
+        try:
+            data = await self._load(bot, file_id, uid)
+            fut.set_result(data)
+            return data
+        except asyncio.CancelledError:
+            # Не отменяем future: его ждут другие задачи, которых никто не отменял
+            self._inflight.pop(file_id, None)
+            fut.set_result(_ABANDONED)
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка загрузки фото {file_id}: {e}")
+            fut.set_result(None)
+            return None
+        finally:
+            self._inflight.pop(file_id, None)
+
+    async def _load(self, bot: Bot, file_id: str, uid: str | None) -> bytes | None:
+        if uid is not None:
+            data = await self._disk_get(uid)
+            if data is not None:
+                self._memory_put(uid, data)
+                return data
+        f_info = await bot.get_file(file_id)
+        uid = f_info.file_unique_id or file_id
+        self._aliases[file_id] = uid
+        while len(self._aliases) > self.max_aliases:
+            self._aliases.popitem(last=False)
+        data = self._memory_get(uid)
+        if data is None:
+            data = await self._disk_get(uid)
+        if data is None:
+            # Скачиваем напрямую в память
+            dest = io.BytesIO()
+            await bot.download_file(f_info.file_path, dest)
+            data = dest.getvalue()
+            await self._disk_put(uid, data)
+        self._memory_put(uid, data)
+        return data
+
+    async def save_to(self, bot: Bot, file_id: str, path: str) -> bool:
+        """Сохраняет файл по file_id в path (через кэш). True при успехе."""
+        data = await self.get_bytes(bot, file_id)
+        if data is None:
+            return False
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        await asyncio.to_thread(self._write_file, path, data)
+        return True
+
+
+telegram_file_cache = TelegramFileCache(os.path.join(BASE_DIR, "data", "tg_cache"))
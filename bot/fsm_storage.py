@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Mapping
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+_EMPTY_DATA = "{}"
+
+
+class _Entry:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state: str | None, data: str, touched: float) -> None:
+        self.state = state
+        # Данные храним сериализованными: get_data всегда отдаёт новый dict
+        self.data = data
+        self.touched = touched
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_storage той же БД, что и бот.
+
+    Состояния живут в памяти (write-back): get/set не ходят в SQLite, изменённые
+    ключи раз в flush_interval сбрасываются одной транзакцией, поэтому несколько
+    update_data подряд в одном хендлере дают одну запись. Сессии, не менявшиеся
+    дольше ttl, удаляются и из памяти, и из таблицы. Подходит для одного процесса
+    бота и для воркеров webhook-режима (апдейты пользователя всегда попадают в один
+    воркер, см. bot/webhook.py); если чужое состояние меняют из другого процесса —
+    FSM_STORAGE=redis://...
+    """
+
+    def __init__(
+        self,
+        db,
+        ttl: float = 7 * 24 * 3600,
+        flush_interval: float = 1.0,
+        sweep_interval: float = 3600.0,
+        memory_idle: float = 1800.0,
+        max_entries: int = 50000,
+    ) -> None:
+        self._db = db
+        self.ttl = float(ttl)
+        self.flush_interval = float(flush_interval)
+        self.sweep_interval = float(sweep_interval)
+        self.memory_idle = float(memory_idle)
+        self.max_entries = int(max_entries)
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._loading: dict[str, asyncio.Future] = {}
+        self._dirty: set[str] = set()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._closed = False
+
+    # --- память ---
+    def _key(self, key: StorageKey) -> str:
+        return self._key_builder.build(key)
+
+    async def _entry(self, key: StorageKey) -> _Entry:
+        skey = self._key(key)
+        entry = self._entries.get(skey)
+        if entry is not None:
+            self._entries.move_to_end(skey)
+            return entry
+        pending = self._loading.get(skey)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load(skey))
+            self._loading[skey] = pending
+            pending.add_done_callback(lambda _f, k=skey: self._loading.pop(k, None))
+        return await asyncio.shield(pending)
+
+    async def _load(self, skey: str) -> _Entry:
+        async with self._db._read() as db:
+            async with db.execute(
+                "SELECT state, data, updated_at FROM fsm_storage WHERE key = ?", (skey,)
+            ) as cur:
+                row = await cur.fetchone()
+        entry = self._entries.get(skey)
+        if entry is not None:
+            # Ключ успели записать, пока шёл SELECT — он новее
+            return entry
+        now = time.time()
+        if row is not None and row[2] is not None and now - float(row[2]) < self.ttl:
+            entry = _Entry(row[0], row[1] or _EMPTY_DATA, float(row[2]))
+        else:
+            entry = _Entry(None, _EMPTY_DATA, now)
+        self._entries[skey] = entry
+        self._evict_overflow()
+        return entry
+
+    def _evict_overflow(self) -> None:
+        if len(self._entries) <= self.max_entries:
+            return
+        for skey in list(self._entries):
+            if len(self._entries) <= self.max_entries:
+                break
+            if skey not in self._dirty:
+                del self._entries[skey]
+
+    def _mark_dirty(self, key: StorageKey, entry: _Entry) -> None:
+        skey = self._key(key)
+        entry.touched = time.time()
+        # Запись могли выгрузить из памяти, пока хендлер ждал загрузки, — возвращаем
+        self._entries[skey] = entry
+        self._dirty.add(skey)
+        self._ensure_task()
+
+    # --- BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, entry)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._entry(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        # Сериализуем сразу, чтобы несериализуемые данные падали в хендлере, а не при сбросе
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        entry = await self._entry(key)
+        entry.data = payload
+        self._mark_dirty(key, entry)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return json.loads((await self._entry(key)).data)
+
+    # --- фоновый сброс и очистка ---
+    def _ensure_task(self) -> None:
+        if self._task is None and not self._closed:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_sweep >= self.sweep_interval:
+                    last_sweep = time.monotonic()
+                    await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[fsm_storage] flush failed: {e}")
+
+    async def flush(self) -> int:
+        """Записывает изменённые ключи одной транзакцией. Возвращает число ключей."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            keys = list(self._dirty)
+            self._dirty.clear()
+            upserts = []
+            deletes = []
+            for skey in keys:
+                entry = self._entries.get(skey)
+                if entry is None:
+                    continue
+                if entry.state is None and entry.data == _EMPTY_DATA:
+                    # state.clear() — строку можно удалить
+                    deletes.append((skey,))
+                else:
+                    upserts.append((skey, entry.state, entry.data, entry.touched))
+            try:
+                async with self._db._write() as db:
+                    if upserts:
+                        await db.executemany(
+                            """
+                            INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(key) DO UPDATE SET
+                                state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+                            """,
+                            upserts,
+                        )
+                    if deletes:
+                        await db.executemany("DELETE FROM fsm_storage WHERE key = ?", deletes)
+                    await db.commit()
+            except BaseException:
+                # Вернём ключи в очередь — запишутся при следующем сбросе
+                self._dirty.update(keys)
+                raise
+            return len(keys)
+
+    async def sweep(self) -> int:
+        """Удаляет брошенные сессии (старше ttl) и выгружает из памяти давно не использованные."""
+        now = time.time()
+        for skey in [
+            k for k, e in self._entries.items()
+            if k not in self._dirty and now - e.touched >= min(self.memory_idle, self.ttl)
+        ]:
+            del self._entries[skey]
+        async with self._db._write() as db:
+            cur = await db.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (now - self.ttl,))
+            removed = cur.rowcount or 0
+            await db.commit()
+        if removed:
+            logger.info(f"[fsm_storage] Removed {removed} expired FSM sessions")
+        return removed
+
+    async def close(self) -> None:
+        self._closed = True
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"[fsm_storage] final flush failed: {e}")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+def build_fsm_storage(db) -> BaseStorage:
+    """Хранилище FSM по FSM_STORAGE: sqlite (по умолчанию), memory или redis://... / rediss://... / unix://...
+
+    Redis-бэкенд — штатный RedisStorage aiogram (нужен пакет redis); подойдёт любой
+    сервер с протоколом Redis. FSM_TTL_SECONDS — срок жизни брошенной сессии.
+    """
+    backend = (os.getenv("FSM_STORAGE") or "sqlite").strip()
+    ttl = _env_int("FSM_TTL_SECONDS", 7 * 24 * 3600)
+    if backend.lower() == "memory":
+        return MemoryStorage()
+    if backend.lower().startswith(("redis://", "rediss://", "unix://")):
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise RuntimeError("FSM_STORAGE=redis://... требует пакет redis: pip install 'redis>=5'") from e
+        return RedisStorage.from_url(
+            backend,
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True),
+            state_ttl=ttl,
+            data_ttl=ttl,
+        )
+    if backend.lower() != "sqlite":
+        logger.warning(f"[fsm_storage] Unknown FSM_STORAGE={backend!r}, using sqlite")
+    return SQLiteStorage(db, ttl=ttl)
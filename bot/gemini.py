@@ -2,13 +2,16 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import hashlib
 import io
 import logging
+import multiprocessing
 import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 
 import httpx
-import requests  # для совместимости с generate_text
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +43,86 @@ def _compress_image(img_bytes: bytes) -> bytes:
         return img_bytes
 
 
+# Сжатие (Pillow) — в отдельных процессах, чтобы не упираться в GIL и не блокировать цикл событий
+COMPRESS_WORKERS = max(1, min(4, os.cpu_count() or 1))
+# Кэш сжатых входных фото (base64) по хэшу содержимого: повтор на другом ключе не сжимает заново
+COMPRESS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+_compress_executor: ProcessPoolExecutor | None = None
+_compressed_cache: OrderedDict[str, str] = OrderedDict()
+_compressed_cache_bytes = 0
+_compress_inflight: dict[str, asyncio.Future] = {}
+
+
+def _get_compress_executor() -> ProcessPoolExecutor:
+    global _compress_executor
+    if _compress_executor is None:
+        # spawn: не форкаем процесс с запущенным циклом событий и потоками aiosqlite
+        _compress_executor = ProcessPoolExecutor(
+            max_workers=COMPRESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _compress_executor
+
+
+async def compress_image_async(img_bytes: bytes) -> bytes:
+    """_compress_image в пуле процессов; при сбое пула — в потоке."""
+    global _compress_executor
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_get_compress_executor(), _compress_image, img_bytes)
+    except Exception as e:
+        logger.warning("[Gemini] Compression process pool failed, using thread: %s", e)
+        executor, _compress_executor = _compress_executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return await asyncio.to_thread(_compress_image, img_bytes)
+
+
+def _cache_put(digest: str, encoded: str) -> None:
+    global _compressed_cache_bytes
+    _compressed_cache[digest] = encoded
+    _compressed_cache_bytes += len(encoded)
+    while _compressed_cache_bytes > COMPRESS_CACHE_MAX_BYTES and len(_compressed_cache) > 1:
+        _, old = _compressed_cache.popitem(last=False)
+        _compressed_cache_bytes -= len(old)
+
+
+async def _prepare_image(img_bytes: bytes) -> str:
+    """Сжатое фото в base64 для inlineData; одно и то же содержимое сжимается один раз."""
+    digest = hashlib.blake2b(img_bytes, digest_size=20).hexdigest()
+    cached = _compressed_cache.get(digest)
+    if cached is not None:
+        _compressed_cache.move_to_end(digest)
+        return cached
+    pending = _compress_inflight.get(digest)
+    if pending is not None:
+        encoded = await asyncio.shield(pending)
+        if encoded is not None:
+            return encoded
+        # Задачу, которая сжимала это фото, отменили — сжимаем сами
+        return await _prepare_image(img_bytes)
+    fut = asyncio.get_running_loop().create_future()
+    _compress_inflight[digest] = fut
+    try:
+        compressed = await compress_image_async(img_bytes)
+        encoded = base64.b64encode(compressed).decode("utf-8")
+        _cache_put(digest, encoded)
+        fut.set_result(encoded)
+        return encoded
+    except asyncio.CancelledError:
+        # Не отменяем future: его ждут другие задачи, которых никто не отменял
+        _compress_inflight.pop(digest, None)
+        fut.set_result(None)
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # помечаем как полученное, если никто не ждал
+        raise
+    finally:
+        _compress_inflight.pop(digest, None)
+
+
 def _valid_proxy(url: str) -> bool:
     try:
         from urllib.parse import urlparse
@@ -98,43 +181,67 @@ def _normalize_proxy_for_httpx(raw: str) -> str | None:
     return None
 
 
-def _build_proxies(proxy_url: str | None) -> dict:
-    if not proxy_url or not _valid_proxy(proxy_url):
-        return {}
-    return {"http": proxy_url, "https": proxy_url}
+# Долгоживущие клиенты: один AsyncClient на прокси (None — напрямую), чтобы не платить
+# за TLS-рукопожатие и CONNECT к прокси на каждый запрос и не держать поток по 600 с.
+GEMINI_TIMEOUT = httpx.Timeout(connect=30.0, read=600.0, write=60.0, pool=30.0)
+GEMINI_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0)
+
+try:
+    import h2  # noqa: F401  # HTTP/2 в httpx доступен только с пакетом h2 (httpx[http2])
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_clients: dict[str | None, httpx.AsyncClient] = {}
+_clients_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _get_client(proxy_url: str | None) -> httpx.AsyncClient:
+    global _clients_loop
+    loop = asyncio.get_running_loop()
+    if _clients_loop is not loop:
+        # Клиент привязан к циклу событий, в котором открыты его соединения
+        _clients.clear()
+        _clients_loop = loop
+    client = _clients.get(proxy_url)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            proxy=proxy_url,
+            timeout=GEMINI_TIMEOUT,
+            limits=GEMINI_LIMITS,
+            http2=_HTTP2,
+            verify=True,
+        )
+        _clients[proxy_url] = client
+    return client
+
+
+async def close_clients() -> None:
+    """Закрывает пул HTTP-клиентов Gemini и процессы сжатия (при остановке бота/админки)."""
+    global _compress_executor
+    executor, _compress_executor = _compress_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning("[Gemini] Client close failed: %s", e)
 
 
-def _generate_sync(
-    api_key: str,
+def _build_image_payload(
     prompt: str,
-    images: list[bytes] | bytes,
+    images_b64: list[str],
     ref_image_bytes: bytes | None = None,
-    model_name: str | None = None,
     aspect_ratio: str | None = None,
-    key_id: int | None = None,
-    db_instance = None,
-    proxy_url: str | None = None,
-) -> Optional[bytes]:
-    # Используем gemini-3-pro-image-preview (NANO PRO) для всех категорий
-    endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3-pro-image-preview:generateContent?key={api_key}"
-    headers = {"Content-Type": "application/json"}
-
+) -> dict:
+    """Собирает тело generateContent из уже сжатых фото (base64)."""
     parts = []
-    
-    # Обработка основного изображения или списка изображений
-    if isinstance(images, bytes):
-        img_list = [images]
-    else:
-        img_list = images or []
-        
-    # ЛОГИРОВАНИЕ: Проверка размера первого фото
-    if img_list and len(img_list) > 0:
-        logger.info("[Gemini] First image size: %.2f KB", len(img_list[0]) / 1024)
 
-    # Сжимаем изображения для ускорения передачи через прокси
-    for i, img_bytes in enumerate(img_list, 1):
-        if img_bytes:
-            compressed = _compress_image(img_bytes)
+    for i, encoded in enumerate(images_b64, 1):
+        if encoded:
             if i == 1:
                 label = "[SCENE_AND_MODEL_REFERENCE_IMAGE]:"
             elif i == 2:
@@ -145,7 +252,7 @@ def _generate_sync(
             parts.append({
                 "inlineData": {
                     "mimeType": "image/jpeg",
-                    "data": base64.b64encode(compressed).decode("utf-8"),
+                    "data": encoded,
                 }
             })
             
@@ -190,14 +297,45 @@ def _generate_sync(
             {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
         ]
     }
+    return payload
+
+
+async def _generate_async(
+    api_key: str,
+    prompt: str,
+    images: list[bytes] | bytes,
+    ref_image_bytes: bytes | None = None,
+    model_name: str | None = None,
+    aspect_ratio: str | None = None,
+    key_id: int | None = None,
+    db_instance = None,
+    proxy_url: str | None = None,
+) -> Optional[bytes]:
+    # Используем gemini-3-pro-image-preview (NANO PRO) для всех категорий
+    endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3-pro-image-preview:generateContent?key={api_key}"
+    headers = {"Content-Type": "application/json"}
+
+    # Обработка основного изображения или списка изображений
+    if isinstance(images, bytes):
+        img_list = [images]
+    else:
+        img_list = images or []
+
+    # ЛОГИРОВАНИЕ: Проверка размера первого фото
+    if img_list and len(img_list) > 0:
+        logger.info("[Gemini] First image size: %.2f KB", len(img_list[0]) / 1024)
+
+    # Сжимаем изображения для ускорения передачи через прокси (результат кэшируется)
+    images_b64 = await asyncio.gather(*[_prepare_image(b) for b in img_list if b])
+    payload = _build_image_payload(prompt, images_b64, ref_image_bytes, aspect_ratio)
+    images_count = len(img_list)
 
     proxy_url_used = proxy_url if _valid_proxy(proxy_url or "") else None
-    timeout_cfg = httpx.Timeout(connect=30.0, read=600.0, write=60.0, pool=30.0)
 
     logger.info(
         "[Gemini] NANO PRO (v1beta generateContent) start: prompt_len=%d, images_count=%d, ref_img=%s, proxy=%s, model=gemini-3-pro-image-preview",
         len(prompt or ""),
-        len(img_list),
+        images_count,
         bool(ref_image_bytes),
         (proxy_url_used[:30] + "...") if proxy_url_used else "none",
     )
@@ -218,13 +356,11 @@ def _generate_sync(
             if attempt == 2:
                 use_proxy = None
                 logger.info("[Gemini] Retry without proxy")
-            with httpx.Client(proxy=use_proxy, timeout=timeout_cfg, verify=True) as client:
-                resp = client.post(endpoint, headers=headers, json=payload)
+            resp = await _get_client(use_proxy).post(endpoint, headers=headers, json=payload)
             if resp.status_code >= 500:
                 last_text = resp.text
                 logger.warning("[Gemini] 5xx on attempt %d: %s", attempt, (resp.text or '')[:200])
-                import time as _t
-                _t.sleep(1)
+                await asyncio.sleep(1)
                 continue
             break
         except (httpx.ProxyError, httpx.ConnectError, httpx.ReadTimeout, httpx.ConnectTimeout) as e:
@@ -234,8 +370,7 @@ def _generate_sync(
             logger.warning("[Gemini] proxy/network error on attempt %d: %s", attempt, e)
             if attempt == 1 and proxy_url_used:
                 continue
-            import time as _t
-            _t.sleep(1)
+            await asyncio.sleep(1)
         except httpx.HTTPError as e:
             last_exception = e
             last_text = str(e)
@@ -243,8 +378,7 @@ def _generate_sync(
             logger.warning("[Gemini] HTTP error on attempt %d: %s", attempt, e)
             if attempt == 1 and proxy_url_used:
                 continue
-            import time as _t
-            _t.sleep(1)
+            await asyncio.sleep(1)
     
     if resp is None or resp.status_code != 200:
         # Detailed diagnostics for non-200 responses
@@ -323,6 +457,61 @@ def _generate_sync(
     return None
 
 
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+# Результат больше порога держим не в памяти, а во временном файле
+RESULT_SPILL_BYTES = _env_int("RESULT_SPILL_BYTES", 16 * 1024 * 1024)
+
+
+class ImageResult:
+    """Результат generate_image: байты в памяти (data) или временный файл (path).
+
+    На диск результат попадает, только если он больше RESULT_SPILL_BYTES.
+    Telegram получает его через as_input_file() без чтения с диска; в историю
+    байты пишутся, а временный файл переносится.
+    """
+
+    __slots__ = ("data", "path", "size")
+
+    def __init__(self, data: bytes | None = None, path: str | None = None) -> None:
+        self.data = data
+        self.path = path
+        self.size = len(data) if data is not None else os.path.getsize(path)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, spill_bytes: int = RESULT_SPILL_BYTES) -> "ImageResult":
+        if len(data) <= spill_bytes:
+            return cls(data=data)
+        import uuid
+        _base = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        data_dir = os.path.join(_base, "data")
+        os.makedirs(data_dir, exist_ok=True)
+        path = os.path.join(data_dir, f"result_{uuid.uuid4()}.jpg")
+        with open(path, "wb") as f:
+            f.write(data)
+        return cls(path=path)
+
+    def as_input_file(self, filename: str):
+        from aiogram.types import BufferedInputFile, FSInputFile
+        if self.data is not None:
+            return BufferedInputFile(self.data, filename=filename)
+        return FSInputFile(self.path, filename=filename)
+
+    def discard(self) -> None:
+        """Удаляет временный файл, если результат не понадобился."""
+        if self.data is None and self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
 def is_proxy_error(e: Exception) -> bool:
     """Проверяет, является ли ошибка ошибкой прокси/сети"""
     return getattr(e, 'is_proxy_error', False)
@@ -338,13 +527,12 @@ async def generate_image(
     key_id: int | None = None,
     db_instance = None,
     images_bytes: list[bytes] = None,
-) -> Optional[str]:
+) -> Optional[ImageResult]:
     """
     Генерирует изображение через Gemini API.
     Принимает пути к файлам ИЛИ байты изображений напрямую.
+    Возвращает ImageResult (в памяти, крупный — во временном файле) или None.
     """
-    import uuid
-    
     # Если переданы пути, читаем их (для обратной совместимости)
     if not images_bytes:
         images_bytes = []
@@ -383,9 +571,7 @@ async def generate_image(
         except Exception as e:
             logger.error(f"[Gemini] Error getting proxies: {e}")
 
-    # Вызываем синхронную обертку
-    result_bytes = await asyncio.to_thread(
-        _generate_sync, 
+    result_bytes = await _generate_async(
         api_key, 
         final_prompt, 
         images_bytes, 
@@ -399,19 +585,15 @@ async def generate_image(
     
     if result_bytes:
         # Сжимаем для быстрой загрузки в Telegram (через прокси может быть медленно)
-        result_bytes = _compress_image(result_bytes)
-        _base = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        data_dir = os.path.join(_base, "data")
-        os.makedirs(data_dir, exist_ok=True)
-        out_path = os.path.join(data_dir, f"result_{uuid.uuid4()}.jpg")
-        with open(out_path, "wb") as f:
-            f.write(result_bytes)
-        return f"data/{os.path.basename(out_path)}"
+        result_bytes = await compress_image_async(result_bytes)
+        if len(result_bytes) > RESULT_SPILL_BYTES:
+            return await asyncio.to_thread(ImageResult.from_bytes, result_bytes)
+        return ImageResult(data=result_bytes)
         
     return None
 
 
-def _generate_text_sync(
+async def _generate_text_async(
     api_key: str,
     prompt: str,
     image_bytes: bytes,
@@ -437,34 +619,31 @@ def _generate_text_sync(
         "generationConfig": {"temperature": 0.1, "topK": 32, "topP": 1, "maxOutputTokens": 8192},
     }
 
-    proxies = _build_proxies(proxy_url)
-    session = requests.Session()
-    session.trust_env = False
+    proxy_url_used = proxy_url if _valid_proxy(proxy_url or "") else None
+    client = _get_client(proxy_url_used)
 
     logger.info(
         "[Gemini] text generation start: prompt_len=%d, img=%d, proxy=%s",
         len(prompt or ""),
         len(image_bytes or b""),
-        proxies or "none",
+        proxy_url_used or "none",
     )
 
     resp = None
     last_text = None
     for attempt in range(1, 4):
         try:
-            resp = session.post(endpoint, headers=headers, json=payload, timeout=90, proxies=proxies or None)
+            resp = await client.post(endpoint, headers=headers, json=payload, timeout=90)
             if resp.status_code >= 500:
                 last_text = resp.text
                 logger.warning("[Gemini] 5xx on attempt %d: %s", attempt, (resp.text or '')[:200])
-                import time as _t
-                _t.sleep(2 * attempt)
+                await asyncio.sleep(2 * attempt)
                 continue
             break
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             last_text = str(e)
             logger.warning("[Gemini] network error on attempt %d: %s", attempt, e)
-            import time as _t
-            _t.sleep(2 * attempt)
+            await asyncio.sleep(2 * attempt)
     if resp is None or resp.status_code != 200:
         body_text = (getattr(resp, 'text', None) or last_text or '')
         snippet = (body_text or '')[:1000]
@@ -495,7 +674,7 @@ async def generate_text(
             active_proxies = await db_instance.get_active_proxies_urls()
             if active_proxies:
                 import random
-                selected_proxy = random.choice(active_proxies)
+                selected_proxy = _normalize_proxy_for_httpx(random.choice(active_proxies))
         except Exception: pass
 
-    return await asyncio.to_thread(_generate_text_sync, api_key, prompt, image_bytes, selected_proxy)
+    return await _generate_text_async(api_key, prompt, image_bytes, selected_proxy)
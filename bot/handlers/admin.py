@@ -12,8 +12,11 @@ import logging
 import requests
 import os
 
-from bot.config import Settings, load_settings
+from bot.broadcast import KIND_COPY, KIND_MEDIA, BroadcastEngine
+from bot.concurrency import snapshot as concurrency_snapshot
+from bot.config import Settings
 from bot.db import Database
+from bot.pagination import decode_cursor, encode_cursor
 
 logger = logging.getLogger(__name__)
 from bot.keyboards import (
@@ -48,7 +51,7 @@ router = Router()
 
 
 def _is_admin(user_id: int, settings: Settings) -> bool:
-    return user_id in (settings.admin_ids or [])
+    return user_id in settings.admin_ids
 
 
 async def _safe_answer(callback: CallbackQuery, text: str | None = None, show_alert: bool = False) -> None:
@@ -135,6 +138,11 @@ async def admin_stats(callback: CallbackQuery, db: Database, settings: Settings)
         f"{get_string('admin_stats_total_generations', lang)}: {stats.get('total_generations', 0)}\n"
         f"{get_string('admin_stats_today_generations', lang)}: {stats.get('today_generations', 0)}\n"
     )
+    runtime = concurrency_snapshot()
+    if runtime:
+        text += "\n" + get_string("admin_stats_runtime", lang) + "\n"
+        for name, values in runtime.items():
+            text += f"<code>{name}</code>: " + ", ".join(f"{k}={v}" for k, v in values.items()) + "\n"
     try:
         await callback.message.edit_text(text, reply_markup=admin_main_keyboard(lang))
     except TelegramBadRequest:
@@ -236,8 +244,17 @@ async def admin_user_search_finish(message: Message, state: FSMContext, db: Data
     try:
         uid = int(txt)
     except Exception:
-        await message.answer(get_string("admin_enter_id_error", lang))
-        return
+        # Не число — ищем по username/имени (FTS), несколько совпадений показываем списком
+        found = await db.search_users(txt, limit=PAGE_SIZE)
+        if not found:
+            await message.answer(get_string("admin_enter_id_error", lang))
+            return
+        if len(found) > 1:
+            users = await db.list_users_by_ids(found)
+            await state.clear()
+            await message.answer(get_string("admin_users_list", lang), reply_markup=admin_users_keyboard(users, None, None, lang))
+            return
+        uid = found[0]
     blocked = await db.get_user_blocked(uid)
     state_txt = get_string("admin_block", lang) if blocked else get_string("admin_unblock", lang)
     text = get_string("admin_user_title", lang, uid=uid) + f"\n{get_string('admin_user_status', lang, status=state_txt)}"
@@ -254,17 +271,24 @@ async def admin_users_page(callback: CallbackQuery, db: Database, settings: Sett
         await _safe_answer(callback)
         return
     lang = await db.get_user_language(callback.from_user.id)
-    try:
-        page = int(callback.data.split(":", 1)[1])
-    except Exception:
-        page = 0
-    offset = page * PAGE_SIZE
-    users = await db.list_users_page(offset=offset, limit=PAGE_SIZE + 1)
-    has_next = len(users) > PAGE_SIZE
-    users_page = users[:PAGE_SIZE]
+    # admin_users_page:0 — первая страница, :n:<курсор> — дальше, :p:<курсор> — назад
+    parts = callback.data.split(":", 2)
+    direction = parts[1] if len(parts) > 2 else ""
+    cursor = decode_cursor(parts[2]) if len(parts) > 2 else None
+    if cursor is not None and direction == "p":
+        users = await db.list_users_page(limit=PAGE_SIZE + 1, before=cursor)
+        has_prev, has_next = len(users) > PAGE_SIZE, True
+        users = users[-PAGE_SIZE:]
+    else:
+        users = await db.list_users_page(limit=PAGE_SIZE + 1, after=cursor)
+        has_prev, has_next = cursor is not None, len(users) > PAGE_SIZE
+        users = users[:PAGE_SIZE]
+    prev_cursor = encode_cursor(users[0][3], users[0][0]) if users and has_prev else None
+    next_cursor = encode_cursor(users[-1][3], users[-1][0]) if users and has_next else None
+    users_page = [(uid, username, blocked) for uid, username, blocked, _ in users]
     text = get_string("admin_users_list", lang)
     try:
-        await callback.message.edit_text(text, reply_markup=admin_users_keyboard(users_page, page, has_next, lang))
+        await callback.message.edit_text(text, reply_markup=admin_users_keyboard(users_page, prev_cursor, next_cursor, lang))
     except TelegramBadRequest:
         pass
     await _safe_answer(callback)
@@ -1128,7 +1152,6 @@ async def cmd_rebind_photos(message: Message, db: Database, settings: Settings,
             new_id = sent.photo[-1].file_id
             await db.set_model_photo(model_id, new_id)
             updated += 1
-            await asyncio.sleep(0.1)
         except Exception:
             failed += 1
             continue
@@ -1137,14 +1160,19 @@ async def cmd_rebind_photos(message: Message, db: Database, settings: Settings,
 
 
 @router.message(Command("all"))
-async def cmd_broadcast(message: Message, db: Database, settings: Settings, bot: Bot, state: FSMContext) -> None:
+async def cmd_broadcast(
+    message: Message, db: Database, settings: Settings, state: FSMContext, broadcasts: Optional[BroadcastEngine] = None
+) -> None:
     if not _is_admin(message.from_user.id, settings):
         return
     lang = await db.get_user_language(message.from_user.id)
     # 1) Если команда отправлена ответом на сообщение — рассылаем это сообщение
     if message.reply_to_message:
-        await _broadcast_forward(bot, db, message.reply_to_message)
-        await message.answer(get_string("admin_broadcast_done", lang))
+        src = message.reply_to_message
+        job_id = await _start_broadcast(
+            db, broadcasts, KIND_COPY, {"from_chat_id": src.chat.id, "message_id": src.message_id}, message.from_user.id
+        )
+        await message.answer(get_string("admin_broadcast_started", lang, id=job_id))
         return
     # 2) Мастер-режим: просим прислать текст (или переданный аргумент)
     await state.set_state(BroadcastState.waiting_message)
@@ -1217,55 +1245,50 @@ async def on_broadcast_cancel(callback: CallbackQuery, state: FSMContext, settin
     await _safe_answer(callback)
 
 @router.callback_query(F.data == "broadcast_send")
-async def on_broadcast_send(callback: CallbackQuery, state: FSMContext, db: Database, settings: Settings, bot: Bot) -> None:
+async def on_broadcast_send(
+    callback: CallbackQuery, state: FSMContext, db: Database, settings: Settings, broadcasts: Optional[BroadcastEngine] = None
+) -> None:
     if not _is_admin(callback.from_user.id, settings):
         await _safe_answer(callback)
         return
     lang = await db.get_user_language(callback.from_user.id)
     data = await state.get_data()
-    text = data.get("bc_text") or ""
-    photo = data.get("bc_photo")
-    video = data.get("bc_video")
+    payload = {"text": data.get("bc_text") or "", "photo": data.get("bc_photo"), "video": data.get("bc_video")}
     await state.clear()
     try:
-        await _broadcast_send(bot, db, text, photo, video)
-        await _replace_with_text(callback, get_string("admin_broadcast_success", lang))
+        job_id = await _start_broadcast(db, broadcasts, KIND_MEDIA, payload, callback.from_user.id)
+        await _replace_with_text(callback, get_string("admin_broadcast_started", lang, id=job_id))
     except Exception as e:
         await _replace_with_text(callback, get_string("admin_broadcast_error", lang, e=e))
     await _safe_answer(callback)
 
 
-async def _broadcast_text(bot: Bot, db: Database, text: str) -> None:
-    user_ids = await db.list_all_user_ids()
-    for uid in user_ids:
-        try:
-            await bot.send_message(chat_id=uid, text=text)
-            await asyncio.sleep(0.03)
-        except Exception:
-            continue
+@router.message(Command("stop_broadcast"))
+async def cmd_stop_broadcast(message: Message, db: Database, settings: Settings) -> None:
+    if not _is_admin(message.from_user.id, settings):
+        return
+    lang = await db.get_user_language(message.from_user.id)
+    parts = (message.text or "").split()
+    if len(parts) < 2 or not parts[1].lstrip("#").isdigit():
+        await message.answer(get_string("admin_broadcast_stop_usage", lang))
+        return
+    job_id = int(parts[1].lstrip("#"))
+    # Движок увидит статус при следующей записи прогресса и остановится
+    if await db.cancel_broadcast_job(job_id):
+        await message.answer(get_string("admin_broadcast_cancelled", lang, id=job_id))
+    else:
+        await message.answer(get_string("admin_broadcast_not_running", lang, id=job_id))
 
-async def _broadcast_send(bot: Bot, db: Database, text: str, photo_file_id: Optional[str], video_file_id: Optional[str]) -> None:
-    user_ids = await db.list_all_user_ids()
-    for uid in user_ids:
-        try:
-            if video_file_id:
-                await bot.send_video(chat_id=uid, video=video_file_id, caption=text or "")
-            elif photo_file_id:
-                await bot.send_photo(chat_id=uid, photo=photo_file_id, caption=text or "")
-            else:
-                await bot.send_message(chat_id=uid, text=text or "")
-            await asyncio.sleep(0.03)
-        except Exception:
-            continue
 
-async def _broadcast_forward(bot: Bot, db: Database, src_msg: Message) -> None:
-    user_ids = await db.list_all_user_ids()
-    for uid in user_ids:
-        try:
-            await bot.copy_message(chat_id=uid, from_chat_id=src_msg.chat.id, message_id=src_msg.message_id)
-            await asyncio.sleep(0.03)
-        except Exception:
-            continue
+async def _start_broadcast(
+    db: Database, broadcasts: Optional[BroadcastEngine], kind: str, payload: dict, admin_id: int
+) -> int:
+    """Ставит рассылку в очередь (bot/broadcast.py). Отчёт придёт админу по завершении."""
+    job_id = await db.create_broadcast_job(kind, payload, created_by=admin_id)
+    # В webhook-режиме движок работает в одном воркере — остальные найдут задание опросом
+    if broadcasts is not None:
+        broadcasts.wake()
+    return job_id
 
 
 @router.callback_query(F.data.startswith("admin_user:"))
@@ -1325,7 +1348,6 @@ async def admin_user_history(callback: CallbackQuery, settings: Settings, db: Da
                     await callback.message.answer(caption, parse_mode="Markdown")
         except Exception:
             await callback.message.answer(caption, parse_mode="Markdown")
-        await asyncio.sleep(0.1)
 
     await _safe_answer(callback)
 
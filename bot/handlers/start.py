@@ -1,6 +1,5 @@
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.types import BufferedInputFile
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import CommandStart
 from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
@@ -50,29 +49,37 @@ from bot.keyboards import (
     infographic_gender_keyboard,
     infographic_style_keyboard,
     yes_no_keyboard,
+    gen_queue_keyboard,
 )
-from bot.db import Database
+from bot.db import Database, UserProfile
+from bot.media_group import MediaGroupMiddleware
+from bot.progress import EDIT_STEPS, GENERATION_STEPS, progress_ticker
+from bot.membership_cache import MembershipCache
+from bot.file_cache import telegram_file_cache
+from bot.archive import ArchiveJob, history_archiver
+from bot.concurrency import BoundedDedup, LockRegistry, register
+from bot.scheduler import GenerationCancelled, QueueFull, generation_scheduler
 from bot.strings import get_string
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from bot.config import load_settings
+from bot.config import Settings, get_settings
 from bot.gemini import generate_image, generate_text
 import asyncio
-import time
 from asyncio import Lock
-from aiogram.enums import ChatAction
 
 state_lock = Lock()
 import logging
 import os
 import json
-import aiosqlite
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 logger = logging.getLogger(__name__)
 
 
 router = Router()
+# Альбомы для хендлеров с флагом media_group приходят одной пачкой (data["album"])
+media_group_middleware = register("media_groups", MediaGroupMiddleware())
+router.message.middleware(media_group_middleware)
 
  
 class CreateForm(StatesGroup):
@@ -253,44 +260,6 @@ async def _ask_garment_length(message_or_callback: Message | CallbackQuery, stat
         await message_or_callback.answer(text, reply_markup=kb)
 
 
-async def _run_generation_progress(bot, chat_id: int, message_id: int, stop_event: asyncio.Event) -> None:
-    start_time = time.time()
-    steps_text = [
-        "Изучаю ваш запрос",
-        "Обрабатываю детали",
-        "Применяю нейронные фильтры",
-        "Улучшаю качество",
-        "Финализирую"
-    ]
-    total_steps = 5
-    step = 1
-    try:
-        while not stop_event.is_set() and step <= total_steps:
-            for sub in range(4):
-                if stop_event.is_set(): break
-                elapsed = int(time.time() - start_time)
-                progress = int(((step - 1) / total_steps + (sub / 4) / total_steps) * 100)
-                if progress > 99: progress = 99
-                
-                filled = int(progress / 10)
-                bar = "🟦" * filled + "⬜️" * (10 - filled)
-                
-                text = (
-                    f"🚀 Генерация\n\n"
-                    f"{steps_text[step-1]}\n\n"
-                    f"{bar} {progress}%\n\n"
-                    f"Прошло: {elapsed}с • Шаг {step}/{total_steps}\n\n"
-                    f"Результат вас приятно удивит"
-                )
-                try:
-                    await bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_PHOTO)
-                    await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
-                except: pass
-                await asyncio.sleep(1.5)
-            step += 1
-    except: pass
-
-
 async def _answer_model_photo(callback: CallbackQuery, photo: str, caption: str, reply_markup=None) -> Message | None:
     from aiogram.types import InputMediaPhoto, FSInputFile
     import os
@@ -345,18 +314,18 @@ async def on_child_gender_select(callback: CallbackQuery, state: FSMContext, db:
     await _safe_answer(callback)
 
 
-async def _check_subscription(user_id: int, bot: Bot, db: Database) -> bool:
-    """Проверяет подписку пользователя на обязательный канал"""
-    channel_id = await db.get_app_setting("required_channel_id")
-    if not channel_id:
-        return True 
+membership_cache = MembershipCache()
+
+
+async def _fetch_subscription(user_id: int, channel_id: str, bot: Bot) -> tuple[bool, float | None]:
+    """Запрос в Telegram. Возвращает (подписан, TTL для кэша; None — TTL по умолчанию)."""
     try:
         # Пытаемся получить статус участника
         member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
         # Статусы, которые считаются "подписан"
         is_subbed = member.status in ("member", "administrator", "creator")
         logger.info(f"Subscription check for {user_id} in {channel_id}: {member.status} (is_subbed: {is_subbed})")
-        return is_subbed
+        return is_subbed, None
     except Exception as e:
         err_msg = str(e).lower()
         logger.error(f"Error checking subscription for {user_id} in {channel_id}: {e}")
@@ -364,14 +333,31 @@ async def _check_subscription(user_id: int, bot: Bot, db: Database) -> bool:
         # Если ошибка "chat not found", значит ID канала неверный или бот не в канале
         if "chat not found" in err_msg:
             logger.error(f"CRITICAL: Required channel {channel_id} not found. Check if bot is admin there.")
-            return False
+            return False, None
         
         # Если ошибка "member not found", значит пользователь точно не подписан
         if "user not found" in err_msg or "member not found" in err_msg:
-            return False
+            return False, None
             
-        # Для остальных ошибок (например, временный сбой) разрешаем, чтобы не блокировать сервис
-        return True
+        # Для остальных ошибок (например, временный сбой) разрешаем, чтобы не блокировать сервис,
+        # но кэшируем ненадолго, чтобы перепроверить после сбоя
+        return True, membership_cache.negative_ttl
+
+
+async def _check_subscription(user_id: int, bot: Bot, db: Database) -> bool:
+    """Проверяет подписку пользователя на обязательный канал"""
+    channel_id = await db.get_app_setting("required_channel_id")
+    if not channel_id:
+        return True 
+    cached = membership_cache.get(channel_id, user_id)
+    if cached is not None:
+        is_subbed, needs_refresh = cached
+        if needs_refresh:
+            membership_cache.refresh(channel_id, user_id, lambda: _fetch_subscription(user_id, channel_id, bot))
+        return is_subbed
+    is_subbed, ttl = await _fetch_subscription(user_id, channel_id, bot)
+    membership_cache.put(channel_id, user_id, is_subbed, ttl)
+    return is_subbed
 
 async def _show_confirmation(message_or_callback: Message | CallbackQuery, state: FSMContext, db: Database) -> None:
     """Показывает сводку параметров и кнопку создания фото"""
@@ -843,35 +829,34 @@ async def on_dynamic_option(callback: CallbackQuery, state: FSMContext, db: Data
         try:
             opt_id = int(val)
             # Нам нужно получить value и custom_prompt из step_options
-            import aiosqlite
-            async with aiosqlite.connect(db._db_path) as conn:
+            async with db._read() as conn:
                 async with conn.execute("SELECT option_text, option_value, custom_prompt FROM step_options WHERE id=?", (opt_id,)) as cur:
                     row = await cur.fetchone()
-                    if row:
-                        opt_text, opt_val, custom_prompt = row
-                        
-                        if opt_val == "back":
-                            await on_back_step(callback, state, db)
-                            await _safe_answer(callback)
-                            return
-
-                        if opt_val == "skip":
-                            # Пропускаем шаг без сохранения ответа
-                            opt_text = None
-                            opt_val = None
-
-                        if custom_prompt:
-                            # Если есть кастомный промпт — запрашиваем ввод текста
-                            await state.update_data(waiting_custom_for=step_key)
-                            await _replace_with_text(callback, custom_prompt, reply_markup=back_step_keyboard(lang))
-                            await _safe_answer(callback)
-                            return
-                        
-                        if opt_val is not None:
-                            # Иначе просто сохраняем значение
-                            await state.update_data({step_key: opt_val})
-                            # Также сохраняем человекочитаемое название для сводки
-                            await state.update_data({f"{step_key}_label": opt_text})
+            if row:
+                opt_text, opt_val, custom_prompt = row
+                
+                if opt_val == "back":
+                    await on_back_step(callback, state, db)
+                    await _safe_answer(callback)
+                    return
+
+                if opt_val == "skip":
+                    # Пропускаем шаг без сохранения ответа
+                    opt_text = None
+                    opt_val = None
+
+                if custom_prompt:
+                    # Если есть кастомный промпт — запрашиваем ввод текста
+                    await state.update_data(waiting_custom_for=step_key)
+                    await _replace_with_text(callback, custom_prompt, reply_markup=back_step_keyboard(lang))
+                    await _safe_answer(callback)
+                    return
+                
+                if opt_val is not None:
+                    # Иначе просто сохраняем значение
+                    await state.update_data({step_key: opt_val})
+                    # Также сохраняем человекочитаемое название для сводки
+                    await state.update_data({f"{step_key}_label": opt_text})
         except ValueError:
             # На случай если пришло не число (старый формат или ошибка)
             await state.update_data({step_key: val})
@@ -989,6 +974,8 @@ async def on_accept_terms(callback: CallbackQuery, db: Database, bot: Bot) -> No
 @router.callback_query(F.data == "check_subscription")
 async def on_check_subscription(callback: CallbackQuery, db: Database, bot: Bot) -> None:
     """Обработчик кнопки 'Я подписался'"""
+    # Пользователь только что подписался — кэшированный отрицательный ответ больше не верен
+    membership_cache.invalidate(callback.from_user.id)
     if await _ensure_access(callback, db, bot):
         lang = await db.get_user_language(callback.from_user.id)
         await _replace_with_text(callback, get_string("main_menu_title", lang), reply_markup=main_menu_keyboard(lang))
@@ -1017,12 +1004,12 @@ async def on_back_main(callback: CallbackQuery, state: FSMContext, db: Database)
 
 
 @router.callback_query(F.data == "menu_create")
-async def on_create_photo(callback: CallbackQuery, db: Database, state: FSMContext) -> None:
+async def on_create_photo(callback: CallbackQuery, db: Database, state: FSMContext, settings: Settings | None = None) -> None:
     lang = await db.get_user_language(callback.from_user.id)
     # Техработы: блокируем для не-админов
     if await db.get_maintenance():
-        settings = load_settings()
-        if callback.from_user.id not in (settings.admin_ids or []):
+        settings = settings or get_settings()
+        if callback.from_user.id not in settings.admin_ids:
             await _safe_answer(callback, get_string("maintenance_alert", lang), show_alert=True)
             return
     balance = await db.get_user_balance(callback.from_user.id)
@@ -1045,12 +1032,12 @@ async def on_create_photo(callback: CallbackQuery, db: Database, state: FSMConte
 
 
 @router.callback_query(F.data == "menu_market")
-async def on_marketplace_menu(callback: CallbackQuery, db: Database) -> None:
+async def on_marketplace_menu(callback: CallbackQuery, db: Database, settings: Settings | None = None) -> None:
     lang = await db.get_user_language(callback.from_user.id)
     # Техработы
     if await db.get_maintenance():
-        settings = load_settings()
-        if callback.from_user.id not in (settings.admin_ids or []):
+        settings = settings or get_settings()
+        if callback.from_user.id not in settings.admin_ids:
             await _safe_answer(callback, get_string("maintenance_alert", lang), show_alert=True)
             return
     balance = await db.get_user_balance(callback.from_user.id)
@@ -1069,13 +1056,15 @@ async def on_marketplace_menu(callback: CallbackQuery, db: Database) -> None:
     await _safe_answer(callback)
 
 
-async def _ensure_access(message_or_callback: Message | CallbackQuery, db: Database, bot: Bot) -> bool:
+async def _ensure_access(message_or_callback: Message | CallbackQuery, db: Database, bot: Bot, profile: UserProfile | None = None, settings: Settings | None = None) -> bool:
     """Проверяет условия доступа (соглашение и подписка) и выводит нужный экран"""
     user_id = message_or_callback.from_user.id
-    lang = await db.get_user_language(user_id)
+    if profile is None:
+        profile = await db.get_user_profile(user_id)
+    lang = profile.lang
     from bot.keyboards import terms_keyboard, subscription_check_keyboard
     
-    # 1. Сначала Блокировка
+    # 1. Сначала Блокировка (из БД, а не из кэша профиля: её меняет админка)
     if await db.get_user_blocked(user_id):
         text = get_string("user_blocked", lang)
         if isinstance(message_or_callback, Message):
@@ -1085,14 +1074,13 @@ async def _ensure_access(message_or_callback: Message | CallbackQuery, db: Datab
         return False
 
     # 2. Проверка администратора (админы проходят мимо подписки и соглашения)
-    settings = load_settings()
-    if user_id in (settings.admin_ids or []):
+    settings = settings or get_settings()
+    if user_id in settings.admin_ids:
         logger.info(f"Admin {user_id} bypasses access checks")
         return True
 
     # 3. Потом Соглашение
-    accepted = await db.get_user_accepted_terms(user_id)
-    if not accepted:
+    if not profile.accepted_terms:
         text = get_string("start_welcome", lang)
         if isinstance(message_or_callback, Message):
             await message_or_callback.answer(text, reply_markup=terms_keyboard(lang))
@@ -1118,15 +1106,15 @@ async def _ensure_access(message_or_callback: Message | CallbackQuery, db: Datab
     return True
 
 @router.callback_query(F.data.startswith("create_cat:"))
-async def on_create_category_universal(callback: CallbackQuery, db: Database, state: FSMContext) -> None:
+async def on_create_category_universal(callback: CallbackQuery, db: Database, state: FSMContext, settings: Settings | None = None) -> None:
     """Универсальный обработчик выбора категории, поддерживающий динамические шаги"""
     cat_key = callback.data.split(":")[1]
     lang = await db.get_user_language(callback.from_user.id)
 
     # Техработы
     if await db.get_maintenance():
-        settings = load_settings()
-        if callback.from_user.id not in (settings.admin_ids or []):
+        settings = settings or get_settings()
+        if callback.from_user.id not in settings.admin_ids:
             await _safe_answer(callback, get_string("maintenance_alert", lang), show_alert=True)
             return
             
@@ -1550,10 +1538,10 @@ async def on_rand_other_style_custom(message: Message, state: FSMContext, db: Da
 
 
 @router.callback_query(F.data == "create_cat:storefront")
-async def on_storefront_category(callback: CallbackQuery, db: Database, state: FSMContext) -> None:
+async def on_storefront_category(callback: CallbackQuery, db: Database, state: FSMContext, settings: Settings | None = None) -> None:
     if await db.get_maintenance():
-        settings = load_settings()
-        if callback.from_user.id in (settings.admin_ids or []): pass
+        settings = settings or get_settings()
+        if callback.from_user.id in settings.admin_ids: pass
         else:
             await _safe_answer(callback, get_string("maintenance_alert", await db.get_user_language(callback.from_user.id)), show_alert=True)
             return
@@ -1572,8 +1560,8 @@ async def on_storefront_category(callback: CallbackQuery, db: Database, state: F
 
 async def on_whitebg_category(callback: CallbackQuery, db: Database, state: FSMContext) -> None:
     if await db.get_maintenance():
-        settings = load_settings()
-        if callback.from_user.id not in (settings.admin_ids or []):
+        settings = get_settings()
+        if callback.from_user.id not in settings.admin_ids:
             await _safe_answer(callback, get_string("maintenance_alert", await db.get_user_language(callback.from_user.id)), show_alert=True)
             return
     if not await db.get_category_enabled("whitebg"):
@@ -1630,8 +1618,8 @@ async def on_infographics_menu(callback: CallbackQuery, db: Database) -> None:
 
 async def on_infographic_category(callback: CallbackQuery, state: FSMContext, db: Database) -> None:
     if await db.get_maintenance():
-        settings = load_settings()
-        if callback.from_user.id not in (settings.admin_ids or []):
+        settings = get_settings()
+        if callback.from_user.id not in settings.admin_ids:
             await _safe_answer(callback, get_string("maintenance_alert", await db.get_user_language(callback.from_user.id)), show_alert=True)
             return
     cat = callback.data.split(":")[1]
@@ -1910,8 +1898,8 @@ async def on_has_person_selected(callback: CallbackQuery, state: FSMContext, db:
 async def on_create_own(callback: CallbackQuery, state: FSMContext, db: Database) -> None:
     # Техработы: блокируем для не-админов
     if await db.get_maintenance():
-        settings = load_settings()
-        if callback.from_user.id not in (settings.admin_ids or []):
+        settings = get_settings()
+        if callback.from_user.id not in settings.admin_ids:
             await _safe_answer(callback, "Идут техработы. Пожалуйста, попробуйте позже.", show_alert=True)
             return
     # Категория может быть выключена в админке
@@ -1929,8 +1917,8 @@ async def on_create_own(callback: CallbackQuery, state: FSMContext, db: Database
 # Own Background Variant Flow
 async def on_create_own_variant(callback: CallbackQuery, state: FSMContext, db: Database) -> None:
     if await db.get_maintenance():
-        settings = load_settings()
-        if callback.from_user.id not in (settings.admin_ids or []):
+        settings = get_settings()
+        if callback.from_user.id not in settings.admin_ids:
             await _safe_answer(callback, get_string("maintenance_alert", await db.get_user_language(callback.from_user.id)), show_alert=True)
             return
     if not await db.get_category_enabled("own_variant"):
@@ -2864,36 +2852,30 @@ async def on_info_pose(callback: CallbackQuery, state: FSMContext, db: Database)
 
 
 
-from collections import defaultdict
-
-# Словар замков для каждого пользователя, чтобы избежать race condition
-user_locks = defaultdict(asyncio.Lock)
-# Замки для генерации (чтобы не запускать две параллельно)
-gen_locks = defaultdict(asyncio.Lock)
+# Замки для каждого пользователя, чтобы избежать race condition (удаляются, когда не нужны)
+user_locks = register("photo_user_locks", LockRegistry())
 # Кэш обработанных сообщений, чтобы не считать одно фото дважды (race condition на стороне TG)
-processed_msg_ids = set()
+processed_msg_ids = register("photo_msg_dedup", BoundedDedup(max_size=10000, ttl=600))
 
-@router.message(CreateForm.waiting_view, F.photo)
-async def handle_user_photo(message: Message, state: FSMContext, db: Database) -> None:
+@router.message(CreateForm.waiting_view, F.photo, flags={"media_group": True})
+async def handle_user_photo(
+    message: Message, state: FSMContext, db: Database, album: list[Message] | None = None
+) -> None:
     user_id = message.from_user.id
-    msg_id = message.message_id
+    # Альбом приходит одной пачкой (MediaGroupMiddleware); message_id уникален только внутри чата
+    messages = album or [message]
     
     # 1. Быстрая проверка на дубликат сообщения (вне лока для скорости)
-    if msg_id in processed_msg_ids:
+    if all((m.chat.id, m.message_id) in processed_msg_ids for m in messages):
         return
     
     # Используем индивидуальный замок для каждого пользователя
-    async with user_locks[user_id]:
+    async with user_locks.hold(user_id):
         # Повторная проверка внутри замка
-        if msg_id in processed_msg_ids:
+        messages = [m for m in messages if m.photo and processed_msg_ids.add((m.chat.id, m.message_id))]
+        if not messages:
             return
-        processed_msg_ids.add(msg_id)
-        # Очищаем старые ID (держим последние 100)
-        if len(processed_msg_ids) > 100:
-            list(processed_msg_ids)[:50] 
-
-        # Даем микро-паузу для MemoryStorage (aiogram 3 sync)
-        await asyncio.sleep(0.05)
+        message = messages[0]
         
         data = await state.get_data()
         current_state = await state.get_state()
@@ -2909,12 +2891,13 @@ async def handle_user_photo(message: Message, state: FSMContext, db: Database) -
 
         # --- ОБЫЧНАЯ ГЕНЕРАЦИЯ ---
         if data.get("normal_gen_mode"):
-            photos = data.get("photos") or []
+            photos = list(data.get("photos") or [])
             
-            # Добавляем фото, если его еще нет в списке
-            if photo_id not in photos:
-                photos.append(photo_id)
-                photos = photos[:4]
+            # Добавляем фото, если их еще нет в списке (весь альбом — одним обновлением)
+            new_ids = [m.photo[-1].file_id for m in messages]
+            new_ids = [fid for fid in new_ids if fid not in photos]
+            if new_ids:
+                photos = (photos + new_ids)[:4]
                 # ВАЖНО: Сначала обновляем данные в state
                 await state.update_data(photos=photos)
                 # И сразу же обновляем локальную переменную data для консистентности
@@ -3803,15 +3786,63 @@ SCENE DESCRIPTION (USE FOR BACKGROUND AND MODEL ONLY, IGNORE CLOTHES): {prompt_t
 async def form_generate(callback: CallbackQuery, state: FSMContext, db: Database) -> None:
     await _do_generate(callback, state, db)
 
-async def _do_generate(message_or_callback: Message | CallbackQuery, state: FSMContext, db: Database) -> None:
+async def _run_scheduled(message_or_callback: Message | CallbackQuery, db: Database, job, busy_text: str | None = None) -> None:
+    """Выполняет job() в слоте общего планировщика генераций.
+
+    Если все линии заняты — сообщает место в очереди с кнопкой отмены.
+    busy_text отправляется, когда у пользователя уже есть генерация (иначе повтор молча игнорируется).
+    """
     user_id = message_or_callback.from_user.id
-    if gen_locks[user_id].locked():
-        logger.warning(f"[_do_generate] Пропуск: Генерация для {user_id} уже выполняется.")
-        if isinstance(message_or_callback, CallbackQuery):
+    is_callback = isinstance(message_or_callback, CallbackQuery)
+    ans_obj = message_or_callback.message if is_callback else message_or_callback
+    lang = await db.get_user_language(user_id)
+    queue_msg = None
+
+    async def _on_queued(position: int) -> None:
+        nonlocal queue_msg
+        if is_callback:
             await _safe_answer(message_or_callback)
-        return
-    async with gen_locks[user_id]:
-        await _do_generate_real(message_or_callback, state, db)
+        queue_msg = await ans_obj.answer(
+            get_string("gen_queued", lang, position=position),
+            reply_markup=gen_queue_keyboard(lang),
+        )
+
+    try:
+        async with generation_scheduler.slot(user_id, on_queued=_on_queued):
+            if queue_msg:
+                try: await queue_msg.delete()
+                except: pass
+            await job()
+    except QueueFull as e:
+        if e.reason == "user":
+            logger.warning(f"[generation] Пропуск: генерация для {user_id} уже выполняется или в очереди.")
+            if busy_text:
+                await ans_obj.answer(busy_text)
+            elif is_callback:
+                await _safe_answer(message_or_callback)
+            return
+        text = get_string("gen_queue_full", lang)
+        if is_callback:
+            await _safe_answer(message_or_callback, text, show_alert=True)
+        else:
+            await ans_obj.answer(text)
+    except GenerationCancelled:
+        if queue_msg:
+            try: await queue_msg.edit_text(get_string("gen_queue_cancelled", lang))
+            except: pass
+
+
+@router.callback_query(F.data == "gen_cancel")
+async def on_gen_cancel(callback: CallbackQuery) -> None:
+    generation_scheduler.cancel(callback.from_user.id)
+    await _safe_answer(callback)
+
+
+async def _do_generate(message_or_callback: Message | CallbackQuery, state: FSMContext, db: Database) -> None:
+    await _run_scheduled(
+        message_or_callback, db,
+        lambda: _do_generate_real(message_or_callback, state, db),
+    )
 
 async def _do_generate_real(message_or_callback: Message | CallbackQuery, state: FSMContext, db: Database) -> None:
     user_id = message_or_callback.from_user.id
@@ -3828,8 +3859,8 @@ async def _do_generate_real(message_or_callback: Message | CallbackQuery, state:
 
     # Проверка техработ
     if await db.get_maintenance():
-        settings = load_settings()
-        if user_id not in (settings.admin_ids or []):
+        settings = get_settings()
+        if user_id not in settings.admin_ids:
             lang = await db.get_user_language(user_id)
             if isinstance(message_or_callback, CallbackQuery):
                 await _safe_answer(message_or_callback, get_string("maintenance_alert", lang), show_alert=True)
@@ -3867,7 +3898,7 @@ async def _do_generate_real(message_or_callback: Message | CallbackQuery, state:
         model_id = data.get("model_id")
         bg = None
         if model_id:
-            async with aiosqlite.connect(db._db_path) as conn:
+            async with db._read() as conn:
                 async with conn.execute("SELECT photo_file_id FROM models WHERE id=?", (model_id,)) as cur:
                     row = await cur.fetchone()
                     if row: bg = row[0]
@@ -3889,7 +3920,7 @@ async def _do_generate_real(message_or_callback: Message | CallbackQuery, state:
         if not ref:
             model_id = data.get("model_id")
             if model_id:
-                async with aiosqlite.connect(db._db_path) as conn:
+                async with db._read() as conn:
                     async with conn.execute("SELECT photo_file_id FROM models WHERE id=?", (model_id,)) as cur:
                         row = await cur.fetchone()
                         if row: ref = row[0]
@@ -3974,51 +4005,13 @@ async def _do_generate_real(message_or_callback: Message | CallbackQuery, state:
         # Отправляем сообщение о начале генерации с анимацией
         process_msg = await ans_obj.answer("🎨 ⚡️ ⏳")
         
-        async def animate_gen(msg, lang_code):
-            start_time = time.time()
-            steps_text = [
-                "Изучаю ваш запрос",
-                "Обрабатываю детали",
-                "Применяю нейронные фильтры",
-                "Улучшаю качество",
-                "Финализирую"
-            ]
-            total_steps = 5
-            try:
-                for step in range(1, total_steps + 1):
-                    for sub in range(4):
-                        elapsed = int(time.time() - start_time)
-                        progress = int(((step - 1) / total_steps + (sub / 4) / total_steps) * 100)
-                        if progress > 99: progress = 99
-                        filled = int(progress / 10)
-                        bar = "🟦" * filled + "⬜️" * (10 - filled)
-                        text = (
-                            f"🚀 Генерация\n\n"
-                            f"{steps_text[step-1]}\n\n"
-                            f"{bar} {progress}%\n\n"
-                            f"Прошло: {elapsed}с • Шаг {step}/{total_steps}\n\n"
-                            f"Результат вас приятно удивит"
-                        )
-                        await msg.edit_text(text)
-                        # Увеличиваем паузу между обновлениями анимации, чтобы не спамить в API Telegram
-                        await asyncio.sleep(3.0)
-            except: pass
-
-        anim_task = asyncio.create_task(animate_gen(process_msg, lang))
-    
-        # Объединяем основные и специальные ключи для режима "Свой вариант"
-        api_keys = await db.list_api_keys()
-        if category == "own_variant" or data.get("own_mode") or category == "own":
-            own_keys = await db.list_own_variant_api_keys()
-            # Добавляем только уникальные токены
-            existing_tokens = {k[1] for k in api_keys}
-            for ok in own_keys:
-                if ok[1] not in existing_tokens:
-                    api_keys.append(ok)
-            
-        active_keys = [k for k in api_keys if k[2]] # is_active
-        if not active_keys:
-            anim_task.cancel()
+        # Анимацию ведёт общий тикер (bot/progress.py), а не отдельная задача на генерацию
+        progress_anim = progress_ticker.track(process_msg, "🚀 Генерация", GENERATION_STEPS, frame_seconds=3.0)
+    
+        # Ключи выдаёт пул (для "Свой вариант" используются те же api_keys)
+        key_pool = db.key_pool
+        if not await key_pool.has_active_keys():
+            progress_anim.cancel()
             try: await process_msg.delete()
             except: pass
             err_text = get_string("api_error_user", lang) + " (нет активных ключей)"
@@ -4028,48 +4021,28 @@ async def _do_generate_real(message_or_callback: Message | CallbackQuery, state:
                 await ans_obj.answer(err_text)
             return
             
-        import random
-        random.shuffle(active_keys)
-        
         last_error_msg = ""
         keys_tried = 0
-        for key_tuple in active_keys:
-            if keys_tried >= 5: # Пробуем до 5 ключей
+        tried_ids: set[int] = set()
+        while keys_tried < 5: # Пробуем до 5 ключей
+            lease = await key_pool.acquire(exclude=tried_ids)
+            if lease is None:
                 break
-            
-            kid = key_tuple[0]
-            token = key_tuple[1]
-            ok, limit_err = await db.check_api_key_limits(kid)
-            if not ok: continue
+            kid = lease.key_id
+            token = lease.token
+            tried_ids.add(kid)
             
             keys_tried += 1
             try:
-                import io
-                
-                async def download_one(fid):
-                    if not fid: return None
-                    if str(fid).startswith("data/"):
-                        local_path = os.path.join(BASE_DIR, fid)
-                        if os.path.exists(local_path):
-                            with open(local_path, "rb") as f:
-                                return f.read()
-                    try:
-                        # Скачиваем напрямую в память
-                        f_info = await bot.get_file(fid)
-                        dest = io.BytesIO()
-                        await bot.download_file(f_info.file_path, dest)
-                        return dest.getvalue()
-                    except Exception as e:
-                        logger.error(f"Ошибка загрузки фото {fid}: {e}")
-                        return None
-
                 logger.info(f"[_do_generate] Параллельная загрузка {len(input_photos)} фото")
-                # Запускаем загрузку всех фото одновременно
-                images_data = await asyncio.gather(*[download_one(fid) for fid in input_photos])
-                images_data = [d for d in images_data if d] # Убираем пустые
+                # Запускаем загрузку всех фото одновременно (повторные попытки и фото моделей берутся из кэша)
+                # input_bytes идут по порядку input_photos — они же потом уходят в историю
+                input_bytes = await asyncio.gather(*[telegram_file_cache.get_bytes(bot, fid) for fid in input_photos])
+                images_data = [d for d in input_bytes if d] # Убираем пустые
                 
                 if not images_data:
                     logger.error("[_do_generate] Не удалось загрузить ни одного фото")
+                    lease.release()
                     continue
 
                 logger.info(f"[_do_generate] Запуск генерации (ключ {kid}, фото: {len(images_data)})")
@@ -4081,7 +4054,7 @@ async def _do_generate_real(message_or_callback: Message | CallbackQuery, state:
                 if aspect == "auto": aspect = "1x1"
                 
                 # Передаем байты напрямую в generate_image
-                result_path = await generate_image(
+                result = await generate_image(
                     api_key=token, 
                     prompt=prompt_filled, 
                     images_bytes=images_data, 
@@ -4091,81 +4064,53 @@ async def _do_generate_real(message_or_callback: Message | CallbackQuery, state:
                     db_instance=db
                 )
                 
-                if result_path:
+                if result:
+                    lease.success()
                     await db.record_api_usage(kid)
                     
                     # Списываем стоимость генерации (ВСЕГДА 20 РУБЛЕЙ ДЛЯ ВСЕХ)
                     price = 20
                     await db.subtract_user_balance(user_id, price)
                     
-                    anim_task.cancel()
-                    from aiogram.types import FSInputFile
+                    progress_anim.cancel()
                     from bot.keyboards import result_actions_keyboard, result_actions_own_keyboard
                     
-                    file_size = os.path.getsize(result_path)
-                    logger.info(f"[_do_generate] Отправка результата %d байт в Telegram...", file_size)
+                    logger.info("[_do_generate] Отправка результата %d байт в Telegram...", result.size)
                     kb_res = result_actions_own_keyboard(lang) if (data.get("own_mode") or category == "own_variant") else result_actions_keyboard(lang)
                     
+                    progress_ticker.note_priority_send()
                     res_msg = await ans_obj.answer_document(
-                        document=FSInputFile(result_path, filename=f"result_{uuid.uuid4().hex[:8]}.jpg"), 
+                        document=result.as_input_file(f"result_{uuid.uuid4().hex[:8]}.jpg"),
                         caption=get_string("gen_success", lang),
                         reply_markup=kb_res
                     )
                     
-                    try: os.remove(result_path)
-                    except: pass
-                    
                     res_photo_id = res_msg.document.file_id
                     await state.update_data(result_photo_id=res_photo_id)
-                    
-                    history_dir = os.path.join("data", "history")
-                    os.makedirs(history_dir, exist_ok=True)
-                    
-                    pid = await db.generate_pid()
-                    local_input_paths = []
-                    # Для Windows/Linux совместимости путей в БД используем /
-                    db_result_path = f"data/history/result_{pid}.jpg"
-                    local_result_path = os.path.join(BASE_DIR, db_result_path)
-                    os.makedirs(os.path.dirname(local_result_path), exist_ok=True)
-
-                    try:
-                        # Качаем результат
-                        file_info = await bot.get_file(res_photo_id)
-                        await bot.download_file(file_info.file_path, local_result_path)
-                        
-                        # Качаем входные фото
-                        for i, f_id in enumerate(input_photos):
-                            if not f_id: continue
-                            db_inp_path = f"data/history/input_{pid}_{i}.jpg"
-                            local_inp_path = os.path.join(BASE_DIR, db_inp_path)
-                            try:
-                                f_info = await bot.get_file(f_id)
-                                await bot.download_file(f_info.file_path, local_inp_path)
-                                local_input_paths.append(db_inp_path)
-                            except: pass
-                    except Exception as e:
-                        logger.error(f"Error downloading images for history: {e}")
-
-                    await db.add_generation_history(
-                        pid=pid,
+
+                    try: await process_msg.delete()
+                    except: pass
+                    if isinstance(message_or_callback, CallbackQuery): await _safe_answer(message_or_callback)
+                    # Файлы и строку истории пишет фоновый архиватор — из байтов, что уже в памяти
+                    await history_archiver.submit(ArchiveJob(
+                        db, bot,
                         user_id=user_id,
                         category=category,
                         params=json.dumps(data),
-                        input_photos=json.dumps(input_photos),
+                        input_photos=input_photos,
+                        inputs=input_bytes,
                         result_photo_id=res_photo_id,
-                        input_paths=json.dumps(local_input_paths),
-                        result_path=db_result_path,
-                        prompt=prompt_filled
-                    )
-                    
-                    try: await process_msg.delete()
-                    except: pass
-                    if isinstance(message_or_callback, CallbackQuery): await _safe_answer(message_or_callback)
+                        result_bytes=result.data,
+                        result_path=result.path,
+                        prompt=prompt_filled,
+                    ))
                     return
                 else:
+                    lease.failure()
                     from bot.gemini import is_proxy_error
                     await db.record_api_error(kid, token[:10], "EmptyResult", "Empty result from API", is_proxy_error=False)
             except Exception as e:
+                lease.failure(e)
                 logger.error(f"Ошибка генерации на ключе {kid}: {e}", exc_info=True)
                 last_error_msg = str(e)
                 from bot.gemini import is_proxy_error
@@ -4173,8 +4118,10 @@ async def _do_generate_real(message_or_callback: Message | CallbackQuery, state:
                 # При таймауте не крутим ключи — проблема в сети/прокси
                 if "timeout" in str(e).lower():
                     keys_tried = 999
+            finally:
+                lease.release()
         
-        anim_task.cancel()
+        progress_anim.cancel()
         try: await process_msg.delete()
         except: pass
         
@@ -4189,7 +4136,7 @@ async def _do_generate_real(message_or_callback: Message | CallbackQuery, state:
             
     except Exception as e:
         logger.error(f"Критическая ошибка в _do_generate: {e}")
-        if 'anim_task' in locals(): anim_task.cancel()
+        if 'progress_anim' in locals(): progress_anim.cancel()
         err_text = get_string("gen_error_contact_support", lang)
         if isinstance(message_or_callback, CallbackQuery): await _replace_with_text(message_or_callback, err_text)
         else: await ans_obj.answer(err_text)
@@ -4205,12 +4152,11 @@ async def on_result_edit(callback: CallbackQuery, state: FSMContext, db: Databas
 
 @router.message(CreateForm.waiting_edit_text)
 async def on_result_edit_text(message: Message, state: FSMContext, db: Database) -> None:
-    user_id = message.from_user.id
-    if gen_locks[user_id].locked():
-        await message.answer("Пожалуйста, подождите, выполняется обработка ваших правок.")
-        return
-    async with gen_locks[user_id]:
-        await on_result_edit_text_real(message, state, db)
+    await _run_scheduled(
+        message, db,
+        lambda: on_result_edit_text_real(message, state, db),
+        busy_text="Пожалуйста, подождите, выполняется обработка ваших правок.",
+    )
 
 async def on_result_edit_text_real(message: Message, state: FSMContext, db: Database) -> None:
     edit_text = (message.text or "").strip()
@@ -4271,84 +4217,19 @@ async def on_result_edit_text_real(message: Message, state: FSMContext, db: Data
 
     # Анимация
     process_msg = await message.answer("🎨 ⚡️ ⏳")
-    async def animate_gen(msg):
-        start_time = time.time()
-        steps_text = [
-            "Понимаю, что изменить",
-            "Сверяю с оригиналом",
-            "Вношу корректировки",
-            "Фокусирую детали",
-            "Финализирую"
-        ]
-        total_steps = 5
-        try:
-            for step in range(1, total_steps + 1):
-                # Плавная имитация прогресса
-                for sub in range(4):
-                    elapsed = int(time.time() - start_time)
-                    progress = int(((step - 1) / total_steps + (sub / 4) / total_steps) * 100)
-                    if progress > 99: progress = 99
-                    
-                    filled = int(progress / 10)
-                    bar = "🟦" * filled + "⬜️" * (10 - filled)
-                    
-                    text = (
-                        f"✏️ Редактирование\n\n"
-                        f"{steps_text[step-1]}\n\n"
-                        f"{bar} {progress}%\n\n"
-                        f"Прошло: {elapsed}с • Шаг {step}/{total_steps}\n\n"
-                        f"Результат вас приятно удивит"
-                    )
-                    await msg.edit_text(text)
-                    await asyncio.sleep(1.5)
-        except: pass
-    anim_task = asyncio.create_task(animate_gen(process_msg))
+    progress_anim = progress_ticker.track(process_msg, "✏️ Редактирование", EDIT_STEPS, frame_seconds=1.5)
 
     try:
-        # Скачиваем фото
-        downloaded_paths = []
-        import uuid, os
-        for fid in input_photos:
-            if not fid: continue
-            try:
-                # Если это локальный путь
-                if str(fid).startswith("data/"):
-                    local_path = os.path.join(BASE_DIR, fid)
-                    if os.path.exists(local_path):
-                        ext = local_path.split('.')[-1]
-                        p = f"data/temp_edit_{uuid.uuid4()}.{ext}"
-                        import shutil
-                        shutil.copy2(local_path, p)
-                        downloaded_paths.append(p)
-                        logger.info(f"[Edit] Added local file: {fid}")
-                        continue
-
-                f_info = await message.bot.get_file(fid)
-                # Логируем размер файла из инфо Телеграма
-                logger.info(f"[Edit] File {fid} size from Telegram: {f_info.file_size} bytes")
-                
-                ext = f_info.file_path.split('.')[-1]
-                p = f"data/temp_edit_{uuid.uuid4()}.{ext}"
-                await message.bot.download_file(f_info.file_path, p)
-                
-                # Проверяем реальный размер на диске
-                if os.path.exists(p):
-                    sz = os.path.getsize(p)
-                    logger.info(f"[Edit] Real file size on disk: {sz} bytes")
-                
-                downloaded_paths.append(p)
-            except Exception as e:
-                logger.error(f"[Edit] Ошибка загрузки фото {fid}: {e}")
+        # Фото берём из общего кэша: исходники этой сессии обычно уже скачаны при генерации
+        import uuid
+        input_bytes = await asyncio.gather(*[telegram_file_cache.get_bytes(message.bot, fid) for fid in input_photos])
+        images_data = [d for d in input_bytes if d]
+        for d in images_data:
+            logger.info(f"[Edit] Input photo size: {len(d)} bytes")
 
         # Выбор API ключей
         # Всегда используем основные API ключи (Pro версия)
-        api_keys = await db.list_api_keys()
-        
-        active_keys = [k for k in api_keys if k[2]]
-        import random
-        random.shuffle(active_keys)
-        
-        result_path = None
+        result = None
         kid_used = None
         
         from bot.gemini import generate_image
@@ -4356,33 +4237,37 @@ async def on_result_edit_text_real(message: Message, state: FSMContext, db: Data
         aspect = raw_aspect.replace(":", "x")
         if aspect == "auto": aspect = "1x1"
         
-        for key_tuple in active_keys:
-            kid, token = key_tuple[0], key_tuple[1]
-            ok, _ = await db.check_api_key_limits(kid)
-            if not ok: continue
+        tried_ids: set[int] = set()
+        while True:
+            lease = await db.key_pool.acquire(exclude=tried_ids)
+            if lease is None:
+                break
+            kid, token = lease.key_id, lease.token
+            tried_ids.add(kid)
             
             try:
-                result_path = await generate_image(
-                    api_key=token, prompt=prompt_filled, image_paths=downloaded_paths,
+                result = await generate_image(
+                    api_key=token, prompt=prompt_filled, images_bytes=images_data,
                     aspect_ratio=aspect, quality=quality, key_id=kid, db_instance=db
                 )
-                if result_path:
+                if result:
+                    lease.success()
                     kid_used = kid
+                else:
+                    lease.failure()
                 break
             except Exception as e:
+                lease.failure(e)
                 logger.error(f"Edit error key {kid}: {e}")
                 continue
+            finally:
+                lease.release()
 
-        # Чистим временные фото
-        for p in downloaded_paths:
-            try: os.remove(p)
-            except: pass
-
-        anim_task.cancel()
+        progress_anim.cancel()
         try: await process_msg.delete()
         except: pass
 
-        if result_path:
+        if result:
             # Успех
             await db.record_api_usage(kid_used)
             
@@ -4396,55 +4281,26 @@ async def on_result_edit_text_real(message: Message, state: FSMContext, db: Data
             if category == "own_variant" or data.get("own_mode"):
                 kb = result_actions_own_keyboard(lang)
                 
+            progress_ticker.note_priority_send()
             res_msg = await message.answer_document(
-                document=FSInputFile(result_path, filename=f"edited_{uuid.uuid4().hex[:8]}.jpg"),
+                document=result.as_input_file(f"edited_{uuid.uuid4().hex[:8]}.jpg"),
                 caption=f"✅ Правки применены!\n\nТекст правок: {edit_text}",
                 reply_markup=kb
             )
 
-            # Сохраняем в историю
-            pid = await db.generate_pid()
-            history_dir = os.path.join("data", "history")
-            os.makedirs(history_dir, exist_ok=True)
-            
-            local_input_paths = []
-            db_result_path = f"data/history/result_{pid}.jpg"
-            local_result_path = os.path.join(BASE_DIR, db_result_path)
-            os.makedirs(os.path.dirname(local_result_path), exist_ok=True)
-
-            try:
-                # Качаем результат
-                res_photo_id = res_msg.document.file_id
-                file_info = await message.bot.get_file(res_photo_id)
-                await message.bot.download_file(file_info.file_path, local_result_path)
-                
-                # Качаем входные фото
-                for i, f_id in enumerate(input_photos):
-                    if not f_id: continue
-                    db_inp_path = f"data/history/input_{pid}_{i}.jpg"
-                    local_inp_path = os.path.join(BASE_DIR, db_inp_path)
-                    try:
-                        f_info = await message.bot.get_file(f_id)
-                        await message.bot.download_file(f_info.file_path, local_inp_path)
-                        local_input_paths.append(db_inp_path)
-                    except: pass
-            except Exception as e:
-                logger.error(f"Error downloading images for history in edit: {e}")
-
-            await db.add_generation_history(
-                pid=pid,
+            # В историю — фоном, из уже скачанных байтов
+            await history_archiver.submit(ArchiveJob(
+                db, message.bot,
                 user_id=user_id,
                 category=category,
                 params=json.dumps(data),
-                input_photos=json.dumps(input_photos),
-                result_photo_id=res_photo_id,
-                input_paths=json.dumps(local_input_paths),
-                result_path=db_result_path,
-                prompt=prompt_filled
-            )
-
-            try: os.remove(result_path)
-            except: pass
+                input_photos=input_photos,
+                inputs=input_bytes,
+                result_photo_id=res_msg.document.file_id,
+                result_bytes=result.data,
+                result_path=result.path,
+                prompt=prompt_filled,
+            ))
             # Не очищаем стейт полностью, чтобы можно было еще раз править или повторить
             await state.set_state(CreateForm.result_ready)
         else:
@@ -4452,7 +4308,7 @@ async def on_result_edit_text_real(message: Message, state: FSMContext, db: Data
 
     except Exception as e:
         logger.error(f"Critical error in on_result_edit_text: {e}")
-        anim_task.cancel()
+        progress_anim.cancel()
         try: await process_msg.delete()
         except: pass
         await message.answer(get_string("gen_error", lang))
@@ -4639,9 +4495,7 @@ async def on_history(callback: CallbackQuery, db: Database) -> None:
         except Exception as e:
             logger.error(f"Error sending history item {pid}: {e}")
             await callback.message.answer(caption, parse_mode="Markdown")
-        
-        # Небольшая задержка, чтобы не спамить
-        await asyncio.sleep(0.1)
+        # Темп отправки в чат держит OutboundLimiter
 
     await _safe_answer(callback)
 
@@ -0,0 +1,184 @@
+import io
+import logging
+import os
+import shutil
+import time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY_ROOT = "data/history"
+THUMBS_DIR = "thumbs"
+THUMB_SIZE = 256
+THUMB_QUALITY = 80
+_DAY_FORMAT = "%Y-%m-%d"
+
+
+def utc_day(ts: float | None = None) -> str:
+    """Каталог дня — по UTC, как created_at (CURRENT_TIMESTAMP) в SQLite."""
+    return time.strftime(_DAY_FORMAT, time.gmtime(ts))
+
+
+def thumb_of(path: str) -> str:
+    """Путь превью для файла дня: data/history/<день>/thumbs/<имя>; для старых файлов — сам файл."""
+    head, name = os.path.split(path)
+    if os.path.dirname(head) != HISTORY_ROOT:
+        return path
+    return f"{head}/{THUMBS_DIR}/{name}"
+
+
+def make_thumbnail(data: bytes, size: int = THUMB_SIZE) -> bytes | None:
+    try:
+        from PIL import Image
+        img = Image.open(io.BytesIO(data)).convert("RGB")
+        img.thumbnail((size, size))
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=THUMB_QUALITY, optimize=True)
+        return buf.getvalue()
+    except Exception as e:
+        logger.debug(f"[history] thumbnail failed: {e}")
+        return None
+
+
+class HistoryStore:
+    """Файлы истории генераций, разложенные по дням: data/history/YYYY-MM-DD/.
+
+    В каталоге дня лежат result_<pid>.jpg, input_<pid>_<i>.jpg и превью для
+    админки в thumbs/. Срок хранения считается днями, поэтому истёкшая история
+    удаляется целым каталогом (drop_expired), без проверки и удаления каждого
+    файла по строкам БД. Файлы старой плоской раскладки (прямо в data/history)
+    удаляются по mtime. Методы синхронные — вызывать через asyncio.to_thread.
+    """
+
+    def __init__(self, base_dir: str = BASE_DIR, root: str = HISTORY_ROOT, usage_ttl: float = 60.0) -> None:
+        self.base_dir = base_dir
+        self.root = root
+        self.usage_ttl = usage_ttl
+        self._usage: tuple[float, list[dict]] | None = None
+
+    def _abs(self, path: str) -> str:
+        return os.path.join(self.base_dir, path)
+
+    def result_path(self, pid: str, day: str) -> str:
+        return f"{self.root}/{day}/result_{pid}.jpg"
+
+    def input_path(self, pid: str, index: int, day: str) -> str:
+        return f"{self.root}/{day}/input_{pid}_{index}.jpg"
+
+    # --- запись ---
+    def write(self, path: str, data: bytes) -> None:
+        """Пишет файл дня (атомарно) и его превью."""
+        dest = self._abs(path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = f"{dest}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, dest)
+        self._write_thumb(path, data)
+
+    def move(self, src: str, path: str) -> None:
+        """Переносит готовый файл (например, временный результат) в каталог дня."""
+        dest = self._abs(path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.move(src, dest)
+        with open(dest, "rb") as f:
+            self._write_thumb(path, f.read())
+
+    def _write_thumb(self, path: str, data: bytes) -> None:
+        thumb_path = thumb_of(path)
+        if thumb_path == path:
+            return
+        thumb = make_thumbnail(data)
+        if thumb is None:
+            return
+        dest = self._abs(thumb_path)
+        try:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, "wb") as f:
+                f.write(thumb)
+        except OSError as e:
+            logger.warning(f"[history] thumbnail {thumb_path} not saved: {e}")
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(self._abs(path))
+
+    # --- срок хранения ---
+    def days(self) -> list[str]:
+        root = self._abs(self.root)
+        try:
+            names = os.listdir(root)
+        except FileNotFoundError:
+            return []
+        days = []
+        for name in names:
+            try:
+                datetime.strptime(name, _DAY_FORMAT)
+            except ValueError:
+                continue
+            if os.path.isdir(os.path.join(root, name)):
+                days.append(name)
+        return sorted(days)
+
+    def drop_expired(self, keep_days: int, now: datetime | None = None) -> tuple[int, int]:
+        """Удаляет каталоги дней старше keep_days и старые плоские файлы.
+
+        Возвращает (удалено каталогов, удалено плоских файлов).
+        """
+        now = now or datetime.now(timezone.utc)
+        cutoff = now - timedelta(days=keep_days)
+        # День целиком старше границы, только если он раньше её даты
+        cutoff_day = cutoff.strftime(_DAY_FORMAT)
+        dropped = 0
+        for day in self.days():
+            if day >= cutoff_day:
+                break
+            shutil.rmtree(self._abs(f"{self.root}/{day}"), ignore_errors=True)
+            dropped += 1
+
+        removed = 0
+        cutoff_ts = cutoff.timestamp()
+        try:
+            with os.scandir(self._abs(self.root)) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file() and entry.stat().st_mtime < cutoff_ts:
+                            os.remove(entry.path)
+                            removed += 1
+                    except OSError:
+                        pass
+        except FileNotFoundError:
+            pass
+        if dropped or removed:
+            self._usage = None
+        return dropped, removed
+
+    # --- учёт места ---
+    def usage_by_day(self) -> list[dict]:
+        """Файлы и байты по дням (превью — отдельно), новые дни сверху; кэш на usage_ttl."""
+        cached = self._usage
+        now = time.monotonic()
+        if cached is not None and now - cached[0] < self.usage_ttl:
+            return cached[1]
+        usage = []
+        for day in reversed(self.days()):
+            row = {"day": day, "files": 0, "bytes": 0, "thumb_bytes": 0}
+            day_dir = self._abs(f"{self.root}/{day}")
+            for dirpath, _, files in os.walk(day_dir):
+                is_thumbs = os.path.basename(dirpath) == THUMBS_DIR
+                for name in files:
+                    try:
+                        size = os.path.getsize(os.path.join(dirpath, name))
+                    except OSError:
+                        continue
+                    if is_thumbs:
+                        row["thumb_bytes"] += size
+                    else:
+                        row["files"] += 1
+                        row["bytes"] += size
+            usage.append(row)
+        self._usage = (now, usage)
+        return usage
+
+
+history_store = HistoryStore()
@@ -0,0 +1,368 @@
+import asyncio
+import logging
+import random
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+MAX_TOTAL_USAGE = 235  # Жесткий общий лимит на ключ
+MAX_DAILY_USAGE = 235  # Лимит в день
+MAX_MINUTE_USAGE = 20  # Лимит в минуту
+
+# Ошибки, после которых ключ отдыхает, а не перебирается повторно
+COOLDOWN_ERROR_TYPES = ("429", "quota")
+COOLDOWN_BASE = 60.0
+COOLDOWN_MAX = 900.0
+
+# Окно минутного лимита и формат времени в api_usage_log (UTC)
+MINUTE_WINDOW = 60.0
+_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Ожидаемая длительность генерации: ключи быстрее неё получают больший вес
+REFERENCE_LATENCY = 30.0
+EWMA_ALPHA = 0.2
+
+
+class _KeyState:
+    __slots__ = (
+        "id", "token", "active", "daily", "total", "day",
+        "minute", "others_minute", "flushed_minute", "in_flight", "pending", "pending_log",
+        "success_rate", "latency", "cooldown_until", "strikes",
+    )
+
+    def __init__(self, key_id: int, token: str) -> None:
+        self.id = key_id
+        self.token = token
+        self.active = True
+        self.daily = 0
+        self.total = 0
+        self.day = ""
+        # monotonic-время использований за последнюю минуту
+        self.minute: deque[float] = deque()
+        # monotonic-время использований другими процессами (по api_usage_log на момент перечитывания)
+        self.others_minute: deque[float] = deque()
+        # UTC-время своих использований, уже записанных в api_usage_log, — их не считаем чужими
+        self.flushed_minute: deque[str] = deque()
+        self.in_flight = 0
+        # Ещё не записанные в api_keys/api_usage_log использования
+        self.pending = 0
+        self.pending_log: list[str] = []
+        self.success_rate = 1.0
+        self.latency: float | None = None
+        self.cooldown_until = 0.0
+        self.strikes = 0
+
+    def minute_usage(self, now: float) -> int:
+        """Использования за последние MINUTE_WINDOW секунд: свои плюс других процессов."""
+        for window in (self.minute, self.others_minute):
+            while window and now - window[0] >= MINUTE_WINDOW:
+                window.popleft()
+        return len(self.minute) + len(self.others_minute)
+
+    def load_others(self, recent: list[str], since: str, now: float, wall: float) -> None:
+        """Чужие использования из api_usage_log: всё окно минус свои уже записанные."""
+        while self.flushed_minute and self.flushed_minute[0] < since:
+            self.flushed_minute.popleft()
+        others = Counter(recent)
+        others.subtract(self.flushed_minute)
+        times = []
+        for ts, n in others.items():
+            if n <= 0:
+                continue
+            age = wall - datetime.strptime(ts, _TS_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+            times.extend([now - max(0.0, age)] * n)
+        self.others_minute = deque(sorted(times))
+
+    def limit_error(self, now: float, minute_limit: int = MAX_MINUTE_USAGE) -> str:
+        if self.total >= MAX_TOTAL_USAGE:
+            return f"Total limit {MAX_TOTAL_USAGE} reached"
+        if self.daily >= MAX_DAILY_USAGE:
+            return f"Daily limit {MAX_DAILY_USAGE} reached"
+        # Общий лимит ключа — по всем процессам, доля процесса (minute_limit) — по своим запросам
+        if self.minute_usage(now) + self.in_flight >= MAX_MINUTE_USAGE:
+            return f"Minute limit {MAX_MINUTE_USAGE} reached"
+        if len(self.minute) + self.in_flight >= minute_limit:
+            return f"Minute limit {minute_limit} for this process reached"
+        return ""
+
+    def weight(self) -> float:
+        latency = self.latency if self.latency is not None else REFERENCE_LATENCY
+        speed = REFERENCE_LATENCY / max(latency, 1.0)
+        return (0.05 + self.success_rate) ** 2 * speed / (1 + self.in_flight)
+
+
+class KeyLease:
+    """Ключ, выданный пулом на одну попытку генерации. Закрывается success()/failure()/release()."""
+
+    __slots__ = ("_pool", "_state", "_started", "_closed")
+
+    def __init__(self, pool: "KeyPool", state: _KeyState) -> None:
+        self._pool = pool
+        self._state = state
+        self._started = time.monotonic()
+        self._closed = False
+
+    @property
+    def key_id(self) -> int:
+        return self._state.id
+
+    @property
+    def token(self) -> str:
+        return self._state.token
+
+    def _close(self) -> bool:
+        if self._closed:
+            return False
+        self._closed = True
+        self._state.in_flight = max(0, self._state.in_flight - 1)
+        return True
+
+    def release(self) -> None:
+        """Ключ не использовался (например, не удалось скачать фото) — статистику не трогаем."""
+        self._close()
+
+    def success(self) -> None:
+        if not self._close():
+            return
+        st = self._state
+        elapsed = time.monotonic() - self._started
+        st.success_rate += EWMA_ALPHA * (1.0 - st.success_rate)
+        st.latency = elapsed if st.latency is None else st.latency + EWMA_ALPHA * (elapsed - st.latency)
+        st.strikes = 0
+
+    def failure(self, error: Exception | None = None) -> None:
+        if not self._close():
+            return
+        st = self._state
+        error_type = getattr(error, "error_type", None)
+        if error_type in COOLDOWN_ERROR_TYPES:
+            st.strikes += 1
+            pause = min(COOLDOWN_BASE * 2 ** (st.strikes - 1), COOLDOWN_MAX)
+            st.cooldown_until = time.monotonic() + pause
+            logger.warning(f"[KeyPool] Key {st.id} cooling down for {int(pause)}s after {error_type}")
+        elif getattr(error, "is_proxy_error", False):
+            # Сеть/прокси — ключ не виноват
+            return
+        st.success_rate += EWMA_ALPHA * (0.0 - st.success_rate)
+
+
+class KeyPool:
+    """Пул API-ключей Gemini в памяти.
+
+    Список ключей перечитывается из api_keys раз в refresh_interval (их меняет админка),
+    счётчики ведутся в памяти и раз в flush_interval сбрасываются в api_keys и api_usage_log.
+    Минутный лимит — скользящее окно 60 с в памяти процесса; при перечитывании оно дополняется
+    использованиями других процессов (админки, воркеров) из api_usage_log — за вычетом своих
+    уже записанных, чтобы не считать их дважды.
+    Заодно раз в compact_interval чистится api_usage_log (см. Database.prune_api_usage).
+    Чужие использования видны с задержкой (flush + перечитывание), поэтому при нескольких
+    процессах-воркерах каждому ещё задаётся доля minute_limit для своих запросов
+    (см. bot/webhook.py); общий MAX_MINUTE_USAGE проверяется по всем процессам.
+    """
+
+    def __init__(
+        self,
+        db,
+        refresh_interval: float = 30.0,
+        flush_interval: float = 10.0,
+        compact_interval: float = 3600.0,
+        minute_limit: int = MAX_MINUTE_USAGE,
+    ) -> None:
+        self._db = db
+        self.minute_limit = max(1, int(minute_limit))
+        self.refresh_interval = refresh_interval
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self._compacted_at = 0.0
+        self._keys: dict[int, _KeyState] = {}
+        self._loaded_at: float | None = None
+        self._lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now().isoformat()[:10]
+
+    async def _load(self) -> None:
+        async with self._db._read() as db:
+            async with db.execute(
+                "SELECT id, token, is_active, daily_usage, total_usage, last_usage_reset FROM api_keys"
+            ) as cur:
+                rows = await cur.fetchall()
+        wall = time.time()
+        since = datetime.fromtimestamp(wall - MINUTE_WINDOW, timezone.utc).strftime(_TS_FORMAT)
+        recent = await self._db.get_api_usage_recent([int(r[0]) for r in rows], since)
+        now = time.monotonic()
+        today = self._today()
+        seen = set()
+        for key_id, token, is_active, daily, total, last_reset in rows:
+            key_id = int(key_id)
+            seen.add(key_id)
+            st = self._keys.get(key_id)
+            if st is None or st.token != token:
+                # Новый ключ или сменили токен — статистика старого токена не применима
+                fresh = _KeyState(key_id, token)
+                if st is not None:
+                    fresh.pending, fresh.pending_log = st.pending, st.pending_log
+                    fresh.flushed_minute = st.flushed_minute
+                st = self._keys[key_id] = fresh
+            st.active = bool(is_active)
+            # В БД — уже сброшенные значения, в памяти сверху ещё не записанные
+            st.total = int(total or 0) + st.pending
+            if last_reset and str(last_reset)[:10] == today:
+                st.daily = int(daily or 0) + st.pending
+            else:
+                st.daily = st.pending
+            st.day = today
+            st.load_others(recent.get(key_id, []), since, now, wall)
+        for key_id in [k for k in self._keys if k not in seen]:
+            del self._keys[key_id]
+        self._loaded_at = time.monotonic()
+
+    async def _ensure_loaded(self) -> None:
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_interval:
+            return
+        async with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_interval:
+                return
+            await self._flush_locked()
+            await self._load()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    def _roll_day(self) -> None:
+        today = self._today()
+        for st in self._keys.values():
+            if st.day != today:
+                st.day = today
+                st.daily = 0
+
+    async def has_active_keys(self) -> bool:
+        await self._ensure_loaded()
+        return any(st.active for st in self._keys.values())
+
+    async def acquire(self, exclude: set[int] | None = None) -> KeyLease | None:
+        """Выбирает ключ с учётом лимитов, паузы после 429/quota и истории успехов/скорости."""
+        await self._ensure_loaded()
+        self._roll_day()
+        now = time.monotonic()
+        candidates = [
+            st for st in self._keys.values()
+            if st.active
+            and not (exclude and st.id in exclude)
+            and st.cooldown_until <= now
+            and not st.limit_error(now, self.minute_limit)
+        ]
+        if not candidates:
+            return None
+        st = random.choices(candidates, weights=[c.weight() for c in candidates])[0]
+        st.in_flight += 1
+        return KeyLease(self, st)
+
+    async def check_limits(self, key_id: int) -> tuple[bool, str]:
+        await self._ensure_loaded()
+        self._roll_day()
+        st = self._keys.get(int(key_id))
+        if st is None:
+            return False, "Key not found"
+        err = st.limit_error(time.monotonic(), self.minute_limit)
+        return (not err), err
+
+    async def record_usage(self, key_id: int) -> None:
+        await self._ensure_loaded()
+        self._roll_day()
+        st = self._keys.get(int(key_id))
+        if st is None:
+            # Ключ удалён между выдачей и записью — пишем в лог напрямую
+            async with self._db._write() as db:
+                await db.execute("INSERT INTO api_usage_log (key_id) VALUES (?)", (int(key_id),))
+                await db.commit()
+            return
+        st.minute.append(time.monotonic())
+        st.daily += 1
+        st.total += 1
+        st.pending += 1
+        st.pending_log.append(datetime.now(timezone.utc).strftime(_TS_FORMAT))
+
+    async def _flush_locked(self) -> None:
+        dirty = [st for st in self._keys.values() if st.pending or (st.active and st.total >= MAX_TOTAL_USAGE)]
+        if not dirty:
+            return
+        today = self._today()
+        now_local = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        usage_rows = []
+        log_rows = []
+        rollup: Counter = Counter()
+        deactivate = []
+        # record_usage не ждёт блокировку — запоминаем, сколько именно уходит в БД
+        flushed = {st.id: (st.pending, len(st.pending_log)) for st in dirty}
+        for st in dirty:
+            if st.pending:
+                usage_rows.append((today, st.pending, st.pending, today, now_local, st.pending, st.id))
+                log_rows.extend((st.id, ts) for ts in st.pending_log)
+                for ts in st.pending_log:
+                    rollup[(st.id, "m", ts[:16])] += 1
+                    rollup[(st.id, "d", ts[:10])] += 1
+            if st.active and st.total >= MAX_TOTAL_USAGE:
+                deactivate.append((st.id, MAX_TOTAL_USAGE))
+        try:
+            async with self._db._write() as db:
+                # Дневной счётчик сбрасывается, если последний сброс был не сегодня
+                await db.executemany(
+                    "UPDATE api_keys SET "
+                    "daily_usage = CASE WHEN substr(COALESCE(last_usage_reset, ''), 1, 10) = ? THEN daily_usage + ? ELSE ? END, "
+                    "last_usage_reset = CASE WHEN substr(COALESCE(last_usage_reset, ''), 1, 10) = ? THEN last_usage_reset ELSE ? END, "
+                    "total_usage = total_usage + ? "
+                    "WHERE id=?",
+                    usage_rows,
+                )
+                await db.executemany("INSERT INTO api_usage_log (key_id, timestamp) VALUES (?, ?)", log_rows)
+                await db.executemany(
+                    "INSERT INTO api_usage_rollup (key_id, bucket, bucket_start, count) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(bucket, bucket_start, key_id) DO UPDATE SET count = count + excluded.count",
+                    [(*k, n) for k, n in rollup.items()],
+                )
+                # Автоматически деактивируем ключ при достижении общего лимита
+                await db.executemany("UPDATE api_keys SET is_active=0 WHERE id=? AND total_usage >= ?", deactivate)
+                await db.commit()
+        except Exception as e:
+            logger.error(f"[KeyPool] Flush failed, will retry: {e}")
+            return
+        for st in dirty:
+            count, logged = flushed[st.id]
+            st.flushed_minute.extend(st.pending_log[:logged])
+            st.pending -= count
+            del st.pending_log[:logged]
+            if st.total >= MAX_TOTAL_USAGE:
+                st.active = False
+
+    async def flush(self) -> None:
+        async with self._lock:
+            await self._flush_locked()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self._compacted_at >= self.compact_interval:
+                    self._compacted_at = time.monotonic()
+                    await self._db.prune_api_usage()
+            except Exception as e:
+                logger.error(f"[KeyPool] Flush loop error: {e}")
+
+    def invalidate(self) -> None:
+        """Перечитать ключи при следующем обращении (после изменений из этого процесса)."""
+        self._loaded_at = None
+
+    async def close(self) -> None:
+        task, self._flush_task = self._flush_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        await self.flush()
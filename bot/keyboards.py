@@ -170,7 +170,7 @@ def admin_main_keyboard(lang="ru") -> InlineKeyboardMarkup:
         ]
     )
 
-def admin_users_keyboard(users: list[tuple], page: int, has_next: bool, lang="ru") -> InlineKeyboardMarkup:
+def admin_users_keyboard(users: list[tuple], prev_cursor: str | None, next_cursor: str | None, lang="ru") -> InlineKeyboardMarkup:
     rows: list[list[InlineKeyboardButton]] = []
     for row in users:
         uid, username, blocked = row
@@ -179,11 +179,12 @@ def admin_users_keyboard(users: list[tuple], page: int, has_next: bool, lang="ru
         rows.append([
             InlineKeyboardButton(text=f"{status} ID {uid} {uname}", callback_data=f"admin_user:{uid}")
         ])
+    # Курсоры страниц — см. bot/pagination.py
     nav_row: list[InlineKeyboardButton] = []
-    if page > 0:
-        nav_row.append(InlineKeyboardButton(text=get_string("back", lang), callback_data=f"admin_users_page:{page-1}"))
-    if has_next:
-        nav_row.append(InlineKeyboardButton(text="▶️", callback_data=f"admin_users_page:{page+1}"))
+    if prev_cursor:
+        nav_row.append(InlineKeyboardButton(text=get_string("back", lang), callback_data=f"admin_users_page:p:{prev_cursor}"))
+    if next_cursor:
+        nav_row.append(InlineKeyboardButton(text="▶️", callback_data=f"admin_users_page:n:{next_cursor}"))
     if nav_row:
         rows.append(nav_row)
     rows.append([InlineKeyboardButton(text=get_string("back_main", lang), callback_data="back_main")])
@@ -356,6 +357,11 @@ def back_main_keyboard(lang="ru") -> InlineKeyboardMarkup:
         inline_keyboard=[[InlineKeyboardButton(text=get_string("back_main", lang), callback_data="back_main")]]
     )
 
+def gen_queue_keyboard(lang="ru") -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text=get_string("btn_cancel_queue", lang), callback_data="gen_cancel")]]
+    )
+
 def result_actions_keyboard(lang="ru") -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -0,0 +1,71 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message
+
+
+class _Album:
+    __slots__ = ("messages", "last")
+
+    def __init__(self, message: Message) -> None:
+        self.messages = [message]
+        self.last = time.monotonic()
+
+
+class MediaGroupMiddleware(BaseMiddleware):
+    """Собирает фото одного альбома (media_group_id) и отдаёт хендлеру одним вызовом.
+
+    Работает только для хендлеров с флагом media_group: первый апдейт альбома ждёт,
+    пока новые части перестанут приходить (window, но не дольше max_wait), остальные
+    апдейты поглощаются. Хендлер получает первое сообщение и data["album"] — все
+    сообщения альбома по порядку.
+    """
+
+    def __init__(self, window: float = 0.4, max_wait: float = 2.0, max_size: int = 10) -> None:
+        self.window = window
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self._albums: dict[tuple[int, str], _Album] = {}
+        self.batches = 0
+        self.absorbed = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, Message) or not event.media_group_id or not get_flag(data, "media_group"):
+            return await handler(event, data)
+
+        key = (event.chat.id, event.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.messages.append(event)
+            album.last = time.monotonic()
+            self.absorbed += 1
+            return None
+
+        album = self._albums[key] = _Album(event)
+        deadline = time.monotonic() + self.max_wait
+        try:
+            while len(album.messages) < self.max_size:
+                now = time.monotonic()
+                wait = min(album.last + self.window, deadline) - now
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            # Части, пришедшие позже, начнут новую пачку
+            self._albums.pop(key, None)
+
+        messages = sorted(album.messages, key=lambda m: m.message_id)
+        self.batches += 1
+        data["album"] = messages
+        return await handler(messages[0], data)
+
+    def stats(self) -> dict[str, int]:
+        return {"pending": len(self._albums), "batches": self.batches, "absorbed": self.absorbed}
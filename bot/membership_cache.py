@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class MembershipCache:
+    """Кэш результатов get_chat_member по ключу (channel_id, user_id).
+
+    Подписан — держим долго, не подписан — коротко (пользователь может подписаться
+    в любой момент). Когда положительная запись близка к истечению, отдаём её и
+    обновляем в фоне (refresh-ahead), чтобы активный пользователь не ждал Telegram.
+    """
+
+    def __init__(
+        self,
+        positive_ttl: float = 600.0,
+        negative_ttl: float = 20.0,
+        refresh_ahead: float = 0.75,
+        max_size: int = 50000,
+    ) -> None:
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.max_size = max_size
+        # (channel_id, user_id) -> (is_member, stored_at, ttl)
+        self._entries: OrderedDict[tuple[str, int], tuple[bool, float, float]] = OrderedDict()
+        self._refreshing: set[tuple[str, int]] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    def get(self, channel_id: str, user_id: int) -> tuple[bool, bool] | None:
+        """(is_member, needs_refresh) или None, если записи нет или она истекла."""
+        key = (str(channel_id), int(user_id))
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        is_member, stored_at, ttl = entry
+        age = time.monotonic() - stored_at
+        if age >= ttl:
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return is_member, (is_member and age >= ttl * self.refresh_ahead)
+
+    def put(self, channel_id: str, user_id: int, is_member: bool, ttl: float | None = None) -> None:
+        if ttl is None:
+            ttl = self.positive_ttl if is_member else self.negative_ttl
+        key = (str(channel_id), int(user_id))
+        self._entries[key] = (bool(is_member), time.monotonic(), float(ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int, channel_id: str | None = None) -> None:
+        user_id = int(user_id)
+        if channel_id is not None:
+            self._entries.pop((str(channel_id), user_id), None)
+            return
+        for key in [k for k in self._entries if k[1] == user_id]:
+            self._entries.pop(key, None)
+
+    def refresh(self, channel_id: str, user_id: int, fetch: Callable[[], Awaitable[tuple[bool, float | None]]]) -> None:
+        """Фоновое обновление записи; повторный вызов для того же ключа игнорируется."""
+        key = (str(channel_id), int(user_id))
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+
+        async def _run() -> None:
+            try:
+                is_member, ttl = await fetch()
+                self.put(channel_id, user_id, is_member, ttl)
+            except Exception as e:
+                logger.warning(f"Membership refresh failed for {user_id} in {channel_id}: {e}")
+            finally:
+                self._refreshing.discard(key)
+
+        task = asyncio.create_task(_run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def __len__(self) -> int:
+        return len(self._entries)
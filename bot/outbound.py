@@ -0,0 +1,223 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from bot.concurrency import register
+
+logger = logging.getLogger(__name__)
+
+# Полосы приоритета: меньше — раньше
+LANE_INTERACTIVE = 0
+LANE_PROGRESS = 1
+LANE_BULK = 2
+_LANE_NAMES = {LANE_INTERACTIVE: "interactive", LANE_PROGRESS: "progress", LANE_BULK: "bulk"}
+
+_lane: contextvars.ContextVar[int] = contextvars.ContextVar("outbound_lane", default=LANE_INTERACTIVE)
+
+
+@contextmanager
+def outbound_lane(lane: int) -> Iterator[None]:
+    """Все отправки внутри блока (в этой задаче) идут в указанной полосе."""
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def bulk_sends():
+    """Рассылки и прочие массовые отправки — после ответов пользователям."""
+    return outbound_lane(LANE_BULK)
+
+
+def _is_outgoing(method) -> bool:
+    # Лимиты Telegram считают сообщения: send*/copy*/forward* и правки
+    name = type(method).__name__
+    return name.startswith(("Send", "Copy", "Forward", "Edit")) and name != "SendChatAction"
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float) -> None:
+        self.tokens = tokens
+        self.updated = updated
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Middleware сессии aiogram: общий лимит исходящих сообщений бота.
+
+    Глобально — не больше global_rate сообщений в секунду, в один чат — chat_rate
+    (в группы — group_rate) с запасом burst. Ожидающие отправки обслуживаются по
+    полосам: ответы пользователям, затем прогресс-бары, затем рассылки. На
+    RetryAfter все отправки ждут указанное время, запрос повторяется (max_retries).
+    Считает доставленные, заблокированные (бот заблокирован пользователем) и
+    неудачные отправки.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 10.0,
+        group_rate: float = 20 / 60,
+        group_burst: float = 3.0,
+        max_retries: int = 3,
+        max_chats: int = 10000,
+    ) -> None:
+        self.global_rate = max(1.0, float(global_rate))
+        self.chat_rate = float(chat_rate)
+        self.chat_burst = float(chat_burst)
+        self.group_rate = float(group_rate)
+        self.group_burst = float(group_burst)
+        self.max_retries = int(max_retries)
+        self.max_chats = int(max_chats)
+        self._global = _Bucket(self.global_rate, time.monotonic())
+        self._chats: OrderedDict[int | str, _Bucket] = OrderedDict()
+        # (lane, seq, future) — очередь за глобальным лимитом
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump_task: asyncio.Task | None = None
+        self._paused_until = 0.0
+        self.delivered = 0
+        self.blocked = 0
+        self.failed = 0
+        self.retried = 0
+        self.waiting_by_lane = {lane: 0 for lane in _LANE_NAMES}
+
+    # --- лимиты ---
+    def set_global_rate(self, rate: float) -> None:
+        """Меняет общий лимит, например делит его между процессами-воркерами."""
+        self.global_rate = max(1.0, float(rate))
+        self._global.tokens = min(self._global.tokens, self.global_rate)
+
+    def _chat_bucket(self, chat_id: int | str, now: float) -> tuple[_Bucket, float, float]:
+        is_group = isinstance(chat_id, str) or int(chat_id) < 0
+        rate, burst = (self.group_rate, self.group_burst) if is_group else (self.chat_rate, self.chat_burst)
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = _Bucket(burst, now)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+        bucket.updated = now
+        return bucket, rate, burst
+
+    async def _acquire_chat(self, chat_id: int | str) -> None:
+        while True:
+            bucket, rate, _ = self._chat_bucket(chat_id, time.monotonic())
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return
+            await asyncio.sleep((1 - bucket.tokens) / rate)
+
+    def _refill_global(self, now: float) -> None:
+        g = self._global
+        g.tokens = min(self.global_rate, g.tokens + (now - g.updated) * self.global_rate)
+        g.updated = now
+
+    async def _acquire_global(self, lane: int) -> None:
+        now = time.monotonic()
+        self._refill_global(now)
+        if not self._waiters and now >= self._paused_until and self._global.tokens >= 1:
+            self._global.tokens -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._seq), fut))
+        self.waiting_by_lane[lane] += 1
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        try:
+            await fut
+        finally:
+            self.waiting_by_lane[lane] -= 1
+
+    async def _pump(self) -> None:
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill_global(now)
+            while self._waiters and self._global.tokens >= 1:
+                _, _, fut = heapq.heappop(self._waiters)
+                if fut.done():
+                    continue
+                self._global.tokens -= 1
+                fut.set_result(None)
+            if self._waiters:
+                await asyncio.sleep((1 - self._global.tokens) / self.global_rate)
+
+    # --- middleware ---
+    async def __call__(self, make_request, bot, method):
+        if not _is_outgoing(method):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        lane = _lane.get()
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                await self._acquire_chat(chat_id)
+            await self._acquire_global(lane)
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                # Flood control действует на весь бот — притормаживаем все отправки
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.failed += 1
+                    raise
+                self.retried += 1
+                logger.warning(f"[outbound] RetryAfter {e.retry_after}s on {type(method).__name__}, retry {attempt}")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramForbiddenError:
+                self.blocked += 1
+                raise
+            except Exception:
+                self.failed += 1
+                raise
+            self.delivered += 1
+            return result
+
+    def stats(self) -> dict[str, int]:
+        stats = {
+            "delivered": self.delivered,
+            "blocked": self.blocked,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+        for lane, name in _LANE_NAMES.items():
+            stats[f"waiting_{name}"] = self.waiting_by_lane[lane]
+        return stats
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+# Один лимитер на процесс: его подключают все Bot этого процесса (bot.session.middleware(...))
+outbound_limiter = register(
+    "outbound",
+    OutboundLimiter(
+        global_rate=_env_float("OUTBOUND_GLOBAL_RATE", 30.0),
+        chat_rate=_env_float("OUTBOUND_CHAT_RATE", 1.0),
+        chat_burst=_env_float("OUTBOUND_CHAT_BURST", 10.0),
+    ),
+)
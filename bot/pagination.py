@@ -0,0 +1,43 @@
+"""Keyset-пагинация списков «новые сверху» (users, generation_history, balance_history).
+
+Страница задаётся не смещением, а последней показанной строкой: курсор —
+пара (created_at, id), следующая страница — строки строго «старше» неё:
+
+    WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?
+
+С индексом по created_at (или (user_id, created_at) при фильтре по пользователю)
+это чтение limit строк индекса на любой странице, а не OFFSET строк с начала.
+id нужен, потому что created_at совпадает у строк, записанных в одну секунду.
+"""
+
+import re
+
+# Курсор в URL/callback_data: "2024-05-01 12:00:00|123456789"
+_SEP = "|"
+_PID_RE = re.compile(r"^PID\d+$", re.IGNORECASE)
+
+
+def encode_cursor(created_at: str | None, row_id: int) -> str:
+    return f"{created_at or ''}{_SEP}{row_id}"
+
+
+def decode_cursor(raw: str | None) -> tuple[str, int] | None:
+    if not raw or _SEP not in raw:
+        return None
+    created_at, _, row_id = raw.rpartition(_SEP)
+    try:
+        return created_at, int(row_id)
+    except ValueError:
+        return None
+
+
+def as_user_id(query: str) -> int | None:
+    """Запрос поиска — это id пользователя (веб-пользователи хранятся с минусом)?"""
+    q = query.strip()
+    if q.lstrip("-").isdigit():
+        return int(q)
+    return None
+
+
+def is_pid(query: str) -> bool:
+    return bool(_PID_RE.match(query.strip()))
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from bot.concurrency import register
+from bot.outbound import LANE_PROGRESS, outbound_lane
+
+logger = logging.getLogger(__name__)
+
+GENERATION_STEPS = (
+    "Изучаю ваш запрос",
+    "Обрабатываю детали",
+    "Применяю нейронные фильтры",
+    "Улучшаю качество",
+    "Финализирую",
+)
+EDIT_STEPS = (
+    "Понимаю, что изменить",
+    "Сверяю с оригиналом",
+    "Вношу корректировки",
+    "Фокусирую детали",
+    "Финализирую",
+)
+# Кадров на шаг: прогресс-бар двигается 4 раза за шаг
+FRAMES_PER_STEP = 4
+
+
+def render_progress(title: str, steps: tuple[str, ...], frame: int, elapsed: int) -> str:
+    total_steps = len(steps)
+    step = frame // FRAMES_PER_STEP + 1
+    sub = frame % FRAMES_PER_STEP
+    progress = min(99, int(((step - 1) / total_steps + (sub / FRAMES_PER_STEP) / total_steps) * 100))
+    filled = int(progress / 10)
+    bar = "🟦" * filled + "⬜️" * (10 - filled)
+    return (
+        f"{title}\n\n"
+        f"{steps[step - 1]}\n\n"
+        f"{bar} {progress}%\n\n"
+        f"Прошло: {elapsed}с • Шаг {step}/{total_steps}\n\n"
+        f"Результат вас приятно удивит"
+    )
+
+
+class ProgressHandle:
+    __slots__ = ("ticker", "message", "title", "steps", "frame_seconds", "started", "last_frame", "last_edit", "done")
+
+    def __init__(self, ticker: "ProgressTicker", message: Message, title: str, steps: tuple[str, ...], frame_seconds: float) -> None:
+        self.ticker = ticker
+        self.message = message
+        self.title = title
+        self.steps = steps
+        self.frame_seconds = frame_seconds
+        self.started = time.monotonic()
+        self.last_frame = -1
+        self.last_edit = 0.0
+        self.done = False
+
+    def cancel(self) -> None:
+        """Останавливает анимацию (сообщение не трогает)."""
+        self.done = True
+        self.ticker._items.discard(self)
+
+
+class ProgressTicker:
+    """Один тикер на процесс для всех сообщений «Генерация N%».
+
+    Вместо задачи на каждую генерацию: раз в tick выбирает сообщения, у которых
+    сменился кадр, и редактирует их в пределах общего бюджета (edits_per_sec).
+    Кадр не сменился — запроса нет; последний кадр показан — сообщение больше не
+    трогаем. Отправка результата списывает бюджет вперёд (note_priority_send),
+    поэтому прогресс-бары получают только остаток. На flood-wait тикер замолкает.
+    """
+
+    def __init__(self, tick: float = 0.5, edits_per_sec: float = 10.0, burst: float = 10.0) -> None:
+        self.tick = tick
+        self.rate = max(0.1, float(edits_per_sec))
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._items: set[ProgressHandle] = set()
+        self._task: asyncio.Task | None = None
+        self.edits = 0
+        self.skipped = 0
+
+    def track(
+        self,
+        message: Message,
+        title: str = "🚀 Генерация",
+        steps: tuple[str, ...] = GENERATION_STEPS,
+        frame_seconds: float = 3.0,
+    ) -> ProgressHandle:
+        handle = ProgressHandle(self, message, title, steps, frame_seconds)
+        self._items.add(handle)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return handle
+
+    def note_priority_send(self, count: int = 1) -> None:
+        """Учитывает приоритетную отправку (результат) в общем бюджете."""
+        self._refill()
+        self._tokens = max(-self.burst, self._tokens - count)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    async def _run(self) -> None:
+        while self._items:
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            if now < self._paused_until:
+                continue
+            self._refill()
+            due = []
+            for item in self._items:
+                frame = int((now - item.started) / item.frame_seconds)
+                if frame > item.last_frame:
+                    due.append((item.last_edit, item, frame))
+                else:
+                    self.skipped += 1
+            # Дольше всех не обновлявшиеся — первыми
+            due.sort(key=lambda x: x[0])
+            batch = []
+            for _, item, frame in due:
+                if self._tokens < 1:
+                    break
+                self._tokens -= 1
+                batch.append(self._edit(item, frame, now))
+            if batch:
+                with outbound_lane(LANE_PROGRESS):
+                    await asyncio.gather(*batch)
+
+    async def _edit(self, item: ProgressHandle, frame: int, now: float) -> None:
+        last = len(item.steps) * FRAMES_PER_STEP - 1
+        frame = min(frame, last)
+        previous, item.last_frame, item.last_edit = item.last_frame, frame, now
+        text = render_progress(item.title, item.steps, frame, int(now - item.started))
+        try:
+            await item.message.edit_text(text)
+            self.edits += 1
+        except TelegramRetryAfter as e:
+            self._paused_until = time.monotonic() + e.retry_after
+            # Кадр не показан — попробуем снова после паузы
+            item.last_frame = previous
+            logger.warning(f"[progress] Flood wait {e.retry_after}s, pausing progress edits")
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e):
+                # Сообщение удалили или его нельзя редактировать
+                item.cancel()
+        except Exception as e:
+            logger.debug(f"[progress] edit failed: {e}")
+        if item.last_frame >= last:
+            # Последний кадр показан — дальше сообщение не меняется
+            self._items.discard(item)
+
+    def stats(self) -> dict[str, int]:
+        return {"active": len(self._items), "edits": self.edits, "skipped": self.skipped}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+progress_ticker = register("progress", ProgressTicker(edits_per_sec=_env_float("PROGRESS_EDITS_PER_SEC", 10.0)))
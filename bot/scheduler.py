@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Очередь переполнена: reason="global" — общая, "user" — у пользователя уже есть генерация."""
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(f"generation queue is full ({reason})")
+        self.reason = reason
+
+
+class GenerationCancelled(Exception):
+    """Ожидание в очереди отменено пользователем."""
+
+
+class _Waiter:
+    __slots__ = ("user_id", "future")
+
+    def __init__(self, user_id: int, future: asyncio.Future) -> None:
+        self.user_id = user_id
+        self.future = future
+
+
+class GenerationScheduler:
+    """Общий планировщик генераций: не более max_concurrent одновременно, остальные ждут.
+
+    Очередь ограничена max_queue, у пользователя не больше max_per_user заявок
+    (включая выполняющуюся). Слоты раздаются по кругу между пользователями,
+    поэтому один пользователь с несколькими заявками не задерживает остальных.
+    Один пользователь не выполняет больше одной генерации одновременно.
+    """
+
+    def __init__(self, max_concurrent: int = 4, max_queue: int = 100, max_per_user: int = 1) -> None:
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_queue = max(0, int(max_queue))
+        self.max_per_user = max(1, int(max_per_user))
+        self._queues: dict[int, deque[_Waiter]] = {}
+        # Порядок обхода пользователей с ожидающими заявками (round-robin)
+        self._rotation: deque[int] = deque()
+        self._running: set[int] = set()
+        self._queued = 0
+
+    @property
+    def active(self) -> int:
+        return len(self._running)
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def is_busy(self, user_id: int) -> bool:
+        return user_id in self._running or bool(self._queues.get(user_id))
+
+    def position(self, user_id: int) -> int:
+        """Оценка места первой заявки пользователя в очереди (1 — следующая); 0 — не в очереди."""
+        queue = self._queues.get(user_id)
+        if not queue:
+            return 0
+        pos = 0
+        for uid in self._rotation:
+            pos += 1
+            if uid == user_id:
+                return pos
+        return pos
+
+    def _enqueue(self, user_id: int) -> _Waiter:
+        pending = len(self._queues.get(user_id) or ()) + (1 if user_id in self._running else 0)
+        if pending >= self.max_per_user:
+            raise QueueFull("user")
+        can_start = len(self._running) < self.max_concurrent and user_id not in self._running
+        if self._queued >= self.max_queue and not can_start:
+            raise QueueFull("global")
+        waiter = _Waiter(user_id, asyncio.get_running_loop().create_future())
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+        if not queue:
+            self._rotation.append(user_id)
+        queue.append(waiter)
+        self._queued += 1
+        return waiter
+
+    def _remove(self, waiter: _Waiter) -> None:
+        queue = self._queues.get(waiter.user_id)
+        if not queue or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self._queued -= 1
+        if not queue:
+            del self._queues[waiter.user_id]
+            self._rotation.remove(waiter.user_id)
+
+    def _dispatch(self) -> None:
+        while len(self._running) < self.max_concurrent and self._rotation:
+            # Первый по кругу пользователь, у которого сейчас ничего не выполняется
+            for uid in self._rotation:
+                if uid not in self._running:
+                    break
+            else:
+                return
+            queue = self._queues[uid]
+            waiter = queue.popleft()
+            self._queued -= 1
+            self._rotation.remove(uid)
+            if queue:
+                self._rotation.append(uid)
+            else:
+                del self._queues[uid]
+            self._running.add(uid)
+            waiter.future.set_result(None)
+
+    def _release(self, user_id: int) -> None:
+        self._running.discard(user_id)
+        self._dispatch()
+
+    def cancel(self, user_id: int) -> int:
+        """Снимает ожидающие заявки пользователя (выполняющуюся не трогает). Возвращает их число."""
+        queue = self._queues.pop(user_id, None)
+        if not queue:
+            return 0
+        self._rotation.remove(user_id)
+        self._queued -= len(queue)
+        for waiter in queue:
+            if not waiter.future.done():
+                waiter.future.set_exception(GenerationCancelled())
+        return len(queue)
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        user_id: int,
+        on_queued: Callable[[int], Awaitable[None]] | None = None,
+    ) -> AsyncIterator[None]:
+        """Ждёт свободный слот и держит его до выхода из блока.
+
+        on_queued(position) вызывается один раз, если слот не выдан сразу.
+        Бросает QueueFull, если встать в очередь нельзя, и GenerationCancelled,
+        если заявку сняли через cancel().
+        """
+        waiter = self._enqueue(user_id)
+        self._dispatch()
+        try:
+            if not waiter.future.done():
+                if on_queued is not None:
+                    try:
+                        await on_queued(self.position(user_id))
+                    except Exception as e:
+                        logger.warning(f"[scheduler] on_queued callback failed: {e}")
+                await waiter.future
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                # Слот выдали, но задачу отменили до входа в блок — возвращаем его
+                self._release(user_id)
+            else:
+                self._remove(waiter)
+                if not waiter.future.done():
+                    waiter.future.cancel()
+            raise
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+# Один планировщик на процесс: его используют и Telegram-бот, и веб-генерация
+generation_scheduler = GenerationScheduler(
+    max_concurrent=_env_int("GEN_MAX_CONCURRENT", 4),
+    max_queue=_env_int("GEN_MAX_QUEUE", 100),
+    max_per_user=_env_int("GEN_MAX_PER_USER", 1),
+)
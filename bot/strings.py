@@ -77,6 +77,10 @@ STRINGS = {
         "gen_success": "Ваше фото готово!",
         "gen_error": "Ошибка при генерации. Пожалуйста, попробуйте еще раз.",
         "gen_error_contact_support": "⚠️ Произошла ошибка при генерации. Пожалуйста, обратитесь в поддержку @bnbslow.",
+        "gen_queued": "⏳ Все линии генерации заняты. Вы в очереди: {position}. Генерация начнётся автоматически.",
+        "gen_queue_full": "⚠️ Очередь генераций переполнена. Пожалуйста, попробуйте через пару минут.",
+        "gen_queue_cancelled": "Генерация отменена.",
+        "btn_cancel_queue": "❌ Отменить",
         "api_error_user": "⚠️ К сожалению, сейчас все линии перегружены. Пожалуйста, попробуйте еще раз через несколько минут или обратитесь в поддержку @bnbslow.",
         "internal_error": "Произошла внутренняя ошибка. Попробуйте позже.",
         "api_limit_reached": "Все API ключи исчерпали лимиты. Попробуйте позже.",
@@ -349,11 +353,12 @@ STRINGS = {
         "admin_stats_today_users": "Новых сегодня",
         "admin_stats_total_generations": "Всего генераций",
         "admin_stats_today_generations": "Генераций сегодня",
+        "admin_stats_runtime": "⚙️ Процесс (структуры в памяти)",
         "admin_cats_edit": "Категории (нажмите, чтобы включить/отключить):",
         "admin_saved": "Сохранено",
         "admin_prices_title": "💰 Цены категорий (нажмите для редактирования):",
-        "admin_enter_id": "Введите ID пользователя (числом):",
-        "admin_enter_id_error": "Укажите ID числом, например: 123456789",
+        "admin_enter_id": "Введите ID пользователя (числом), username или имя:",
+        "admin_enter_id_error": "Пользователь не найден. Укажите ID числом (например: 123456789), username или имя",
         "admin_user_not_found": "Пользователь не найден",
         "admin_users_list": "👥 Пользователи:",
         "admin_models_title": "🧩 Модели",
@@ -384,7 +389,12 @@ STRINGS = {
         "admin_pick_prompt": "Выберите промт",
         "admin_deleted_return": "Удалено. Вернитесь к списку.",
         "admin_deleted": "Удалено",
-        "admin_broadcast_done": "Рассылка завершена",
+        "admin_broadcast_done": "Рассылка #{id} завершена",
+        "admin_broadcast_started": "Рассылка #{id} запущена. Когда она закончится, придёт отчёт. Остановить: /stop_broadcast {id}",
+        "admin_broadcast_cancelled": "Рассылка #{id} остановлена",
+        "admin_broadcast_stop_usage": "Использование: /stop_broadcast <номер рассылки>",
+        "admin_broadcast_not_running": "Рассылка #{id} не найдена или уже завершена",
+        "admin_broadcast_counts": "Доставлено: {delivered}, заблокировали бота: {blocked}, ошибок: {failed}",
         "admin_broadcast_text_req": "Пришлите текст для рассылки (сообщением). Потом можно будет добавить картинку или пропустить.",
         "admin_broadcast_text_ok": "Текст принят. Прикрепите изображение (фото), видео или нажмите 'Пропустить'.",
         "admin_broadcast_preview": "Предпросмотр рассылки:\n\n{text}",
@@ -517,6 +527,10 @@ STRINGS = {
         "gen_success": "Your photo is ready!",
         "gen_error": "Generation error. Please try again.",
         "gen_error_contact_support": "⚠️ An error occurred during generation. Please contact support @bnbslow.",
+        "gen_queued": "⏳ All generation lines are busy. Your place in the queue: {position}. Generation will start automatically.",
+        "gen_queue_full": "⚠️ The generation queue is full. Please try again in a couple of minutes.",
+        "gen_queue_cancelled": "Generation cancelled.",
+        "btn_cancel_queue": "❌ Cancel",
         "api_error_user": "⚠️ Sorry, all generation lines are currently overloaded. Please try again in a few minutes or contact support @bnbslow.",
         "view_front": "Front",
         "view_back": "Back",
@@ -777,11 +791,12 @@ STRINGS = {
         "admin_stats_today_users": "New today",
         "admin_stats_total_generations": "Total generations",
         "admin_stats_today_generations": "Generations today",
+        "admin_stats_runtime": "⚙️ Process (in-memory structures)",
         "admin_cats_edit": "Categories (click to toggle):",
         "admin_saved": "Saved",
         "admin_prices_title": "💰 Category prices (click to edit):",
-        "admin_enter_id": "Enter user ID (number):",
-        "admin_enter_id_error": "Enter ID as a number, e.g., 123456789",
+        "admin_enter_id": "Enter user ID (number), username or name:",
+        "admin_enter_id_error": "User not found. Enter ID as a number (e.g., 123456789), username or name",
         "admin_user_not_found": "User not found",
         "admin_users_list": "👥 Users:",
         "admin_models_title": "🧩 Models",
@@ -812,7 +827,12 @@ STRINGS = {
         "admin_pick_prompt": "Pick a prompt",
         "admin_deleted_return": "Deleted. Return to list.",
         "admin_deleted": "Deleted",
-        "admin_broadcast_done": "Broadcast finished",
+        "admin_broadcast_done": "Broadcast #{id} finished",
+        "admin_broadcast_started": "Broadcast #{id} started. You will get a report when it finishes. Stop: /stop_broadcast {id}",
+        "admin_broadcast_cancelled": "Broadcast #{id} stopped",
+        "admin_broadcast_stop_usage": "Usage: /stop_broadcast <broadcast number>",
+        "admin_broadcast_not_running": "Broadcast #{id} not found or already finished",
+        "admin_broadcast_counts": "Delivered: {delivered}, blocked the bot: {blocked}, failed: {failed}",
         "admin_broadcast_text_req": "Send text for broadcast (as a message). Then you can add a picture or skip.",
         "admin_broadcast_text_ok": "Text accepted. Attach image (photo), video, or press 'Skip'.",
         "admin_broadcast_preview": "Broadcast preview:\n\n{text}",
@@ -945,6 +965,10 @@ STRINGS = {
         "gen_success": "Ảnh của bạn đã sẵn sàng!",
         "gen_error": "Lỗi khi tạo. Vui lòng thử lại.",
         "gen_error_contact_support": "⚠️ Đã xảy ra lỗi khi tạo. Vui lòng liên hệ bộ phận hỗ trợ @bnbslow.",
+        "gen_queued": "⏳ Tất cả các tuyến tạo đang bận. Vị trí của bạn trong hàng đợi: {position}. Việc tạo sẽ tự động bắt đầu.",
+        "gen_queue_full": "⚠️ Hàng đợi tạo ảnh đã đầy. Vui lòng thử lại sau vài phút.",
+        "gen_queue_cancelled": "Đã hủy tạo ảnh.",
+        "btn_cancel_queue": "❌ Hủy",
         "api_error_user": "⚠️ Xin lỗi, tất cả các tuyến tạo hiện đang bị quá tải. Vui lòng thử lại sau vài phút hoặc liên hệ bộ phận hỗ trợ @bnbslow.",
         "view_front": "Mặt trước",
         "view_back": "Mặt sau",
@@ -1205,11 +1229,12 @@ STRINGS = {
         "admin_stats_today_users": "Mới hôm nay",
         "admin_stats_total_generations": "Tổng số lượt tạo",
         "admin_stats_today_generations": "Lượt tạo hôm nay",
+        "admin_stats_runtime": "⚙️ Tiến trình (cấu trúc trong bộ nhớ)",
         "admin_cats_edit": "Danh mục (nhấn để bật/tắt):",
         "admin_saved": "Đã lưu",
         "admin_prices_title": "💰 Giá danh mục (nhấn để chỉnh sửa):",
-        "admin_enter_id": "Nhập ID người dùng (số):",
-        "admin_enter_id_error": "Nhập ID dưới dạng số, ví dụ: 123456789",
+        "admin_enter_id": "Nhập ID người dùng (số), username hoặc tên:",
+        "admin_enter_id_error": "Không tìm thấy người dùng. Nhập ID dưới dạng số (ví dụ: 123456789), username hoặc tên",
         "admin_user_not_found": "Không tìm thấy người dùng",
         "admin_users_list": "👥 Người dùng:",
         "admin_models_title": "🧩 Người mẫu",
@@ -1240,7 +1265,12 @@ STRINGS = {
         "admin_pick_prompt": "Chọn một lời nhắc",
         "admin_deleted_return": "Đã xóa. Quay lại danh sách.",
         "admin_deleted": "Đã xóa",
-        "admin_broadcast_done": "Đã hoàn thành gửi hàng loạt",
+        "admin_broadcast_done": "Đã hoàn thành gửi hàng loạt #{id}",
+        "admin_broadcast_started": "Đã bắt đầu gửi hàng loạt #{id}. Báo cáo sẽ được gửi khi hoàn tất. Dừng: /stop_broadcast {id}",
+        "admin_broadcast_cancelled": "Đã dừng gửi hàng loạt #{id}",
+        "admin_broadcast_stop_usage": "Cách dùng: /stop_broadcast <số gửi hàng loạt>",
+        "admin_broadcast_not_running": "Không tìm thấy gửi hàng loạt #{id} hoặc đã hoàn tất",
+        "admin_broadcast_counts": "Đã gửi: {delivered}, đã chặn bot: {blocked}, lỗi: {failed}",
         "admin_broadcast_text_req": "Gửi văn bản để gửi hàng loạt (dưới dạng tin nhắn). Sau đó bạn có thể thêm ảnh hoặc bỏ qua.",
         "admin_broadcast_text_ok": "Đã nhận văn bản. Đính kèm hình ảnh (ảnh), video hoặc nhấn 'Bỏ qua'.",
         "admin_broadcast_preview": "Xem trước gửi hàng loạt:\n\n{text}",
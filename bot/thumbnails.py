@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from aiogram import Bot
+
+from bot.concurrency import register
+from bot.file_cache import BASE_DIR, TelegramFileCache, telegram_file_cache
+
+logger = logging.getLogger(__name__)
+
+# Размеры превью по длинной стороне; "full" — оригинал из кэша файлов Telegram
+THUMB_SIZES = {"s": 160, "m": 480, "l": 1024}
+FULL_SIZE = "full"
+THUMB_QUALITY = 82
+THUMB_WORKERS = max(1, min(2, os.cpu_count() or 1))
+# Результат in-flight future, если строившую превью задачу отменили: ждущие строят сами
+_ABANDONED = object()
+
+_IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+)
+
+
+def sniff_media_type(data: bytes) -> str:
+    """Тип содержимого по первым байтам (Telegram отдаёт файлы без Content-Type)."""
+    for signature, media_type in _IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return media_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp":
+        return "video/mp4"
+    return "application/octet-stream"
+
+
+def _render_thumbnail(data: bytes, size: int) -> bytes:
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    img.draft("RGB", (size, size))  # JPEG декодируется сразу в уменьшенном масштабе
+    img = img.convert("RGB")
+    img.thumbnail((size, size), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=THUMB_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+class ThumbnailCache:
+    """Превью фото Telegram фиксированных размеров на диске: <cache_dir>/<size>/<hash(file_id)>.jpg.
+
+    Содержимое по file_id в Telegram не меняется, поэтому превью строится один раз
+    (в пуле процессов) и дальше отдаётся с диска; ETag выводится из file_id и
+    размера — проверить If-None-Match можно, не читая файл. Оригиналы берутся из
+    TelegramFileCache, так что каждый файл скачивается из Telegram однократно.
+    """
+
+    def __init__(self, cache_dir: str, file_cache: TelegramFileCache = telegram_file_cache, workers: int = THUMB_WORKERS) -> None:
+        self.cache_dir = cache_dir
+        self.file_cache = file_cache
+        self.workers = workers
+        self._executor: ProcessPoolExecutor | None = None
+        self._inflight: dict[tuple[str, str], asyncio.Future] = {}
+        self.hits = 0
+        self.rendered = 0
+
+    @staticmethod
+    def _key(file_id: str) -> str:
+        return hashlib.blake2b(file_id.encode(), digest_size=16).hexdigest()
+
+    def etag(self, file_id: str, size: str) -> str:
+        return f'"{self._key(file_id)}-{size}"'
+
+    def _path(self, file_id: str, size: str) -> str:
+        return os.path.join(self.cache_dir, size, f"{self._key(file_id)}.jpg")
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: не форкаем процесс с запущенным циклом событий и потоками aiosqlite
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def _render(self, data: bytes, px: int) -> bytes:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_executor(), _render_thumbnail, data, px)
+        except BrokenProcessPool as e:
+            logger.warning(f"[thumbs] process pool failed, using thread: {e}")
+            executor, self._executor = self._executor, None
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            return await asyncio.to_thread(_render_thumbnail, data, px)
+
+    async def get(self, bot: Bot, file_id: str, size: str) -> tuple[bytes, str] | None:
+        """(байты, media type) превью size или оригинала (FULL_SIZE); None, если файла нет.
+
+        Не картинка (например, видео в поддержке) отдаётся оригиналом при любом size.
+        """
+        if size not in THUMB_SIZES:
+            data = await self.file_cache.get_bytes(bot, file_id)
+            return (data, sniff_media_type(data)) if data is not None else None
+
+        path = self._path(file_id, size)
+        data = await asyncio.to_thread(TelegramFileCache._read_file, path)
+        if data is not None:
+            self.hits += 1
+            return data, "image/jpeg"
+
+        key = (file_id, size)
+        pending = self._inflight.get(key)
+        if pending is not None:
+            result = await asyncio.shield(pending)
+            if result is not _ABANDONED:
+                return result
+            # Задачу, которая строила превью, отменили — строим сами
+            return await self.get(bot, file_id, size)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            result = await self._build(bot, file_id, size, path)
+            fut.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # Не отменяем future: его ждут другие запросы, которых никто не отменял
+            self._inflight.pop(key, None)
+            fut.set_result(_ABANDONED)
+            raise
+        except Exception as e:
+            logger.warning(f"[thumbs] {file_id} ({size}) failed: {e}")
+            fut.set_result(None)
+            return None
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _build(self, bot: Bot, file_id: str, size: str, path: str) -> tuple[bytes, str] | None:
+        original = await self.file_cache.get_bytes(bot, file_id)
+        if original is None:
+            return None
+        media_type = sniff_media_type(original)
+        if not media_type.startswith("image/"):
+            return original, media_type
+        thumb = await self._render(original, THUMB_SIZES[size])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        await asyncio.to_thread(TelegramFileCache._write_file, path, thumb)
+        self.rendered += 1
+        return thumb, "image/jpeg"
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "rendered": self.rendered, "pending": len(self._inflight)}
+
+
+thumbnail_cache = register("thumbs", ThumbnailCache(os.path.join(BASE_DIR, "data", "thumbs")))
@@ -0,0 +1,438 @@
+"""Webhook-режим: один приёмник и N процессов-воркеров.
+
+Приёмник (aiohttp) принимает апдейты от Telegram и раскладывает их по воркерам
+по хэшу user_id, поэтому все апдейты пользователя попадают в один процесс и
+обрабатываются по порядку. Воркер — обычный Dispatcher со своей БД-пулом,
+хранилищем FSM и кэшами; общее состояние между воркерами — SQLite-файл (или
+Redis для FSM, см. bot/fsm_storage.py) и data/tg_cache на диске.
+
+Включается переменной WEBHOOK_URL (публичный адрес без пути), число воркеров —
+BOT_WORKERS. SIGTERM/SIGINT: приёмник перестаёт принимать апдейты, досылает
+очередь воркерам, воркеры дорабатывают начатое (WEBHOOK_DRAIN_TIMEOUT) и выходят.
+
+Планировщик генераций (GEN_MAX_CONCURRENT, GEN_MAX_QUEUE), минутный лимит
+ключей Gemini и общий лимит исходящих сообщений (OUTBOUND_GLOBAL_RATE) считаются
+в памяти процесса, поэтому воркер получает свою долю — 1/BOT_WORKERS (но не меньше
+одной генерации и одного сообщения в секунду: при GEN_MAX_CONCURRENT < BOT_WORKERS
+генераций одновременно будет BOT_WORKERS). Исключение — исходящие сообщения:
+воркеру 0, который ведёт рассылки, достаётся OUTBOUND_BROADCAST_SHARE (по умолчанию
+половина, не меньше равной доли), остальное поровну делят прочие воркеры; чем больше
+доля, тем быстрее рассылки и тем меньше запас на ответы у остальных. Доля минутного лимита ключа ограничивает
+только собственные запросы воркера; все процессы вместе (по api_usage_log) сверяются
+с полным MAX_MINUTE_USAGE. Веб-админка — отдельный процесс со своими лимитами сверх
+этого. Дневные лимиты ключей сходятся через api_keys с задержкой до ~40 с (flush +
+перечитывание).
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import zlib
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+import aiohttp
+from aiohttp import web
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+WORKER_HOST = "127.0.0.1"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Сколько апдейтов приёмник держит в очереди одного воркера, прежде чем отвечать 503
+FORWARD_QUEUE_SIZE = 10000
+FORWARD_BATCH = 100
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+# Следующий апдейт пользователя ждёт предыдущий не дольше этого (генерация не блокирует кнопку отмены)
+ORDER_WAIT = _env_float("WEBHOOK_ORDER_WAIT", 2.0)
+DRAIN_TIMEOUT = _env_float("WEBHOOK_DRAIN_TIMEOUT", 30.0)
+# Доля OUTBOUND_GLOBAL_RATE у воркера 0, который ведёт рассылки; остальное делят прочие воркеры
+BROADCAST_RATE_SHARE = _env_float("OUTBOUND_BROADCAST_SHARE", 0.5)
+
+
+def shard_key(update: dict[str, Any]) -> int:
+    """user_id автора апдейта (или chat_id, если автора нет); 0 — не удалось определить."""
+    for name, payload in update.items():
+        if name == "update_id" or not isinstance(payload, dict):
+            continue
+        for field in ("from", "user"):
+            user = payload.get(field)
+            if isinstance(user, dict) and user.get("id") is not None:
+                return int(user["id"])
+        chat = payload.get("chat")
+        if chat is None and isinstance(payload.get("message"), dict):
+            chat = payload["message"].get("chat")
+        if isinstance(chat, dict) and chat.get("id") is not None:
+            return int(chat["id"])
+    return 0
+
+
+def shard_for(user_id: int, workers: int) -> int:
+    # crc32 вместо hash(): номер воркера должен совпадать между перезапусками
+    return zlib.crc32(str(user_id).encode()) % max(1, workers)
+
+
+def _media_group_id(update: Update) -> str | None:
+    return update.message.media_group_id if update.message is not None else None
+
+
+class OrderedUpdateRunner:
+    """Обработка апдейтов воркером: по порядку внутри пользователя, параллельно между пользователями."""
+
+    def __init__(self, handle: Callable[[Update], Awaitable[Any]], order_wait: float = ORDER_WAIT) -> None:
+        self._handle = handle
+        self.order_wait = order_wait
+        self._queues: dict[int, deque[Update]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.received = 0
+        self.processed = 0
+
+    @property
+    def pending(self) -> int:
+        return self.received - self.processed
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def submit(self, user_id: int, update: Update) -> None:
+        self.received += 1
+        queue = self._queues.get(user_id)
+        if queue is not None:
+            queue.append(update)
+            return
+        queue = self._queues[user_id] = deque([update])
+        self._spawn(self._user_loop(user_id, queue))
+
+    async def _user_loop(self, user_id: int, queue: deque[Update]) -> None:
+        try:
+            while queue:
+                update = queue.popleft()
+                task = self._spawn(self._run(update))
+                group = _media_group_id(update)
+                if group is not None and queue and _media_group_id(queue[0]) == group:
+                    # Части одного альбома не ждут друг друга — их склеивает MediaGroupMiddleware
+                    continue
+                await asyncio.wait({task}, timeout=self.order_wait)
+        finally:
+            self._queues.pop(user_id, None)
+
+    async def _run(self, update: Update) -> None:
+        try:
+            await self._handle(update)
+        except Exception:
+            logger.exception(f"[webhook] Update {update.update_id} failed")
+        finally:
+            self.processed += 1
+
+    async def drain(self, timeout: float) -> None:
+        """Ждёт завершения всех начатых и поставленных апдейтов; по таймауту отменяет остаток."""
+        deadline = time.monotonic() + timeout
+        while self._tasks:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            await asyncio.wait(set(self._tasks), timeout=left)
+        if self._tasks:
+            logger.warning(f"[webhook] Drain timeout, cancelling {len(self._tasks)} tasks")
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# --- воркер ---
+def _split_process_limits(db, workers: int, index: int) -> None:
+    """Оставляет воркеру его долю общих лимитов, которые считаются в памяти процесса."""
+    if workers <= 1:
+        return
+    from bot.outbound import outbound_limiter
+    from bot.scheduler import generation_scheduler
+
+    generation_scheduler.max_concurrent = max(1, generation_scheduler.max_concurrent // workers)
+    generation_scheduler.max_queue = -(-generation_scheduler.max_queue // workers)
+    db.key_pool.minute_limit = max(1, db.key_pool.minute_limit // workers)
+    # Воркер 0 ведёт рассылки — ему не меньше равной доли исходящих, иначе рассылка идёт
+    # на 1/BOT_WORKERS скорости, даже когда остальные воркеры простаивают
+    share = min(1.0, max(1.0 / workers, BROADCAST_RATE_SHARE))
+    if index != 0:
+        share = (1.0 - share) / (workers - 1)
+    outbound_limiter.set_global_rate(outbound_limiter.global_rate * share)
+
+
+async def _worker(index: int) -> None:
+    from bot.archive import history_archiver
+    from bot.concurrency import snapshot as concurrency_snapshot
+    from bot.config import get_settings, reload_settings
+    from bot.db import Database
+    from bot.gemini import close_clients as close_gemini_clients
+    from bot.main import create_bot, create_dispatcher, resolve_db_path
+
+    settings = get_settings()
+    db = Database(db_path=resolve_db_path(settings))
+    _split_process_limits(db, settings.bot_workers, index)
+    bot = await create_bot(settings, db)
+    dp = create_dispatcher(db, settings)
+    runner = OrderedUpdateRunner(lambda update: dp.feed_update(bot, update))
+    draining = False
+    broadcasts = None
+    if index == 0:
+        # Рассылки ведёт один воркер, чтобы темп не умножался на число процессов;
+        # задания, созданные в других воркерах, он находит опросом
+        from bot.broadcast import create_engine as create_broadcast_engine
+
+        broadcasts = dp['broadcasts'] = create_broadcast_engine(db, bot)
+        broadcasts.start()
+
+    async def on_updates(request: web.Request) -> web.Response:
+        if draining:
+            return web.json_response({"ok": False}, status=503)
+        for raw in await request.json():
+            update = Update.model_validate(raw, context={"bot": bot})
+            runner.submit(shard_key(raw), update)
+        return web.json_response({"ok": True})
+
+    async def on_stats(request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "worker": index,
+                "received": runner.received,
+                "processed": runner.processed,
+                "pending": runner.pending,
+                "primitives": concurrency_snapshot(),
+            }
+        )
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/updates", on_updates)
+    app.router.add_get("/stats", on_stats)
+    app_runner = web.AppRunner(app, access_log=None)
+    await app_runner.setup()
+    await web.TCPSite(app_runner, WORKER_HOST, settings.worker_port_base + index).start()
+    logger.info(f"[webhook] Worker {index} (pid {os.getpid()}) listening on {settings.worker_port_base + index}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    if hasattr(signal, "SIGHUP"):
+        try:
+            loop.add_signal_handler(signal.SIGHUP, reload_settings)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    try:
+        await stop.wait()
+    finally:
+        draining = True
+        logger.info(f"[webhook] Worker {index} draining ({runner.pending} pending)")
+        await runner.drain(DRAIN_TIMEOUT)
+        await app_runner.cleanup()
+        if broadcasts is not None:
+            await broadcasts.close()
+        await history_archiver.close()
+        await dp.storage.close()
+        await close_gemini_clients()
+        await bot.session.close()
+        await db.close()
+        logger.info(f"[webhook] Worker {index} stopped")
+
+
+def _worker_entry(index: int) -> None:
+    asyncio.run(_worker(index))
+
+
+# --- приёмник ---
+class _Forwarder:
+    """Очередь апдейтов одного воркера и задача, которая пересылает их пачками по порядку."""
+
+    def __init__(self, index: int, url: str, session: aiohttp.ClientSession) -> None:
+        self.index = index
+        self.url = url
+        self._session = session
+        self.queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize=FORWARD_QUEUE_SIZE)
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < FORWARD_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            body = b"[" + b",".join(batch) + b"]"
+            delay = 0.1
+            while True:
+                try:
+                    async with self._session.post(
+                        self.url, data=body, headers={"Content-Type": "application/json"}
+                    ) as resp:
+                        if resp.status == 200:
+                            break
+                        logger.warning(f"[webhook] Worker {self.index} answered {resp.status}")
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.debug(f"[webhook] Worker {self.index} unavailable: {e}")
+                # Воркер ещё стартует или перезапускается — повторяем ту же пачку, порядок сохраняется
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2.0)
+            for _ in batch:
+                self.queue.task_done()
+
+    async def drain(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"[webhook] {self.queue.qsize()} updates for worker {self.index} were not delivered")
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+async def run_webhook(settings) -> None:
+    from bot.db import Database
+    from bot.main import create_bot, create_dispatcher, resolve_db_path, set_commands
+
+    workers = settings.bot_workers
+    if workers > 1 and (os.getenv("FSM_STORAGE") or "sqlite").strip().lower() == "memory":
+        raise RuntimeError("FSM_STORAGE=memory is per-process; use sqlite or redis:// with BOT_WORKERS > 1")
+
+    # Миграции — один раз здесь, до запуска воркеров
+    db = Database(db_path=resolve_db_path(settings))
+    await db.init()
+    bot = await create_bot(settings, db)
+    probe = create_dispatcher(db, settings)
+    allowed_updates = probe.resolve_used_update_types()
+    await probe.storage.close()
+
+    ctx = multiprocessing.get_context("spawn")
+    processes: list[multiprocessing.Process | None] = [None] * workers
+
+    def spawn(index: int) -> None:
+        proc = ctx.Process(target=_worker_entry, args=(index,), name=f"bot-worker-{index}", daemon=False)
+        proc.start()
+        processes[index] = proc
+
+    for i in range(workers):
+        spawn(i)
+
+    session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+    forwarders = [
+        _Forwarder(i, f"http://{WORKER_HOST}:{settings.worker_port_base + i}/updates", session)
+        for i in range(workers)
+    ]
+    for forwarder in forwarders:
+        forwarder.start()
+
+    # Запись входящих апдейтов для нагрузочного теста (scripts/loadtest_webhook.py)
+    record_path = os.getenv("WEBHOOK_RECORD_PATH", "").strip()
+    record_file = open(record_path, "ab") if record_path else None
+
+    async def on_update(request: web.Request) -> web.Response:
+        if settings.webhook_secret and request.headers.get(SECRET_HEADER) != settings.webhook_secret:
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            user_id = shard_key(json.loads(body))
+        except (ValueError, TypeError, AttributeError):
+            return web.Response(status=400)
+        forwarder = forwarders[shard_for(user_id, workers)]
+        try:
+            forwarder.queue.put_nowait(body.replace(b"\n", b""))
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже
+            return web.Response(status=503)
+        if record_file is not None:
+            record_file.write(body.replace(b"\n", b"") + b"\n")
+        return web.Response(status=200)
+
+    async def on_stats(request: web.Request) -> web.Response:
+        if settings.webhook_secret and request.headers.get(SECRET_HEADER) != settings.webhook_secret:
+            return web.Response(status=401)
+        stats = []
+        for forwarder in forwarders:
+            item = {"worker": forwarder.index, "queued": forwarder.queue.qsize()}
+            try:
+                async with session.get(forwarder.url.rsplit("/", 1)[0] + "/stats") as resp:
+                    item.update(await resp.json())
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                item["down"] = True
+            stats.append(item)
+        return web.json_response({"workers": stats})
+
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app.router.add_post(settings.webhook_path, on_update)
+    app.router.add_get(settings.webhook_path + "/stats", on_stats)
+    app_runner = web.AppRunner(app, access_log=None)
+    await app_runner.setup()
+    await web.TCPSite(app_runner, settings.webhook_host, settings.webhook_port).start()
+
+    await set_commands(bot)
+    await bot.set_webhook(
+        settings.webhook_url + settings.webhook_path,
+        secret_token=settings.webhook_secret,
+        allowed_updates=allowed_updates,
+        max_connections=100,
+    )
+    logger.info(
+        f"[webhook] Listening on {settings.webhook_host}:{settings.webhook_port}{settings.webhook_path}, "
+        f"{workers} worker(s)"
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+            # Упавший воркер поднимаем заново; его очередь ждёт в _Forwarder
+            for i, proc in enumerate(processes):
+                if not stop.is_set() and proc is not None and not proc.is_alive():
+                    logger.error(f"[webhook] Worker {i} exited with {proc.exitcode}, restarting")
+                    spawn(i)
+    finally:
+        logger.info("[webhook] Shutting down: draining forwarders and workers")
+        # Вебхук не снимаем: Telegram подержит новые апдейты до следующего запуска
+        await app_runner.cleanup()
+        await asyncio.gather(*(f.drain(DRAIN_TIMEOUT) for f in forwarders))
+        await session.close()
+        if record_file is not None:
+            record_file.close()
+        for proc in processes:
+            if proc is not None and proc.is_alive():
+                proc.terminate()
+        for proc in processes:
+            if proc is None:
+                continue
+            await asyncio.to_thread(proc.join, DRAIN_TIMEOUT + 10)
+            if proc.is_alive():
+                logger.warning(f"[webhook] Worker {proc.name} did not stop in time, killing")
+                proc.kill()
+        await bot.session.close()
+        await db.close()
@@ -0,0 +1,105 @@
+"""Сравнение задержек FSM-хранилищ: MemoryStorage, SQLiteStorage и (опционально) Redis.
+
+Запуск из корня проекта:
+    python -m scripts.bench_fsm_storage --users 200 --steps 20
+    python -m scripts.bench_fsm_storage --redis-url redis://localhost:6379/0
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from bot.db import Database
+from bot.fsm_storage import SQLiteStorage
+
+
+def _percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def _bench(storage: BaseStorage, users: int, steps: int) -> dict[str, list[float]]:
+    """Имитирует мастер: на каждом шаге set_state + несколько update_data + get_data."""
+    timings: dict[str, list[float]] = {"update_data": [], "get_data": [], "set_state": []}
+
+    async def user_flow(user_id: int) -> None:
+        key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+        for step in range(steps):
+            t0 = time.perf_counter()
+            await storage.set_state(key, f"CreateForm:step_{step}")
+            timings["set_state"].append(time.perf_counter() - t0)
+            for field in ("value", "label", "current_step_index"):
+                t0 = time.perf_counter()
+                await storage.update_data(key, {f"step{step}_{field}": f"file_id_{user_id}_{step}" * 3})
+                timings["update_data"].append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            await storage.get_data(key)
+            timings["get_data"].append(time.perf_counter() - t0)
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*(user_flow(1000 + i) for i in range(users)))
+    return timings
+
+
+def _report(name: str, timings: dict[str, list[float]], total: float) -> None:
+    print(f"\n{name}: {total:.3f} s total")
+    for op, values in timings.items():
+        us = [v * 1e6 for v in values]
+        print(
+            f"  {op:<12} n={len(us):<7} mean={statistics.fmean(us):8.1f} us"
+            f"  p50={_percentile(us, 0.5):8.1f} us  p99={_percentile(us, 0.99):8.1f} us"
+        )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark FSM storages (update/get latency)")
+    parser.add_argument("--users", type=int, default=200, help="Concurrent users (default: 200)")
+    parser.add_argument("--steps", type=int, default=20, help="Wizard steps per user (default: 20)")
+    parser.add_argument("--redis-url", default=None, help="Redis-protocol server URL (optional)")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    timings = await _bench(MemoryStorage(), args.users, args.steps)
+    _report("MemoryStorage", timings, time.perf_counter() - t0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(db_path=os.path.join(tmp, "bench.db"))
+        await db.init()
+        storage = SQLiteStorage(db)
+        try:
+            t0 = time.perf_counter()
+            timings = await _bench(storage, args.users, args.steps)
+            _report("SQLiteStorage", timings, time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            flushed = await storage.flush()
+            print(f"  flush        {flushed} keys in {(time.perf_counter() - t0) * 1000:.1f} ms")
+            # Холодное чтение: всё из таблицы, без кэша в памяти
+            cold = SQLiteStorage(db)
+            t0 = time.perf_counter()
+            for i in range(args.users):
+                await cold.get_data(StorageKey(bot_id=1, chat_id=1000 + i, user_id=1000 + i))
+            print(f"  cold get     {args.users} keys in {(time.perf_counter() - t0) * 1000:.1f} ms")
+            await cold.close()
+        finally:
+            await storage.close()
+            await db.close()
+
+    if args.redis_url:
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        storage = RedisStorage.from_url(args.redis_url)
+        try:
+            t0 = time.perf_counter()
+            timings = await _bench(storage, args.users, args.steps)
+            _report("RedisStorage", timings, time.perf_counter() - t0)
+        finally:
+            await storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,245 @@
+"""Нагрузочный тест webhook-режима: пропускная способность в зависимости от числа воркеров.
+
+Апдейты берутся из файла, записанного приёмником (WEBHOOK_RECORD_PATH=updates.jsonl),
+или генерируются (/start, /profile, /help от --users пользователей).
+
+Локальный прогон: для каждого значения --workers поднимается бот в webhook-режиме
+на временной БД, а вместо api.telegram.org — встроенный фейковый Bot API
+(TELEGRAM_API_URL) с задержкой --api-latency-ms:
+    python -m scripts.loadtest_webhook --workers 1,2,4 --users 200
+    python -m scripts.loadtest_webhook --workers 1,4 --updates data/updates.jsonl
+
+Прогон против уже запущенного приёмника (только отправка и замер, бот не поднимается):
+    python -m scripts.loadtest_webhook --url http://127.0.0.1:8080/webhook --secret S --updates updates.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+BOT_ID = 123456
+
+
+def load_updates(path: str | None, users: int, per_user: int) -> list[dict]:
+    if path:
+        with open(path, "rb") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    updates = []
+    texts = ["/start", "/profile", "/help", "/settings"]
+    for step in range(per_user):
+        for i in range(users):
+            user_id = 10_000_000 + i
+            text = texts[step % len(texts)]
+            updates.append(
+                {
+                    "message": {
+                        "message_id": step + 1,
+                        "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private", "first_name": f"User{i}"},
+                        "from": {"id": user_id, "is_bot": False, "first_name": f"User{i}", "language_code": "ru"},
+                        "text": text,
+                        "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+                    }
+                }
+            )
+    return updates
+
+
+# --- фейковый Bot API ---
+def _fake_result(method: str, params: dict) -> object:
+    user = {"id": BOT_ID, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+    chat_id = params.get("chat_id") or 1
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        chat_id = 1
+    message = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": user}
+    if method == "getme":
+        return user
+    if method == "getchatmember":
+        return {"status": "member", "user": {"id": int(params.get("user_id") or 1), "is_bot": False, "first_name": "U"}}
+    if method == "getchat":
+        return {"id": chat_id, "type": "private"}
+    if method == "getfile":
+        return {"file_id": params.get("file_id") or "f", "file_unique_id": "u", "file_path": "photos/file.jpg"}
+    if method == "sendmediagroup":
+        return [message]
+    if method.startswith(("send", "edit", "forward", "copymessage")) and method != "sendchataction":
+        return message
+    return True
+
+
+async def start_fake_api(port: int, latency: float) -> tuple[web.AppRunner, dict]:
+    counters = {"calls": 0}
+
+    async def handle(request: web.Request) -> web.Response:
+        counters["calls"] += 1
+        params = dict(await request.post()) if request.can_read_body else {}
+        if latency:
+            await asyncio.sleep(latency)
+        method = request.match_info["method"].lower()
+        return web.json_response({"ok": True, "result": _fake_result(method, params)})
+
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, counters
+
+
+# --- отправка и замер ---
+async def fetch_processed(session: aiohttp.ClientSession, url: str, secret: str | None) -> int | None:
+    try:
+        async with session.get(url + "/stats", headers={SECRET_HEADER: secret or ""}) as resp:
+            if resp.status != 200:
+                return None
+            data = await resp.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        return None
+    if any(w.get("down") for w in data["workers"]):
+        return None
+    return sum(w.get("processed", 0) for w in data["workers"])
+
+
+async def replay(url: str, secret: str | None, updates: list[dict], concurrency: int, timeout: float) -> dict:
+    async with aiohttp.ClientSession() as session:
+        baseline = await fetch_processed(session, url, secret) or 0
+        sem = asyncio.Semaphore(concurrency)
+        statuses: dict[int, int] = {}
+
+        async def send(update_id: int, update: dict) -> None:
+            body = json.dumps({**update, "update_id": update_id}).encode()
+            async with sem:
+                for _ in range(20):
+                    async with session.post(
+                        url, data=body, headers={SECRET_HEADER: secret or "", "Content-Type": "application/json"}
+                    ) as resp:
+                        if resp.status != 503:
+                            statuses[resp.status] = statuses.get(resp.status, 0) + 1
+                            return
+                    await asyncio.sleep(0.2)
+
+        t0 = time.perf_counter()
+        base_id = int(time.time()) * 1000
+        await asyncio.gather(*(send(base_id + i, u) for i, u in enumerate(updates)))
+        accepted = time.perf_counter() - t0
+
+        target = baseline + statuses.get(200, 0)
+        processed = baseline
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            processed = await fetch_processed(session, url, secret) or processed
+            if processed >= target:
+                break
+            await asyncio.sleep(0.05)
+        total = time.perf_counter() - t0
+    done = processed - baseline
+    return {
+        "sent": len(updates),
+        "statuses": statuses,
+        "processed": done,
+        "accept_s": accepted,
+        "total_s": total,
+        "rate": done / total if total else 0.0,
+    }
+
+
+async def wait_ready(url: str, secret: str | None, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if await fetch_processed(session, url, secret) is not None:
+                return True
+            await asyncio.sleep(0.3)
+    return False
+
+
+async def run_local(workers: int, args, updates: list[dict]) -> dict | None:
+    secret = "loadtest"
+    tmp = tempfile.mkdtemp(prefix="loadtest_")
+    env = {
+        **os.environ,
+        "BOT_TOKEN": f"{BOT_ID}:LOADTEST",
+        "GEMINI_API_KEY": os.getenv("GEMINI_API_KEY") or "loadtest",
+        "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(tmp, 'bot.db')}",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.api_port}",
+        "BOT_HTTP_PROXY": "",
+        "WEBHOOK_URL": f"http://127.0.0.1:{args.port}",
+        "WEBHOOK_PATH": "/webhook",
+        "WEBHOOK_SECRET": secret,
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": str(args.port),
+        "WEBHOOK_WORKER_PORT_BASE": str(args.port + 100),
+        "BOT_WORKERS": str(workers),
+        "FSM_STORAGE": "sqlite",
+    }
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "bot.main", env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{args.port}/webhook"
+    try:
+        if not await wait_ready(url, secret, 60):
+            print(f"workers={workers}: bot did not start")
+            return None
+        return await replay(url, secret, updates, args.concurrency, args.timeout)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), 60)
+        except asyncio.TimeoutError:
+            proc.kill()
+
+
+def print_result(label: str, res: dict) -> None:
+    print(
+        f"{label:<12} sent={res['sent']} processed={res['processed']} statuses={res['statuses']} "
+        f"accept={res['accept_s']:.2f}s total={res['total_s']:.2f}s -> {res['rate']:.1f} updates/s"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay updates against the webhook receiver and measure throughput")
+    parser.add_argument("--updates", default=None, help="JSONL file recorded via WEBHOOK_RECORD_PATH")
+    parser.add_argument("--users", type=int, default=100, help="Synthetic users (without --updates)")
+    parser.add_argument("--per-user", type=int, default=5, help="Synthetic updates per user")
+    parser.add_argument("--workers", default="1,2,4", help="Worker counts for local runs, e.g. 1,2,4")
+    parser.add_argument("--url", default=None, help="Existing receiver URL (skips local runs)")
+    parser.add_argument("--secret", default=None, help="WEBHOOK_SECRET of the existing receiver")
+    parser.add_argument("--concurrency", type=int, default=50, help="Parallel HTTP requests")
+    parser.add_argument("--api-latency-ms", type=float, default=30.0, help="Fake Bot API latency")
+    parser.add_argument("--port", type=int, default=18080, help="Receiver port for local runs")
+    parser.add_argument("--api-port", type=int, default=18081, help="Fake Bot API port")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Max wait for processing, seconds")
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates, args.users, args.per_user)
+    print(f"{len(updates)} updates")
+
+    if args.url:
+        print_result("remote", await replay(args.url, args.secret, updates, args.concurrency, args.timeout))
+        return
+
+    api_runner, counters = await start_fake_api(args.api_port, args.api_latency_ms / 1000)
+    try:
+        for workers in [int(w) for w in args.workers.split(",") if w.strip()]:
+            counters["calls"] = 0
+            res = await run_local(workers, args, updates)
+            if res is not None:
+                print_result(f"workers={workers}", res)
+                print(f"{'':<12} fake Bot API calls: {counters['calls']}")
+    finally:
+        await api_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())